@@ -0,0 +1,123 @@
+import discord
+import aiohttp
+import datetime
+
+class Alert():
+    """A single (guild, problem) alert waiting to be sent"""
+    def __init__(self, guild: discord.Guild, problem: str, message: str, logs_channel: int | None):
+        self.guild_id = guild.id
+        self.guild_name = guild.name
+        self.problem = problem
+        self.message = message
+        self.logs_channel = logs_channel
+        self.subjects: list[str] = []
+        self.count = 0
+
+    def summary(self, max_subjects: int = 10) -> str:
+        subjects = ", ".join(self.subjects[:max_subjects])
+
+        if self.count > max_subjects:
+            subjects += f" and {self.count - max_subjects} more"
+
+        return f"- **{self.guild_name}** ({self.guild_id}): {self.message} [affected {self.count}: {subjects}]"
+
+class AlertDigest():
+    """
+    Collects alerts raised while handling members and sends them as one digest per flush
+
+    Alerts are deduplicated by (guild, problem). Once an alert has been sent, repeats of it
+    are suppressed until ``window`` has passed, so a deleted role only alerts once per window
+    instead of once per member per sweep
+    """
+    def __init__(self, window: datetime.timedelta = datetime.timedelta(hours=1)):
+        self.window = window
+        self.pending: dict[tuple[int, str], Alert] = {}
+        self.last_sent: dict[tuple[int, str], datetime.datetime] = {}
+
+    def add(self, guild: discord.Guild, problem: str, subject: str, message: str, logs_channel: int | None = None):
+        """
+        Queues an alert. ``subject`` is what was affected (usually a member), ``message`` should not depend on it
+
+        If ``logs_channel`` is set, the alert goes to that channel of the guild, otherwise to the notify webhook
+        """
+        key = (guild.id, problem)
+
+        sent_at = self.last_sent.get(key)
+        if sent_at and datetime.datetime.now() - sent_at < self.window:
+            return
+
+        alert = self.pending.get(key)
+
+        if not alert:
+            alert = Alert(guild, problem, message, logs_channel)
+            self.pending[key] = alert
+
+        alert.count += 1
+        alert.subjects.append(subject)
+
+    async def flush(self, client: discord.Client, notify_webhook: str):
+        """Sends all pending alerts, one message per destination"""
+        now = datetime.datetime.now()
+
+        # Forget suppressions that have expired so this does not grow forever
+        for key, sent_at in list(self.last_sent.items()):
+            if now - sent_at >= self.window:
+                del self.last_sent[key]
+
+        if not self.pending:
+            return
+
+        pending, self.pending = self.pending, {}
+
+        webhook_alerts: list[Alert] = []
+        channel_alerts: dict[int, list[Alert]] = {}
+        for key, alert in pending.items():
+            self.last_sent[key] = now
+
+            if alert.logs_channel:
+                channel_alerts.setdefault(alert.logs_channel, []).append(alert)
+            else:
+                webhook_alerts.append(alert)
+
+        for channel_id, alerts in channel_alerts.items():
+            channel = client.get_channel(channel_id)
+
+            if not channel:
+                print(f"AlertDigest: Failed to find logs channel {channel_id}, sending to webhook instead")
+                webhook_alerts.extend(alerts)
+                continue
+
+            for msg in _chunk_messages(alerts):
+                try:
+                    await channel.send(msg)
+                except discord.HTTPException as exc:
+                    print(f"AlertDigest: Failed to send digest to {channel_id}: {exc}")
+
+        if webhook_alerts:
+            async with aiohttp.ClientSession() as session:
+                hook = discord.Webhook.from_url(notify_webhook, session=session)
+
+                for msg in _chunk_messages(webhook_alerts):
+                    try:
+                        await hook.send(content=msg)
+                    except discord.HTTPException as exc:
+                        print(f"AlertDigest: Failed to send digest to webhook: {exc}")
+
+def _chunk_messages(alerts: list[Alert]) -> list[str]:
+    """Splits alerts into messages that fit within discords message limit"""
+    msgs = []
+    msg = "**Alert digest**\n"
+
+    for alert in alerts:
+        line = alert.summary()[:1800]
+
+        if len(msg) + len(line) >= 1900:
+            msgs.append(msg)
+            msg = ""
+
+        msg += f"\n{line}"
+
+    if msg:
+        msgs.append(msg)
+
+    return msgs
@@ -4,12 +4,30 @@ from fastapi.responses import HTMLResponse, RedirectResponse
 from pydantic import BaseModel
 import secrets
 import datetime
-from kittycat import has_perm, Permission
-from perms import get_user_staff_perms
-from main import config, bot, MAX_PER_CACHE_SERVER, handle_member
+import asyncio
+import heapq
+import aiohttp
+import uvicorn
+from perms import get_user_staff_perms, resolve, check, refresh_staff_positions_forever
+from oauth_states import StateStore, MemoryStateStore, PostgresStateStore
+from placements import PlacementCache
+from gateway import Gateway, GatewayError, RemoteGateway
+from config import Config, ConfigService, load_config
+from constants import MAX_PER_CACHE_SERVER, PLACEMENT_LOCK
+from db import ManagedPool, ReadPool, create_managed_pool, create_read_pool
+import queries
 
 app = fastapi.FastAPI()
 
+# Set by main.py when running embedded in the bot process, otherwise by setup() in each standalone worker
+config: Config = None
+pool: ManagedPool = None
+read_pool: ReadPool = None # reads that can tolerate replication lag
+session: aiohttp.ClientSession = None
+placements: PlacementCache = None
+read_placements: PlacementCache = None # placements for read-only endpoints, never use to decide on writes
+gateway: Gateway = None
+
 async def check_internal(request: Request):
     print(request.headers)
     if request.headers.get("X-Forwarded-For"):
@@ -20,40 +38,58 @@ async def handle_bot_on_all_cache_servers(request: Request, bot_id: int):
     """Handles the user on all cache servers they are on. Internal only"""
     await check_internal(request)
 
-    cache_server = await bot.pool.fetchval("SELECT guild_id FROM cache_server_bots WHERE bot_id = $1", str(bot_id))
+    try:
+        await gateway.handle_bot(bot_id)
+    except GatewayError as exc:
+        raise HTTPException(status_code=exc.status, detail=exc.detail)
+
+@app.get("/getCacheServerOfBot")
+async def get_cache_server_of_bot(request: Request, bot_id: str):
+    """Returns the cache server of a bot"""
+    placement = await read_placements.get(bot_id)
 
-    if cache_server is None:
+    if placement is None:
         raise HTTPException(status_code=404, detail="Bot not found in any cache server")
     
-    cache_server_info = await bot.pool.fetchrow("SELECT bots_role, system_bots_role, logs_channel, staff_role from cache_servers WHERE guild_id = $1", str(member.guild.id))
-
-    if not cache_server_info:
+    guild_id = int(placement.guild_id)
+    if not await gateway.guilds([guild_id]):
         raise HTTPException(status_code=500, detail="Cache server not found despite existing in database")
 
-    member = bot.get_guild(int(cache_server)).get_member(bot_id)
+    member = await gateway.members([(guild_id, int(bot_id))])
 
-    if member is None:
-        raise HTTPException(status_code=500, detail="Bot not found in cache server")
+    return {"guild_id": placement.guild_id, "invite_code": placement.invite_code, "member": bool(member)}
 
-    await handle_member(member, cache_server_info=cache_server_info)
+class CacheServerOfBot(BaseModel):
+    guild_id: str
+    invite_code: str
+    member: bool
 
-@app.get("/getCacheServerOfBot")
-async def get_cache_server_of_bot(request: Request, bot_id: str):
-    """Returns the cache server of a bot"""
-    cache_server = await bot.pool.fetchval("SELECT guild_id FROM cache_server_bots WHERE bot_id = $1", bot_id)
+class GetCacheServerOfBots(BaseModel):
+    bot_ids: list[str]
 
-    if cache_server is None:
-        raise HTTPException(status_code=404, detail="Bot not found in any cache server")
-    
-    data = await bot.pool.fetchrow("SELECT invite_code FROM cache_servers WHERE guild_id = $1", cache_server)
-    
-    guild = bot.get_guild(int(cache_server))
-    if guild is None:
-        raise HTTPException(status_code=500, detail="Cache server not found despite existing in database")
+@app.post("/getCacheServerOfBots", response_model=dict[str, CacheServerOfBot])
+async def get_cache_server_of_bots(request: Request, data: GetCacheServerOfBots):
+    """Returns the cache servers of many bots at once. Bots not in any (known) cache server are left out"""
+    if len(data.bot_ids) > 1000:
+        raise HTTPException(status_code=400, detail="Too many bot ids, max 1000")
+
+    found = await read_placements.get_many(data.bot_ids)
 
-    member = guild.get_member(int(bot_id))
+    guilds = await gateway.guilds(list({int(p.guild_id) for p in found.values()}))
+    members = await gateway.members([(int(p.guild_id), int(bot_id)) for bot_id, p in found.items()])
 
-    return {"guild_id": cache_server, "invite_code": data["invite_code"], "member": member is not None}
+    resp = {}
+    for bot_id, placement in found.items():
+        if int(placement.guild_id) not in guilds:
+            continue
+
+        resp[bot_id] = {
+            "guild_id": placement.guild_id,
+            "invite_code": placement.invite_code,
+            "member": (int(placement.guild_id), int(bot_id)) in members
+        }
+
+    return resp
 
 class AddBotToCacheServer(BaseModel):
     guild_id: str
@@ -66,50 +102,179 @@ async def add_bot_to_cache_server(request: Request, bot_id: str, ignore_bot_type
     """Adds a bot to a cache server. Internal-only"""
     await check_internal(request)
 
-    # Check if bot is approved/certified
-    if not ignore_bot_type:
-        typ = await bot.pool.fetchval("SELECT type FROM bots WHERE bot_id = $1", str(bot_id))
+    # Check if bot is approved/certified, the bot must exist even when ignoring its type
+    typ = await queries.bot_type(pool, bot_id)
 
-        if typ is None:
-            raise HTTPException(status_code=404, detail="Bot not found")
-        
-        if typ not in ["approved", "certified"]:
-            raise HTTPException(status_code=403, detail="Bot not approved/certified")
+    if typ is None:
+        raise HTTPException(status_code=404, detail="Bot not found")
+
+    if not ignore_bot_type and typ not in ["approved", "certified"]:
+        raise HTTPException(status_code=403, detail="Bot not approved/certified")
     
     # Check if bot is already in a cache server
-    cs = await bot.pool.fetchval("SELECT guild_id FROM cache_server_bots WHERE bot_id = $1", bot_id)
+    placement = await placements.get(bot_id)
 
-    if cs is not None:
+    if placement is not None:
         # Return invite code
-        cache_server = await bot.pool.fetchrow("SELECT invite_code, name FROM cache_servers WHERE guild_id = $1", cs)
         return {
-            "guild_id": cs, 
-            "name": cache_server["name"], 
-            "invite_code": cache_server["invite_code"], 
+            "guild_id": placement.guild_id, 
+            "name": placement.name, 
+            "invite_code": placement.invite_code, 
             "added": False
         }
 
-    # Find a cache server with less than MAX_PER_CACHE_SERVER bots
-    available = await bot.pool.fetch("select guild_id, count(*) from cache_server_bots group by guild_id order by random()")
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            await conn.execute(PLACEMENT_LOCK)
 
-    guild_id: str = None
-    for data in available:
-        if data["count"] < MAX_PER_CACHE_SERVER:
-            guild_id = data["guild_id"]
-            break
-    
-    if guild_id is None:
-        print("ERROR: No available cache servers")
-        raise HTTPException(status_code=500, detail="No available cache servers")
+            # A concurrent request may have placed the bot since the cache was read
+            guild_id = await queries.cache_server_of_bot(conn, bot_id)
+            added = guild_id is None
+
+            if added:
+                # Find a cache server with less than MAX_PER_CACHE_SERVER bots
+                available = await queries.cache_server_counts(conn)
+
+                for data in available:
+                    if data["count"] < MAX_PER_CACHE_SERVER:
+                        guild_id = data["guild_id"]
+                        break
+
+                if guild_id is None:
+                    print("ERROR: No available cache servers")
+                    raise HTTPException(status_code=500, detail="No available cache servers")
+
+                # Add bot to cache server
+                await queries.add_cache_server_bot(conn, guild_id, bot_id)
+
+    placements.invalidate(bot_id)
+
+    data = await queries.cache_server_invite(pool, guild_id)
+
+    return {"guild_id": guild_id, "name": data["name"], "invite_code": data["invite_code"], "added": added}
+
+class AddBotsToCacheServers(BaseModel):
+    bot_ids: list[str]
+    ignore_bot_type: bool = False
+
+class BotPlacement(BaseModel):
+    bot_id: str
+    guild_id: str | None = None
+    name: str | None = None
+    invite_code: str | None = None
+    added: bool = False
+    error: str | None = None
 
-    # Add bot to cache server
-    await bot.pool.execute("INSERT INTO cache_server_bots (guild_id, bot_id) VALUES ($1, $2)", guild_id, bot_id)
+@app.post("/addBotsToCacheServers", response_model=list[BotPlacement])
+async def add_bots_to_cache_servers(request: Request, data: AddBotsToCacheServers):
+    """Adds many bots to cache servers at once, spreading them by free capacity. Internal-only"""
+    await check_internal(request)
+
+    if len(data.bot_ids) > 1000:
+        raise HTTPException(status_code=400, detail="Too many bot ids, max 1000")
+
+    bot_ids = list(dict.fromkeys(data.bot_ids))
+    results = {bot_id: {"bot_id": bot_id} for bot_id in bot_ids}
 
-    data = await bot.pool.fetchrow("SELECT name, invite_code FROM cache_servers WHERE guild_id = $1", guild_id)
+    # Check if bots are approved/certified, unknown bots are left out even when ignoring types as they cannot be inserted
+    types = await queries.bot_types(pool, bot_ids)
 
-    return {"guild_id": guild_id, "name": data["name"], "invite_code": data["invite_code"], "added": True}
+    to_place = []
+    for bot_id in bot_ids:
+        typ = types.get(bot_id)
+
+        if typ is None:
+            results[bot_id]["error"] = "Bot not found"
+        elif not data.ignore_bot_type and typ not in ["approved", "certified"]:
+            results[bot_id]["error"] = "Bot not approved/certified"
+        else:
+            to_place.append(bot_id)
+
+    inserts = []
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            await conn.execute(PLACEMENT_LOCK)
+
+            servers = {
+                r["guild_id"]: r for r in await conn.fetch(
+                    "SELECT cs.guild_id, cs.name, cs.invite_code, COUNT(csb.bot_id) AS count FROM cache_servers cs LEFT JOIN cache_server_bots csb ON csb.guild_id = cs.guild_id GROUP BY cs.guild_id"
+                )
+            }
+            existing = {r["bot_id"]: r["guild_id"] for r in await conn.fetch("SELECT bot_id, guild_id FROM cache_server_bots WHERE bot_id = ANY($1)", to_place)}
+
+            # Always place into the server with the most free slots, ties broken randomly
+            free = [(-(MAX_PER_CACHE_SERVER - s["count"]), secrets.randbits(16), guild_id) for guild_id, s in servers.items() if s["count"] < MAX_PER_CACHE_SERVER]
+            heapq.heapify(free)
+
+            for bot_id in to_place:
+                guild_id = existing.get(bot_id)
+                added = False
+
+                if guild_id is None:
+                    if not free:
+                        results[bot_id]["error"] = "No available cache servers"
+                        continue
+
+                    neg_free, tiebreak, guild_id = heapq.heappop(free)
+                    if neg_free + 1 < 0:
+                        heapq.heappush(free, (neg_free + 1, tiebreak, guild_id))
+
+                    inserts.append((guild_id, bot_id))
+                    added = True
+
+                server = servers.get(guild_id)
+                results[bot_id].update({
+                    "guild_id": guild_id,
+                    "name": server["name"] if server else None,
+                    "invite_code": server["invite_code"] if server else None,
+                    "added": added
+                })
+
+            if inserts:
+                await conn.executemany("INSERT INTO cache_server_bots (guild_id, bot_id) VALUES ($1, $2)", inserts)
+
+    placements.invalidate(*[bot_id for _, bot_id in inserts])
+
+    if any(r.get("error") == "No available cache servers" for r in results.values()):
+        print("ERROR: No available cache servers")
+
+    return list(results.values())
+
+_states: StateStore = None
+
+def config_reloaded(old: Config, new: Config):
+    global config
+    config = new
+    pool.warn_after = new.db_hold_warn_seconds
+    pool.reclaim_after = new.db_hold_reclaim_seconds
+
+@app.on_event("startup")
+async def setup():
+    global config, pool, read_pool, session, placements, read_placements, gateway, _states
+
+    if gateway is None:
+        # Standalone worker, everything the bot would have given us needs to be made here
+        config_service = ConfigService()
+        config_service.listen(config_reloaded)
+        asyncio.create_task(config_service.watch())
+        config = config_service.config
+        pool = await create_managed_pool(config)
+        asyncio.create_task(pool.watch())
+        read_pool = await create_read_pool(pool, config.replica_postgres_url)
+        session = aiohttp.ClientSession()
+        # Writes made by the bot process cannot invalidate this cache, so keep entries short-lived
+        placements = PlacementCache(pool, ttl=datetime.timedelta(seconds=30))
+        read_placements = PlacementCache(read_pool, ttl=datetime.timedelta(seconds=30)) if read_pool.replica else placements
+        gateway = RemoteGateway(read_pool, config.ipc_socket, cluster_count=config.cluster_count, shard_count=config.shard_count)
+        asyncio.create_task(refresh_staff_positions_forever(pool))
+
+    if config.oauth_state_backend == "postgres":
+        _states = PostgresStateStore(pool)
+    else:
+        _states = MemoryStateStore()
+
+    asyncio.create_task(_states.sweep_forever())
 
-_states = {}
 @app.get("/oauth2")
 async def oauth2(request: Request, code: str | None = None, error: str | None = None, state: str | None = None):
     """OAuth2 callback"""
@@ -118,17 +283,19 @@ async def oauth2(request: Request, code: str | None = None, error: str | None =
     
     if code is None:
         state = secrets.token_urlsafe(16)
-        _states[state] = [datetime.datetime.now(), "borealis"]
+        await _states.set(state, "borealis")
         return RedirectResponse(f"https://discord.com/oauth2/authorize?client_id={config.borealis_client_id}&redirect_uri={config.base_url}/oauth2&response_type=code&scope=identify%20guilds.join&state={state}")
 
-    if state not in _states:
+    state_data = await _states.get(state) if state else None
+
+    if not state_data:
         return HTMLResponse("<h1>Error: Invalid state</h1>")
 
-    state_created_at, state_bot = _states[state]
+    state_created_at, state_bot = state_data
     
-    if (datetime.datetime.now() - state_created_at).total_seconds() > 60:
+    if _states.expired(state_created_at):
         # Remove state
-        del _states[state]
+        await _states.delete(state)
         return HTMLResponse("<h1>Error: State expired</h1>")
     
     # Exchange code for token
@@ -141,8 +308,8 @@ async def oauth2(request: Request, code: str | None = None, error: str | None =
         "scope": "identify guilds.join"
     }
 
-    async with bot.session.post("https://discord.com/api/v10/oauth2/token", data=data) as resp:
-        del _states[state]
+    async with session.post("https://discord.com/api/v10/oauth2/token", data=data) as resp:
+        await _states.delete(state)
         if resp.status != 200:
             err = await resp.text()
             return HTMLResponse(f"<h1>Error: {resp.status}: {err}</h1>")
@@ -150,7 +317,7 @@ async def oauth2(request: Request, code: str | None = None, error: str | None =
         data = await resp.json()
 
     # Get user info
-    async with bot.session.get("https://discord.com/api/v10/users/@me", headers={"Authorization": f"Bearer {data['access_token']}"}) as resp:
+    async with session.get("https://discord.com/api/v10/users/@me", headers={"Authorization": f"Bearer {data['access_token']}"}) as resp:
         if resp.status != 200:
             err = await resp.text()
             return HTMLResponse(f"<h1>Error: {resp.status}: {err}</h1>")
@@ -161,13 +328,13 @@ async def oauth2(request: Request, code: str | None = None, error: str | None =
         id = int(user["id"])
 
         try:
-            usp = await get_user_staff_perms(bot.pool, id)
+            usp = await get_user_staff_perms(pool, id)
         except Exception as e:
             return HTMLResponse(f"<h1>Error: {e}</h1>")
 
         try:
-            usp = await get_user_staff_perms(bot.pool, id)
-            resolved = usp.resolve()
+            usp = await get_user_staff_perms(pool, id)
+            resolved = resolve(usp)
         except:
             resolved = []
         
@@ -175,11 +342,21 @@ async def oauth2(request: Request, code: str | None = None, error: str | None =
             return HTMLResponse("<h1>Error: You are not a staff member</h1>")
     
         # Add to db
-        await bot.pool.execute("INSERT INTO cache_server_oauths (user_id, access_token, refresh_token, expires_at, bot) VALUES ($1, $2, $3, $4, $5) ON CONFLICT (user_id, bot) DO UPDATE SET access_token = $2, refresh_token = $3, expires_at = $4", str(id), data["access_token"], data["refresh_token"], datetime.datetime.now() + datetime.timedelta(seconds=data["expires_in"]), state_bot)
+        await pool.execute("INSERT INTO cache_server_oauths (user_id, access_token, refresh_token, expires_at, bot) VALUES ($1, $2, $3, $4, $5) ON CONFLICT (user_id, bot) DO UPDATE SET access_token = $2, refresh_token = $3, expires_at = $4", str(id), data["access_token"], data["refresh_token"], datetime.datetime.now() + datetime.timedelta(seconds=data["expires_in"]), state_bot)
 
-    if has_perm(resolved, Permission.from_str("borealis.make_cache_servers")) and state_bot == "borealis":
+    if check(usp, "borealis.make_cache_servers") and state_bot == "borealis":
         # Set new state to doxycycline and refresh back to /oauth2 with state param
-        _states[state] = [datetime.datetime.now(), "doxycycline"]
+        await _states.set(state, "doxycycline")
         return RedirectResponse(f"https://discord.com/oauth2/authorize?client_id={config.cache_server_maker.client_id}&redirect_uri={config.base_url}/oauth2&response_type=code&scope=identify%20guilds.join&state={state}")
 
     return HTMLResponse("<h1>Success! You can now close this tab</h1>")
+
+if __name__ == "__main__":
+    # Standalone mode, see api_mode in config.yaml
+    standalone_config = load_config()
+
+    # Each worker has its own memory state store, a callback landing on another worker would fail with "Invalid state"
+    if standalone_config.api_workers > 1 and standalone_config.oauth_state_backend != "postgres":
+        raise SystemExit("api_workers > 1 needs oauth_state_backend: postgres, OAuth2 states are not shared between workers otherwise")
+
+    uvicorn.run("api:app", port=2837, workers=standalone_config.api_workers)
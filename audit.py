@@ -0,0 +1,55 @@
+import asyncpg
+import asyncio
+import datetime
+
+class ActionLog():
+    """
+    Append-only log of the actions Borealis takes on cache servers (kicks, role changes, invite rotations, deletions)
+
+    record is synchronous and only appends to an in-memory buffer, flush writes the buffer to
+    cache_server_actions with a single COPY. A flush is also started early once flush_at actions are buffered.
+    If postgres is down, actions are kept (up to max_buffer, dropping the oldest) until the next flush
+    """
+    def __init__(self, pool: asyncpg.Pool, flush_at: int = 500, max_buffer: int = 50000):
+        self.pool = pool
+        self.flush_at = flush_at
+        self.max_buffer = max_buffer
+        self.dropped = 0
+        self._buffer: list[tuple[str, str | None, str, str | None, datetime.datetime]] = []
+        self._flushing: asyncio.Task | None = None
+
+    def record(self, guild_id: int, action: str, target_id: int | None = None, reason: str | None = None):
+        self._buffer.append((
+            str(guild_id),
+            str(target_id) if target_id is not None else None,
+            action,
+            reason,
+            datetime.datetime.now(tz=datetime.timezone.utc)
+        ))
+
+        if len(self._buffer) > self.max_buffer:
+            self.dropped += len(self._buffer) - self.max_buffer
+            del self._buffer[:len(self._buffer) - self.max_buffer]
+
+        if len(self._buffer) >= self.flush_at and (not self._flushing or self._flushing.done()):
+            self._flushing = asyncio.create_task(self.flush())
+
+    async def flush(self) -> int:
+        """Writes all buffered actions, returning how many were written"""
+        if not self._buffer:
+            return 0
+
+        records, self._buffer = self._buffer, []
+
+        try:
+            await self.pool.copy_records_to_table(
+                "cache_server_actions",
+                records=records,
+                columns=["guild_id", "target_id", "action", "reason", "created_at"]
+            )
+        except (asyncpg.PostgresError, OSError) as exc:
+            print(f"ActionLog: Failed to flush {len(records)} actions, will retry: {exc}")
+            self._buffer = records + self._buffer
+            return 0
+
+        return len(records)
@@ -0,0 +1,78 @@
+"""
+Compares the latency of the hot queries in queries.QUERIES run inline (as before) against the prepared statements
+
+Usage: python bench_queries.py [iterations] (uses postgres_url from config.yaml, or the POSTGRES_URL environment variable)
+"""
+import asyncio
+import os
+import sys
+import time
+import asyncpg
+import queries
+from config import load_config
+
+async def sample_args(pool: asyncpg.Pool) -> dict[str, tuple]:
+    """Arguments for each query, taken from existing rows where possible"""
+    bot_id = await pool.fetchval("SELECT bot_id FROM cache_server_bots LIMIT 1") or "0"
+    guild_id = await pool.fetchval("SELECT guild_id FROM cache_servers LIMIT 1") or "0"
+    staff = await pool.fetchrow("SELECT user_id, positions FROM staff_members LIMIT 1")
+
+    return {
+        "staff_member": (staff["user_id"] if staff else "0",),
+        "staff_positions": (staff["positions"] if staff else [],),
+        "bot_type": (bot_id,),
+        "bot_types": ([bot_id],),
+        "bot_is_premium_or_certified": (bot_id,),
+        "bot_is_whitelisted": (bot_id,),
+        "bot_is_partner": (bot_id,),
+        "cache_server_of_bot": (bot_id,),
+        "is_selected_bot": (guild_id, bot_id),
+        "cache_server_info": (guild_id,),
+        "cache_server_invite": (guild_id,),
+        "cache_server_counts": (),
+        "placements": ([bot_id],),
+    }
+
+def percentile(samples: list[float], p: float) -> float:
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+async def bench(func, iterations: int) -> list[float]:
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        await func()
+        samples.append((time.perf_counter() - start) * 1000)
+
+    return samples
+
+async def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    dsn = os.environ.get("POSTGRES_URL") or load_config().postgres_url
+
+    # statement_cache_size=0 shows the cost of parsing and planning on every call
+    inline_uncached = await asyncpg.create_pool(dsn, min_size=1, max_size=1, statement_cache_size=0)
+    inline = await asyncpg.create_pool(dsn, min_size=1, max_size=1)
+    prepared = await queries.create_pool(dsn, min_size=1, max_size=1)
+
+    args = await sample_args(inline)
+
+    print(f"{'query':<30} {'mode':<16} {'p50 ms':>8} {'p99 ms':>8} {'mean ms':>8}")
+    for name, query in queries.QUERIES.items():
+        if name not in args:
+            continue # Writes are not benchmarked
+
+        modes = {
+            "inline (no cache)": lambda: inline_uncached.fetch(query, *args[name]),
+            "inline": lambda: inline.fetch(query, *args[name]),
+            "prepared": lambda: queries.fetch(prepared, name, *args[name]),
+        }
+
+        for mode, func in modes.items():
+            samples = await bench(func, iterations)
+            print(f"{name:<30} {mode:<16} {percentile(samples, 0.5):>8.3f} {percentile(samples, 0.99):>8.3f} {sum(samples) / len(samples):>8.3f}")
+
+    await asyncio.gather(inline_uncached.close(), inline.close(), prepared.close())
+
+if __name__ == "__main__":
+    asyncio.run(main())
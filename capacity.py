@@ -0,0 +1,119 @@
+import asyncpg
+import datetime
+import math
+from typing import Awaitable, Callable
+
+class CapacitySnapshot():
+    """Fleet capacity at one point in time"""
+    def __init__(self, servers: int, placed: int, placed_last_day: int, pending: int, last_provisioned: datetime.datetime | None, capacity: int):
+        self.servers = servers
+        self.placed = placed
+        self.placed_last_day = placed_last_day
+        self.pending = pending # Unprovisioned cache servers created by the planner that have not been set up yet
+        self.last_provisioned = last_provisioned
+        self.capacity = capacity
+
+    @property
+    def free(self) -> int:
+        return max(0, self.servers * self.capacity - self.placed)
+
+    @property
+    def fill_ratio(self) -> float:
+        return self.placed / (self.servers * self.capacity) if self.servers else 1
+
+    @property
+    def rate_per_hour(self) -> float:
+        """Bots placed per hour, averaged over the last day"""
+        return self.placed_last_day / 24
+
+class CapacityPlanner():
+    """
+    Creates unprovisioned cache servers ahead of demand
+
+    Keeps free capacity (plus the capacity of pending servers) above the larger of min_free and the
+    number of bots expected to be placed within the horizon. Pending servers are tracked in
+    cache_server_pending until create_cache_server sets them up, and stop counting after pending_ttl.
+    The cooldown runs from the last attempt (cache_server_provision_attempts), successful or not
+    """
+    def __init__(
+        self,
+        pool: asyncpg.Pool,
+        capacity: int,
+        min_free: int,
+        horizon: datetime.timedelta,
+        cooldown: datetime.timedelta,
+        max_pending: int,
+        pending_ttl: datetime.timedelta = datetime.timedelta(days=3)
+    ):
+        self.pool = pool
+        self.capacity = capacity
+        self.min_free = min_free
+        self.horizon = horizon
+        self.cooldown = cooldown
+        self.max_pending = max_pending
+        self.pending_ttl = pending_ttl
+
+    async def snapshot(self) -> CapacitySnapshot:
+        row = await self.pool.fetchrow(
+            """
+            SELECT
+                (SELECT COUNT(*) FROM cache_servers) AS servers,
+                (SELECT COUNT(*) FROM cache_server_bots) AS placed,
+                (SELECT COUNT(*) FROM cache_server_bots WHERE created_at > NOW() - INTERVAL '1 day') AS placed_last_day,
+                (SELECT COUNT(*) FROM cache_server_pending WHERE created_at > NOW() - $1::interval) AS pending,
+                (SELECT MAX(created_at) FROM cache_server_provision_attempts) AS last_provisioned
+            """,
+            self.pending_ttl
+        )
+
+        return CapacitySnapshot(row["servers"], row["placed"], row["placed_last_day"], row["pending"], row["last_provisioned"], self.capacity)
+
+    def wanted_free(self, snapshot: CapacitySnapshot) -> int:
+        """How much free capacity should be available right now"""
+        return max(self.min_free, math.ceil(snapshot.rate_per_hour * self.horizon.total_seconds() / 3600))
+
+    def servers_needed(self, snapshot: CapacitySnapshot) -> int:
+        """How many more unprovisioned servers should be created, ignoring the cooldown"""
+        deficit = self.wanted_free(snapshot) - snapshot.free - snapshot.pending * self.capacity
+
+        if deficit <= 0:
+            return 0
+
+        return min(math.ceil(deficit / self.capacity), max(0, self.max_pending - snapshot.pending))
+
+    def cooling_down(self, snapshot: CapacitySnapshot) -> bool:
+        if not snapshot.last_provisioned:
+            return False
+
+        return datetime.datetime.now(tz=datetime.timezone.utc) - snapshot.last_provisioned < self.cooldown
+
+    async def run(self, provision: Callable[[], Awaitable[int]]) -> int:
+        """
+        Provisions at most one server if more capacity is needed, returning how many were created
+
+        provision creates an unprovisioned cache server and returns its guild id
+        """
+        snapshot = await self.snapshot()
+        needed = self.servers_needed(snapshot)
+
+        print(f"CapacityPlanner: fill={snapshot.fill_ratio:.0%} free={snapshot.free} pending={snapshot.pending} rate={snapshot.rate_per_hour:.1f}/h wanted_free={self.wanted_free(snapshot)} needed={needed}")
+
+        if not needed or self.cooling_down(snapshot):
+            return 0
+
+        # Recorded first so the cooldown also applies when provisioning fails part way
+        attempt_id = await self.pool.fetchval("INSERT INTO cache_server_provision_attempts DEFAULT VALUES RETURNING id")
+
+        try:
+            guild_id = await provision()
+        except Exception as exc:
+            await self.pool.execute("UPDATE cache_server_provision_attempts SET error = $2 WHERE id = $1", attempt_id, str(exc))
+            raise
+
+        await self.pool.execute("UPDATE cache_server_provision_attempts SET guild_id = $2 WHERE id = $1", attempt_id, str(guild_id))
+        await self.pool.execute("INSERT INTO cache_server_pending (guild_id) VALUES ($1) ON CONFLICT DO NOTHING", str(guild_id))
+        return 1
+
+    async def provisioned(self, guild_id: int):
+        """Called once a pending server has been set up as a cache server"""
+        await self.pool.execute("DELETE FROM cache_server_pending WHERE guild_id = $1", str(guild_id))
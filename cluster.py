@@ -0,0 +1,67 @@
+import asyncpg
+import functools
+import math
+from typing import Awaitable, Callable
+
+def cluster_shards(cluster_id: int, cluster_count: int, shard_count: int) -> list[int]:
+    """Returns the contiguous range of shards owned by a cluster"""
+    per_cluster = math.ceil(shard_count / cluster_count)
+    return list(range(cluster_id * per_cluster, min((cluster_id + 1) * per_cluster, shard_count)))
+
+def guild_shard(guild_id: int, shard_count: int) -> int:
+    """Returns the shard a guild is on, see https://discord.com/developers/docs/topics/gateway#sharding"""
+    return (int(guild_id) >> 22) % shard_count
+
+def shard_cluster(shard_id: int, cluster_count: int, shard_count: int) -> int:
+    """Returns the cluster owning a shard"""
+    return shard_id // math.ceil(shard_count / cluster_count)
+
+def cluster_ipc_socket(ipc_socket: str, cluster_id: int, cluster_count: int) -> str:
+    """Each cluster serves IPC on its own socket"""
+    if cluster_count <= 1:
+        return ipc_socket
+
+    return f"{ipc_socket}.{cluster_id}"
+
+class LeaderLock():
+    """
+    Elects one process out of the fleet to run fleet-wide jobs, using a postgres advisory lock
+
+    The lock is held on a dedicated connection for as long as the process lives, if that
+    connection drops another process takes over on its next check
+    """
+    def __init__(self, dsn: str, key: int):
+        self.dsn = dsn
+        self.key = key
+        self._conn: asyncpg.Connection | None = None
+        self._leader = False
+
+    async def is_leader(self) -> bool:
+        if self._conn is None or self._conn.is_closed():
+            self._leader = False
+
+            try:
+                self._conn = await asyncpg.connect(self.dsn)
+            except (OSError, asyncpg.PostgresError) as exc:
+                print(f"LeaderLock: Failed to connect: {exc}")
+                self._conn = None
+                return False
+
+        if not self._leader:
+            self._leader = await self._conn.fetchval("SELECT pg_try_advisory_lock($1)", self.key)
+
+            if self._leader:
+                print("LeaderLock: This process is now the leader")
+
+        return self._leader
+
+    def only(self, func: Callable[..., Awaitable]):
+        """Decorator making a task body a no-op on every process but the leader"""
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            if not await self.is_leader():
+                return
+
+            return await func(*args, **kwargs)
+
+        return wrapper
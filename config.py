@@ -0,0 +1,164 @@
+from pydantic import BaseModel, Field, ValidationError
+from ruamel.yaml import YAML
+from ruamel.yaml.error import YAMLError
+import asyncio
+import os
+from typing import Callable, Literal
+
+class NeededBots(BaseModel):
+    id: int
+    name: str
+    invite: str
+
+class CacheServerMaker(BaseModel):
+    client_id: int
+    client_secret: str
+    token: str
+
+class Config(BaseModel):
+    token: str
+    postgres_url: str = Field(default="postgresql:///infinity")
+    pinned_servers: list[int] = Field(default=[870950609291972618, 758641373074423808])
+    main_server: int = Field(default=758641373074423808)
+    needed_bots: list[NeededBots] = Field(
+        default=[
+            NeededBots(
+                name = "Borealis",
+                id = 1200677946789212242,
+                invite = "https://discord.com/api/oauth2/authorize?client_id={id}&permissions=8&scope=bot%20applications.commands"
+            ),
+            NeededBots(
+                name = "Arcadia",
+                id = 870728078228324382,
+                invite = "https://discord.com/api/oauth2/authorize?client_id={id}&scope=bot%20applications.commands"
+            ),
+            NeededBots(
+                name = "Popplio",
+                id = 815553000470478850,
+                invite = "https://discord.com/api/oauth2/authorize?client_id={id}&scope=bot%20applications.commands"
+            )
+        ]
+    )
+    notify_webhook: str
+    base_url: str
+    cache_server_maker: CacheServerMaker
+    borealis_client_id: int
+    borealis_client_secret: str
+    oauth_state_backend: Literal["memory", "postgres"] = Field(default="memory") # memory or postgres (needed when running multiple API processes)
+    api_mode: Literal["embedded", "standalone"] = Field(default="embedded") # embedded (same event loop as the bot) or standalone (run api.py seperately)
+    api_workers: int = Field(default=3)
+    ipc_socket: str = Field(default="borealis.sock")
+    member_cache_policy: Literal["targeted", "all"] = Field(default="targeted") # targeted (only chunk cache servers and the main server up front) or all
+    shard_count: int | None = Field(default=None) # must be set when cluster_count > 1
+    cluster_count: int = Field(default=1) # each process picks its cluster with the CLUSTER_ID environment variable
+    db_min_size: int = Field(default=2)
+    db_max_size: int = Field(default=10)
+    db_idle_timeout: float = Field(default=300.0) # seconds before an idle connection is closed
+    db_statement_cache_size: int = Field(default=100)
+    db_hold_warn_seconds: float = Field(default=30.0) # warn about connections held longer than this
+    db_hold_reclaim_seconds: float = Field(default=300.0) # terminate connections held longer than this
+    replica_postgres_url: str | None = Field(default=None) # optional read replica for reports, listings and API reads
+    rebalance_batch_size: int = Field(default=10)
+    rebalance_max_moves: int = Field(default=100) # per run of the background rebalancer
+    provision_min_free: int = Field(default=40) # free bot slots to keep across all cache servers
+    provision_horizon_hours: int = Field(default=48) # also keep enough free slots for the bots expected within this many hours
+    provision_cooldown_minutes: int = Field(default=360)
+    provision_max_pending: int = Field(default=2) # unprovisioned servers waiting to be set up
+    cache_server_missing_minutes: int = Field(default=20) # cache servers the bot has been missing from this long are deleted
+    snapshot_path: str = Field(default="borealis_snapshot.db") # reconciled guild state, saved periodically and on shutdown
+    snapshot_max_age_minutes: int = Field(default=30) # older snapshots are ignored on startup
+
+def load_config(path: str = "config.yaml") -> Config:
+    yaml = YAML(typ="safe")
+    with open(path, "r") as f:
+        return Config(**yaml.load(f))
+
+# Fields only read at startup, changing them in config.yaml needs a restart
+RESTART_ONLY = {
+    "token",
+    "postgres_url",
+    "replica_postgres_url",
+    "cache_server_maker",
+    "oauth_state_backend",
+    "api_mode",
+    "api_workers",
+    "ipc_socket",
+    "snapshot_path",
+    "snapshot_max_age_minutes",
+    "member_cache_policy",
+    "shard_count",
+    "cluster_count",
+    "db_min_size",
+    "db_max_size",
+    "db_idle_timeout",
+    "db_statement_cache_size",
+}
+
+class ConfigIndexes():
+    """Read-only lookups derived from a Config"""
+    def __init__(self, config: Config):
+        self.needed_bot_ids: frozenset[int] = frozenset(b.id for b in config.needed_bots)
+        self.pinned_servers: frozenset[int] = frozenset(config.pinned_servers)
+        # (name, invite url) of each needed bot, with {id} and {perms} filled in
+        self.needed_bot_invites: tuple[tuple[str, str], ...] = tuple(
+            (b.name, b.invite.replace("{id}", str(b.id)).replace("{perms}", "8")) for b in config.needed_bots
+        )
+
+class ConfigService():
+    """
+    Holds the current Config and its indexes, reloading config.yaml when it changes
+
+    A reload that fails to parse or validate keeps the current config. Listeners are called with
+    (old, new) after every successful reload, changes to RESTART_ONLY fields are only warned about
+    """
+    def __init__(self, path: str = "config.yaml"):
+        self.path = path
+        self._mtime = os.stat(path).st_mtime
+        self.config = load_config(path)
+        self.indexes = ConfigIndexes(self.config)
+        self.listeners: list[Callable[[Config, Config], None]] = []
+
+    def listen(self, func: Callable[[Config, Config], None]):
+        self.listeners.append(func)
+
+    def reload(self) -> bool:
+        """Reloads the config if config.yaml changed, returning whether it was reloaded"""
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError as exc:
+            print(f"ConfigService: Cannot stat {self.path}: {exc}")
+            return False
+
+        if mtime == self._mtime:
+            return False
+
+        self._mtime = mtime
+
+        try:
+            new = load_config(self.path)
+        except (OSError, YAMLError, ValidationError, TypeError) as exc:
+            print(f"ConfigService: Not reloading, {self.path} is invalid: {exc}")
+            return False
+
+        old = self.config
+
+        restart_only = [f for f in RESTART_ONLY if getattr(old, f) != getattr(new, f)]
+        if restart_only:
+            print(f"ConfigService: {', '.join(sorted(restart_only))} changed, this only takes effect after a restart")
+
+        self.config = new
+        self.indexes = ConfigIndexes(new)
+
+        for listener in self.listeners:
+            try:
+                listener(old, new)
+            except Exception as exc:
+                print(f"ConfigService: Listener {listener.__name__} failed: {exc}")
+
+        print(f"ConfigService: Reloaded {self.path}")
+        return True
+
+    async def watch(self, interval: float = 5):
+        while True:
+            await asyncio.sleep(interval)
+            self.reload()
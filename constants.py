@@ -1,3 +1,11 @@
 import discord
 
+MAX_PER_CACHE_SERVER = 40
+
+# Advisory lock key used to elect the process running fleet-wide jobs
+LEADER_LOCK_KEY = 0x426f7265
+
+# Taken by everything placing or moving bots, so concurrent placements cannot overfill a server
+PLACEMENT_LOCK = "LOCK TABLE cache_server_bots IN SHARE ROW EXCLUSIVE MODE"
+
 BOTS_ROLE_PERMS = permissions=discord.Permissions(view_audit_log=True, create_expressions=True, manage_expressions=True, external_emojis=True, external_stickers=True)
\ No newline at end of file
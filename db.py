@@ -0,0 +1,229 @@
+import asyncpg
+import asyncio
+import collections
+import contextlib
+import os
+import sys
+import time
+from typing import AsyncIterator
+import queries
+
+# Errors meaning the replica itself is unavailable, as opposed to the query being wrong
+REPLICA_ERRORS = (
+    OSError,
+    asyncio.TimeoutError,
+    asyncpg.exceptions.PostgresConnectionError,
+    asyncpg.exceptions.ConnectionDoesNotExistError,
+    asyncpg.exceptions.CannotConnectNowError,
+    asyncpg.exceptions.TooManyConnectionsError,
+    asyncpg.exceptions.InterfaceError,
+)
+
+class ReadPool():
+    """
+    Pool for read-only queries that can tolerate replication lag (reports, listings, read endpoints)
+
+    Queries go to the replica when one is configured. If the replica is unavailable they fall back to
+    the primary, and the replica is not tried again for retry_after seconds
+    """
+    def __init__(self, primary: asyncpg.Pool, replica: asyncpg.Pool | None = None, retry_after: float = 30):
+        self.primary = primary
+        self.replica = replica
+        self.retry_after = retry_after
+        self._replica_down_until = 0.0
+
+    @property
+    def using_replica(self) -> bool:
+        return self.replica is not None and time.monotonic() >= self._replica_down_until
+
+    def _replica_failed(self, exc: BaseException):
+        print(f"ReadPool: Replica unavailable, using the primary for {self.retry_after}s: {exc!r}")
+        self._replica_down_until = time.monotonic() + self.retry_after
+
+    async def _run(self, method: str, query: str, *args):
+        if self.using_replica:
+            try:
+                return await getattr(self.replica, method)(query, *args)
+            except REPLICA_ERRORS as exc:
+                self._replica_failed(exc)
+
+        return await getattr(self.primary, method)(query, *args)
+
+    async def fetch(self, query: str, *args) -> list[asyncpg.Record]:
+        return await self._run("fetch", query, *args)
+
+    async def fetchrow(self, query: str, *args) -> asyncpg.Record | None:
+        return await self._run("fetchrow", query, *args)
+
+    async def fetchval(self, query: str, *args):
+        return await self._run("fetchval", query, *args)
+
+    @contextlib.asynccontextmanager
+    async def acquire(self) -> AsyncIterator[asyncpg.Connection]:
+        """Acquires a replica connection (or a primary one if the replica is unavailable), so queries helpers work on a ReadPool too"""
+        if self.using_replica:
+            try:
+                conn = await self.replica.acquire()
+            except REPLICA_ERRORS as exc:
+                self._replica_failed(exc)
+            else:
+                try:
+                    yield conn
+                finally:
+                    await self.replica.release(conn)
+                return
+
+        async with self.primary.acquire() as conn:
+            yield conn
+
+async def create_read_pool(primary: asyncpg.Pool, replica_dsn: str | None) -> ReadPool:
+    """Creates a ReadPool, starting without a replica if it cannot be reached"""
+    if not replica_dsn:
+        return ReadPool(primary)
+
+    try:
+        replica = await queries.create_pool(replica_dsn)
+    except REPLICA_ERRORS as exc:
+        print(f"create_read_pool: Failed to connect to the replica, all reads will use the primary: {exc!r}")
+        return ReadPool(primary)
+
+    return ReadPool(primary, replica)
+
+class Hold():
+    """A connection currently acquired from a ManagedPool"""
+    def __init__(self, conn: asyncpg.Connection, holder: str):
+        self.conn = conn
+        self.holder = holder
+        self.since = time.monotonic()
+        self.warned = False
+
+    @property
+    def held_for(self) -> float:
+        return time.monotonic() - self.since
+
+def _caller() -> str:
+    """The first function outside of the database modules on the stack, used to name who holds a connection"""
+    skip = {__file__, queries.__file__, contextlib.__file__}
+    frame = sys._getframe(1)
+
+    while frame and frame.f_code.co_filename in skip:
+        frame = frame.f_back
+
+    if not frame:
+        return "unknown"
+
+    return f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})"
+
+class ManagedPool():
+    """
+    asyncpg pool wrapper that tracks who holds each connection, for how long and how long callers waited for one
+
+    Every query method acquires through acquire, so all use of the pool is tracked. watch warns about
+    connections held longer than warn_after and terminates those held longer than reclaim_after, which
+    returns them to the pool (the holder gets an error on its next use of the connection)
+    """
+    def __init__(self, pool: asyncpg.Pool, warn_after: float = 30, reclaim_after: float = 300, slow_wait: float = 1):
+        self.pool = pool
+        self.warn_after = warn_after
+        self.reclaim_after = reclaim_after
+        self.slow_wait = slow_wait
+        self.holds: dict[int, Hold] = {}
+        self.waits: collections.deque[float] = collections.deque(maxlen=1000)
+        self.total_acquires = 0
+        self.reclaimed = 0
+
+    @contextlib.asynccontextmanager
+    async def acquire(self, holder: str | None = None) -> AsyncIterator[asyncpg.Connection]:
+        holder = holder or _caller()
+
+        start = time.monotonic()
+        conn = await self.pool.acquire()
+        waited = time.monotonic() - start
+
+        self.waits.append(waited)
+        self.total_acquires += 1
+
+        if waited >= self.slow_wait:
+            print(f"ManagedPool: {holder} waited {waited:.2f}s for a connection, longest holders: {self.longest_holds(3)}")
+
+        self.holds[id(conn)] = Hold(conn, holder)
+        try:
+            yield conn
+        finally:
+            self.holds.pop(id(conn), None)
+            await self.pool.release(conn)
+
+    async def _run(self, method: str, *args, **kwargs):
+        async with self.acquire() as conn:
+            return await getattr(conn, method)(*args, **kwargs)
+
+    async def fetch(self, query: str, *args, **kwargs) -> list[asyncpg.Record]:
+        return await self._run("fetch", query, *args, **kwargs)
+
+    async def fetchrow(self, query: str, *args, **kwargs) -> asyncpg.Record | None:
+        return await self._run("fetchrow", query, *args, **kwargs)
+
+    async def fetchval(self, query: str, *args, **kwargs):
+        return await self._run("fetchval", query, *args, **kwargs)
+
+    async def execute(self, query: str, *args, **kwargs) -> str:
+        return await self._run("execute", query, *args, **kwargs)
+
+    async def executemany(self, query: str, args, **kwargs):
+        return await self._run("executemany", query, args, **kwargs)
+
+    async def copy_records_to_table(self, table_name: str, **kwargs) -> str:
+        return await self._run("copy_records_to_table", table_name, **kwargs)
+
+    def longest_holds(self, n: int = 5) -> list[str]:
+        return [f"{h.holder}={h.held_for:.1f}s" for h in sorted(self.holds.values(), key=lambda h: h.since)[:n]]
+
+    def check_holds(self):
+        """Warns about and reclaims connections held too long"""
+        for hold in list(self.holds.values()):
+            held_for = hold.held_for
+
+            if held_for >= self.reclaim_after:
+                print(f"ManagedPool: Reclaiming connection held by {hold.holder} for {held_for:.0f}s")
+                self.holds.pop(id(hold.conn), None)
+                hold.conn.terminate()
+                self.reclaimed += 1
+            elif held_for >= self.warn_after and not hold.warned:
+                print(f"ManagedPool: Connection held by {hold.holder} for {held_for:.0f}s")
+                hold.warned = True
+
+    async def watch(self, interval: float = 10):
+        while True:
+            await asyncio.sleep(interval)
+            self.check_holds()
+
+    def stats(self) -> dict:
+        waits = sorted(self.waits)
+
+        return {
+            "size": self.pool.get_size(),
+            "idle": self.pool.get_idle_size(),
+            "min_size": self.pool.get_min_size(),
+            "max_size": self.pool.get_max_size(),
+            "held": len(self.holds),
+            "acquires": self.total_acquires,
+            "reclaimed": self.reclaimed,
+            "wait_p50_ms": waits[len(waits) // 2] * 1000 if waits else 0,
+            "wait_p99_ms": waits[min(len(waits) - 1, int(len(waits) * 0.99))] * 1000 if waits else 0,
+            "wait_max_ms": waits[-1] * 1000 if waits else 0,
+        }
+
+    async def close(self):
+        await self.pool.close()
+
+async def create_managed_pool(config) -> ManagedPool:
+    """Creates the primary pool with the db_* settings from config"""
+    pool = await queries.create_pool(
+        config.postgres_url,
+        min_size=config.db_min_size,
+        max_size=config.db_max_size,
+        max_inactive_connection_lifetime=config.db_idle_timeout,
+        statement_cache_size=config.db_statement_cache_size
+    )
+
+    return ManagedPool(pool, warn_after=config.db_hold_warn_seconds, reclaim_after=config.db_hold_reclaim_seconds)
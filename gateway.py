@@ -0,0 +1,199 @@
+import discord
+import asyncpg
+import asyncio
+import json
+import os
+from abc import ABC, abstractmethod
+from typing import Awaitable, Callable
+from cluster import guild_shard, shard_cluster, cluster_ipc_socket
+from db import ReadPool
+
+class GatewayError(Exception):
+    """An error from a gateway operation, carrying the HTTP status the API should respond with"""
+    def __init__(self, status: int, detail: str):
+        super().__init__(detail)
+        self.status = status
+        self.detail = detail
+
+class Gateway(ABC):
+    """
+    Everything the API needs from the bots gateway connection
+
+    Reads are answered from gateway state, mutations are performed by the bot
+    """
+    @abstractmethod
+    async def guilds(self, guild_ids: list[int]) -> set[int]:
+        """Returns which of the given guilds the bot is in"""
+
+    @abstractmethod
+    async def members(self, pairs: list[tuple[int, int]]) -> set[tuple[int, int]]:
+        """Returns which of the given (guild_id, user_id) pairs are members of the guild"""
+
+    @abstractmethod
+    async def handle_bot(self, bot_id: int):
+        """Runs handle_member for a bot on its cache server"""
+
+class LocalGateway(Gateway):
+    """Gateway used when the API runs on the same event loop as the bot"""
+    def __init__(self, bot: discord.Client, handle_bot: Callable[[int], Awaitable[None]]):
+        self.bot = bot
+        self._handle_bot = handle_bot
+
+    async def guilds(self, guild_ids: list[int]):
+        return {guild_id for guild_id in guild_ids if self.bot.get_guild(guild_id)}
+
+    async def members(self, pairs: list[tuple[int, int]]):
+        found = set()
+        for guild_id, user_id in pairs:
+            guild = self.bot.get_guild(guild_id)
+
+            if guild and guild.get_member(user_id):
+                found.add((guild_id, user_id))
+
+        return found
+
+    async def handle_bot(self, bot_id: int):
+        await self._handle_bot(bot_id)
+
+class RemoteGateway(Gateway):
+    """
+    Gateway used by standalone API workers
+
+    Reads come from the read model published by GatewayPublisher (through a ReadPool when given one),
+    mutations are sent to the bot over IPC. When clustered, mutations are sent to the cluster owning the guild
+    """
+    def __init__(self, pool: asyncpg.Pool | ReadPool, ipc_socket: str, cluster_count: int = 1, shard_count: int | None = None):
+        self.pool = pool
+        self.ipc_socket = ipc_socket
+        self.cluster_count = cluster_count
+        self.shard_count = shard_count
+
+    async def _socket_for_bot(self, bot_id: int) -> str:
+        if self.cluster_count <= 1:
+            return self.ipc_socket
+
+        guild_id = await self.pool.fetchval("SELECT guild_id FROM cache_server_bots WHERE bot_id = $1", str(bot_id))
+
+        if guild_id is None:
+            raise GatewayError(404, "Bot not found in any cache server")
+
+        cluster_id = shard_cluster(guild_shard(guild_id, self.shard_count), self.cluster_count, self.shard_count)
+        return cluster_ipc_socket(self.ipc_socket, cluster_id, self.cluster_count)
+
+    async def guilds(self, guild_ids: list[int]):
+        rows = await self.pool.fetch("SELECT guild_id FROM cache_server_gateway_guilds WHERE guild_id = ANY($1)", [str(g) for g in guild_ids])
+        return {int(r["guild_id"]) for r in rows}
+
+    async def members(self, pairs: list[tuple[int, int]]):
+        rows = await self.pool.fetch(
+            "SELECT guild_id, user_id FROM cache_server_gateway_members WHERE (guild_id, user_id) IN (SELECT * FROM unnest($1::text[], $2::text[]))",
+            [str(g) for g, _ in pairs],
+            [str(u) for _, u in pairs]
+        )
+        return {(int(r["guild_id"]), int(r["user_id"])) for r in rows}
+
+    async def handle_bot(self, bot_id: int):
+        await ipc_call(await self._socket_for_bot(bot_id), "handle_bot", bot_id=bot_id)
+
+class GatewayPublisher():
+    """
+    Publishes the bots gateway state (guilds and the bots in them) to postgres for standalone API workers
+
+    Only the changes since the last publish are written. When clustered (shard_ids set), each
+    process only ever touches the rows of guilds on its own shards
+    """
+    def __init__(self, bot: discord.Client, pool: asyncpg.Pool, shard_ids: list[int] | None = None, shard_count: int | None = None):
+        self.bot = bot
+        self.pool = pool
+        self.shard_ids = shard_ids
+        self.shard_count = shard_count
+        self._guilds: dict[str, tuple[str, int]] | None = None
+        self._members: set[tuple[str, str]] = set()
+
+    async def publish(self):
+        guilds = {str(g.id): (g.name, g.member_count or 0) for g in self.bot.guilds}
+        members = {(str(g.id), str(m.id)) for g in self.bot.guilds for m in g.members if m.bot}
+
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                if self._guilds is None:
+                    # First publish, replace whatever an earlier run left behind
+                    if self.shard_ids is None:
+                        await conn.execute("DELETE FROM cache_server_gateway_guilds")
+                    else:
+                        await conn.execute("DELETE FROM cache_server_gateway_guilds WHERE ((guild_id::bigint >> 22) % $1) = ANY($2)", self.shard_count, self.shard_ids)
+                    await conn.copy_records_to_table("cache_server_gateway_guilds", records=[(g, name, count) for g, (name, count) in guilds.items()], columns=["guild_id", "name", "member_count"])
+                    await conn.copy_records_to_table("cache_server_gateway_members", records=list(members), columns=["guild_id", "user_id"])
+                else:
+                    removed_guilds = [g for g in self._guilds if g not in guilds]
+                    changed_guilds = [(g, name, count) for g, (name, count) in guilds.items() if self._guilds.get(g) != (name, count)]
+
+                    if removed_guilds:
+                        await conn.execute("DELETE FROM cache_server_gateway_guilds WHERE guild_id = ANY($1)", removed_guilds)
+                    if changed_guilds:
+                        await conn.executemany("INSERT INTO cache_server_gateway_guilds (guild_id, name, member_count) VALUES ($1, $2, $3) ON CONFLICT (guild_id) DO UPDATE SET name = $2, member_count = $3, updated_at = NOW()", changed_guilds)
+
+                    removed_members = [m for m in self._members - members if m[0] in guilds]
+                    added_members = list(members - self._members)
+
+                    if removed_members:
+                        await conn.executemany("DELETE FROM cache_server_gateway_members WHERE guild_id = $1 AND user_id = $2", removed_members)
+                    if added_members:
+                        await conn.executemany("INSERT INTO cache_server_gateway_members (guild_id, user_id) VALUES ($1, $2) ON CONFLICT DO NOTHING", added_members)
+
+        self._guilds = guilds
+        self._members = members
+
+async def serve_ipc(path: str, handlers: dict[str, Callable[..., Awaitable]]):
+    """
+    Serves handlers over a local unix socket
+
+    Each connection sends one JSON request ({"op": ..., "args": {...}}) on a single line and gets one JSON response back
+    """
+    async def on_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            req = json.loads(await reader.readline())
+            handler = handlers.get(req.get("op"))
+
+            if not handler:
+                resp = {"ok": False, "status": 400, "detail": f"Unknown op {req.get('op')}"}
+            else:
+                try:
+                    resp = {"ok": True, "result": await handler(**req.get("args", {}))}
+                except GatewayError as exc:
+                    resp = {"ok": False, "status": exc.status, "detail": exc.detail}
+                except Exception as exc:
+                    print(f"serve_ipc: {req.get('op')} failed: {exc}")
+                    resp = {"ok": False, "status": 500, "detail": str(exc)}
+
+            writer.write(json.dumps(resp).encode() + b"\n")
+            await writer.drain()
+        finally:
+            writer.close()
+
+    if os.path.exists(path):
+        os.remove(path)
+
+    server = await asyncio.start_unix_server(on_connection, path=path)
+
+    async with server:
+        await server.serve_forever()
+
+async def ipc_call(path: str, op: str, **args):
+    """Calls an op served by serve_ipc, raising GatewayError on failure"""
+    try:
+        reader, writer = await asyncio.open_unix_connection(path)
+    except OSError as exc:
+        raise GatewayError(503, f"Bot is not reachable: {exc}")
+
+    try:
+        writer.write(json.dumps({"op": op, "args": args}).encode() + b"\n")
+        await writer.drain()
+        resp = json.loads(await reader.readline())
+    finally:
+        writer.close()
+
+    if not resp["ok"]:
+        raise GatewayError(resp["status"], resp["detail"])
+
+    return resp.get("result")
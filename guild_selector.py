@@ -0,0 +1,210 @@
+import discord
+import bisect
+import datetime
+import re
+
+class SelectorError(ValueError):
+    pass
+
+class GuildIndex():
+    """Indexes guilds by exact name (and name prefix), rebuilt lazily after guilds change"""
+    def __init__(self):
+        self._by_name: dict[str, list[int]] = {}
+        self._names: list[str] = []
+        self._dirty = True
+
+    def invalidate(self):
+        self._dirty = True
+
+    def ensure(self, guilds: list[discord.Guild]):
+        if not self._dirty:
+            return
+
+        self._by_name = {}
+        for g in guilds:
+            self._by_name.setdefault(g.name, []).append(g.id)
+
+        self._names = sorted(self._by_name.keys())
+        self._dirty = False
+
+    def by_name(self, name: str) -> list[int]:
+        return self._by_name.get(name, [])
+
+    def by_prefix(self, prefix: str) -> list[int]:
+        ids = []
+
+        i = bisect.bisect_left(self._names, prefix)
+        while i < len(self._names) and self._names[i].startswith(prefix):
+            ids.extend(self._by_name[self._names[i]])
+            i += 1
+
+        return ids
+
+def split_expression(expr: str) -> list[list[tuple[str, bool]]]:
+    """
+    Splits an expression into groups (on ,) of terms (on &), as (term, quoted) pairs
+
+    Text in double quotes is taken as is, so names containing , or & can be selected
+    """
+    groups: list[list[tuple[str, bool]]] = [[]]
+    term = ""
+    quoted = False
+    in_quotes = False
+
+    def end_term():
+        nonlocal term, quoted
+        if quoted:
+            groups[-1].append((term, True))
+        elif term.strip():
+            groups[-1].append((term.strip(), False))
+        term = ""
+        quoted = False
+
+    for c in expr:
+        if c == '"':
+            if not in_quotes and not quoted:
+                if term.strip():
+                    raise SelectorError(f"Unexpected quote after {term.strip()!r}")
+                term = ""
+
+            in_quotes = not in_quotes
+            quoted = True
+        elif in_quotes:
+            term += c
+        elif c in ",&":
+            end_term()
+            if c == ",":
+                groups.append([])
+        elif quoted and not c.isspace():
+            raise SelectorError(f"Unexpected {c!r} after a quoted name")
+        elif quoted:
+            continue
+        else:
+            term += c
+
+    if in_quotes:
+        raise SelectorError("Unterminated quote")
+
+    end_term()
+    return [g for g in groups if g]
+
+_COMPARISON = re.compile(r"^(fill|age)(<=|>=|<|>|=)(\d+)(%|d|h)?$")
+_OPS = {
+    "<": lambda a, b: a < b,
+    ">": lambda a, b: a > b,
+    "<=": lambda a, b: a <= b,
+    ">=": lambda a, b: a >= b,
+    "=": lambda a, b: a == b,
+}
+
+class GuildSelector():
+    """
+    Resolves guild selector expressions
+
+    An expression is a comma seperated list of groups, a guild is selected if it matches any group.
+    A group is a list of terms joined with &, all of which must match. Terms are:
+
+    - all: every guild (except pinned servers)
+    - cs: every cache server
+    - <id>, <name> or <name prefix>* (names are matched exactly, quote them as "<name>" if they contain , or &)
+    - fill<op><n>[%]: cache servers with <op> n bots placed (or n% of MAX_PER_CACHE_SERVER), op is one of < > <= >= =
+    - age<op><n>[d|h]: cache servers created <op> n days (default) or hours ago
+    - missing:roles or missing:channels: cache servers where a configured role/channel no longer exists
+
+    For example ``cs&fill<50%&age>30d, IBLCS-1234`` selects old, half empty cache servers plus one server by name
+    """
+    def __init__(self, bot, max_per_cache_server: int):
+        self.bot = bot
+        self.max_per_cache_server = max_per_cache_server
+        self.index = GuildIndex()
+
+    async def resolve(self, expr: str) -> list[discord.Guild]:
+        self.index.ensure(self.bot.guilds)
+
+        fill: dict[int, int] | None = None
+        if "fill" in expr:
+            rows = await self.bot.pool.fetch("SELECT guild_id, COUNT(*) from cache_server_bots GROUP BY guild_id")
+            fill = {int(r["guild_id"]): r["count"] for r in rows}
+
+        selected: dict[int, None] = {} # Keeps order, unlike a set
+        for terms in split_expression(expr):
+            ids = self._resolve_term(terms[0], fill)
+            for term in terms[1:]:
+                ids &= self._resolve_term(term, fill, within=ids)
+
+            for guild_id in ids:
+                selected[guild_id] = None
+
+        guilds = [self.bot.get_guild(g) for g in selected]
+        return [g for g in guilds if g]
+
+    def _resolve_term(self, term: tuple[str, bool], fill: dict[int, int] | None, within: set[int] | None = None) -> set[int]:
+        """Resolves one (term, quoted) pair. When ``within`` is given, filter terms only need to look at those guilds"""
+        term, quoted = term
+
+        if quoted:
+            return set(self.index.by_name(term))
+
+        lowered = term.lower()
+
+        if lowered == "all":
+            return {g.id for g in self.bot.guilds if g.id not in self.bot.indexes.pinned_servers}
+
+        if lowered == "cs":
+            return {g for g in self.bot.cache_servers if self.bot.get_guild(g)}
+
+        if term.isdigit():
+            return {int(term)} if self.bot.get_guild(int(term)) else set()
+
+        if term.endswith("*"):
+            return set(self.index.by_prefix(term[:-1]))
+
+        candidates = within if within is not None else set(self.bot.cache_servers)
+
+        if lowered.startswith("missing:"):
+            what = lowered.split(":", 1)[1]
+
+            if what not in ("roles", "channels"):
+                raise SelectorError(f"Unknown missing:{what}, expected missing:roles or missing:channels")
+
+            return {g for g in candidates if self._is_missing(g, what)}
+
+        m = _COMPARISON.match(lowered)
+        if m:
+            field, op, n, unit = m.groups()
+            n = int(n)
+
+            if field == "fill":
+                if unit not in (None, "%"):
+                    raise SelectorError(f"Invalid unit {unit} for fill")
+
+                if unit == "%":
+                    n = self.max_per_cache_server * n / 100
+
+                return {g for g in candidates if g in self.bot.cache_servers and _OPS[op]((fill or {}).get(g, 0), n)}
+
+            if unit == "%":
+                raise SelectorError("Invalid unit % for age")
+
+            limit = datetime.timedelta(hours=n) if unit == "h" else datetime.timedelta(days=n)
+            now = datetime.datetime.now(tz=datetime.timezone.utc)
+            return {
+                g for g in candidates
+                if g in self.bot.cache_servers and _OPS[op](now - self.bot.cache_servers[g]["created_at"], limit)
+            }
+
+        return set(self.index.by_name(term))
+
+    def _is_missing(self, guild_id: int, what: str) -> bool:
+        guild = self.bot.get_guild(guild_id)
+        info = self.bot.cache_servers.get(guild_id)
+
+        if not guild or not info:
+            return False
+
+        if what == "roles":
+            keys, get = ("bots_role", "system_bots_role", "staff_role", "web_moderator_role"), guild.get_role
+        else:
+            keys, get = ("logs_channel", "welcome_channel"), guild.get_channel
+
+        return any(not info.get(k) or not get(int(info[k])) for k in keys)
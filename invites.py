@@ -0,0 +1,42 @@
+import discord
+
+class InviteTracker():
+    """
+    Keeps the invites of each cache server in memory, updated from invite create/delete events
+
+    Guilds are seeded by the (rare) full poll in ensure_invites, until then has_invite returns None
+    """
+    def __init__(self):
+        self._invites: dict[int, set[str]] = {}
+
+    def seed(self, guild_id: int, invites: list[discord.Invite]):
+        self._invites[guild_id] = {invite.code for invite in invites}
+
+    def add(self, guild_id: int, code: str):
+        if guild_id in self._invites:
+            self._invites[guild_id].add(code)
+
+    def remove(self, guild_id: int, code: str):
+        if guild_id in self._invites:
+            self._invites[guild_id].discard(code)
+
+    def forget(self, guild_id: int):
+        self._invites.pop(guild_id, None)
+
+    def has_invite(self, guild_id: int, code: str) -> bool | None:
+        """Whether a guild has an invite, or None if the guilds invites are not being tracked yet"""
+        if guild_id not in self._invites:
+            return None
+
+        return code in self._invites[guild_id]
+
+def is_unlimited(invite: discord.Invite) -> bool:
+    """
+    Whether an invite never expires
+
+    Invites from gateway events have max_age but no expires_at, invites from REST have both
+    """
+    if invite.max_age is not None:
+        return invite.max_age == 0
+
+    return not invite.expires_at
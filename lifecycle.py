@@ -0,0 +1,87 @@
+import asyncpg
+import datetime
+from typing import Iterable
+
+class GuildLifecycle():
+    """
+    Tracks which cache servers the bot is missing from, driven by guild join/remove/available events
+
+    When each guild went missing lives in the cache_server_missing table so it survives restarts, and
+    only guilds whose state changed are ever written
+    """
+    def __init__(self, pool: asyncpg.Pool):
+        self.pool = pool
+        self.present: set[int] = set()
+        self.cache_servers: set[int] = set()
+        self.missing: dict[int, datetime.datetime] = {} # guild_id -> first noticed missing
+        self._persisted: set[int] = set() # Missing guilds already in cache_server_missing
+
+    def _now(self) -> datetime.datetime:
+        return datetime.datetime.now(tz=datetime.timezone.utc)
+
+    async def load(self, cache_servers: Iterable[int], present: Iterable[int]):
+        """Seeds the tracker, present should be every guild the bot is in"""
+        self.present = set(present)
+        self.cache_servers = set(cache_servers)
+
+        rows = await self.pool.fetch("SELECT guild_id, first_missing_at from cache_server_missing")
+        since = {int(r["guild_id"]): r["first_missing_at"] for r in rows}
+
+        now = self._now()
+        self.missing = {g: since.get(g, now) for g in self.cache_servers - self.present}
+        self._persisted = {g for g in self.missing if g in since}
+
+        # Guilds we have come back to since the last run
+        returned = [str(g) for g in since if g not in self.missing]
+        if returned:
+            await self.pool.execute("DELETE FROM cache_server_missing WHERE guild_id = ANY($1)", returned)
+
+    async def joined(self, guild_id: int):
+        self.present.add(guild_id)
+
+        if self.missing.pop(guild_id, None) is not None and guild_id in self._persisted:
+            self._persisted.discard(guild_id)
+            await self.pool.execute("DELETE FROM cache_server_missing WHERE guild_id = $1", str(guild_id))
+
+    def left(self, guild_id: int):
+        self.present.discard(guild_id)
+
+        if guild_id in self.cache_servers:
+            self.missing.setdefault(guild_id, self._now())
+
+    def update_cache_servers(self, cache_servers: Iterable[int]):
+        """Called when the set of known cache servers may have changed"""
+        cache_servers = set(cache_servers)
+
+        for guild_id in cache_servers - self.cache_servers:
+            if guild_id not in self.present:
+                self.missing.setdefault(guild_id, self._now())
+
+        for guild_id in self.cache_servers - cache_servers:
+            self.missing.pop(guild_id, None)
+
+        self.cache_servers = cache_servers
+
+    async def check(self, grace: datetime.timedelta) -> tuple[list[int], list[int]]:
+        """
+        Records newly missing cache servers, returning (newly missing, missing for longer than grace)
+
+        Only the time a guild went missing counts, not how often this is called
+        """
+        new = [g for g in self.missing if g not in self._persisted]
+
+        if new:
+            await self.pool.executemany(
+                "INSERT INTO cache_server_missing (guild_id, first_missing_at) VALUES ($1, $2) ON CONFLICT (guild_id) DO NOTHING",
+                [(str(g), self.missing[g]) for g in new]
+            )
+            self._persisted.update(new)
+
+        now = self._now()
+        return new, [g for g, since in self.missing.items() if now - since > grace]
+
+    def forget(self, guild_id: int):
+        """Stops tracking a cache server that has been deleted"""
+        self.cache_servers.discard(guild_id)
+        self.missing.pop(guild_id, None)
+        self._persisted.discard(guild_id)
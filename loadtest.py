@@ -0,0 +1,283 @@
+"""
+Load tests the API endpoints the main site calls, with api.app served in-process against a seeded scratch database
+
+The bot is replaced by StubGateway (every seeded cache server exists, handle_bot only sleeps), so only the API and
+database are measured. Everything is seeded into its own schema, which is dropped and recreated on every run.
+
+Usage: python loadtest.py --dsn postgresql:///borealis_loadtest [--concurrency 50] [--requests 2000] [--endpoints ...]
+(or set LOADTEST_POSTGRES_URL). Never point this at a production database
+"""
+import argparse
+import asyncio
+import contextlib
+import datetime
+import io
+import os
+import random
+import time
+import aiohttp
+import asyncpg
+import uvicorn
+import api
+import queries
+from bench_queries import percentile
+from config import Config
+from constants import MAX_PER_CACHE_SERVER
+from db import ManagedPool, ReadPool
+from gateway import Gateway
+from placements import PlacementCache
+
+SCHEMA = "borealis_loadtest"
+
+# Tables used by the load tested endpoints, mirroring schema.sql, plus stand-ins for the main sites tables that
+# queries.QUERIES refers to (every connection prepares all of them)
+TABLES = [
+    "CREATE TABLE bots (bot_id text PRIMARY KEY, type text NOT NULL, premium boolean NOT NULL DEFAULT false)",
+    "CREATE TABLE bot_whitelist (bot_id text PRIMARY KEY)",
+    "CREATE TABLE partners (bot_id text PRIMARY KEY)",
+    "CREATE TABLE staff_positions (id uuid PRIMARY KEY, index integer NOT NULL, perms text[] NOT NULL)",
+    "CREATE TABLE staff_members (user_id text PRIMARY KEY, positions uuid[] NOT NULL, perm_overrides text[] NOT NULL)",
+    """CREATE TABLE cache_servers (
+        guild_id text PRIMARY KEY,
+        name text NOT NULL,
+        bots_role text NOT NULL,
+        system_bots_role text NOT NULL,
+        web_moderator_role text NOT NULL,
+        welcome_channel text NOT NULL,
+        invite_code text NOT NULL,
+        logs_channel text NOT NULL,
+        staff_role text NOT NULL,
+        created_at timestamptz NOT NULL DEFAULT now()
+    )""",
+    """CREATE TABLE cache_server_bots (
+        guild_id text NOT NULL REFERENCES cache_servers(guild_id) ON UPDATE CASCADE ON DELETE CASCADE,
+        bot_id text NOT NULL UNIQUE REFERENCES bots(bot_id) ON UPDATE CASCADE ON DELETE CASCADE,
+        created_at timestamptz NOT NULL DEFAULT now(),
+        moved_at timestamptz,
+        added integer NOT NULL DEFAULT 0
+    )""",
+]
+
+class StubGateway(Gateway):
+    """Stands in for the bot: every seeded cache server exists and member_ratio of placed bots have joined"""
+    def __init__(self, guild_ids: set[int], handle_latency: float, member_ratio: float = 0.8):
+        self.guild_ids = guild_ids
+        self.handle_latency = handle_latency
+        self.member_ratio = member_ratio
+
+    async def guilds(self, guild_ids: list[int]):
+        return {guild_id for guild_id in guild_ids if guild_id in self.guild_ids}
+
+    async def members(self, pairs: list[tuple[int, int]]):
+        # Stable per bot, so repeated requests for a bot agree
+        return {(guild_id, user_id) for guild_id, user_id in pairs if guild_id in self.guild_ids and user_id % 100 < self.member_ratio * 100}
+
+    async def handle_bot(self, bot_id: int):
+        await asyncio.sleep(self.handle_latency)
+
+class Seed():
+    """IDs seeded into the scratch database"""
+    def __init__(self, guild_ids: list[str], placed: list[str], unplaced: list[str]):
+        self.guild_ids = guild_ids
+        self.placed = placed # Approved bots already in a cache server
+        self.unplaced = unplaced # Approved bots in no cache server, each is added at most once
+
+async def seed(dsn: str, servers: int, placed: int, unplaced: int) -> Seed:
+    """Recreates the schema and seeds it, before any pool connection tries to prepare statements against it"""
+    conn = await asyncpg.connect(dsn, server_settings={"search_path": SCHEMA})
+
+    try:
+        await conn.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+        await conn.execute(f"CREATE SCHEMA {SCHEMA}")
+
+        for table in TABLES:
+            await conn.execute(table)
+
+        return await _seed_rows(conn, servers, placed, unplaced)
+    finally:
+        await conn.close()
+
+async def _seed_rows(conn: asyncpg.Connection, servers: int, placed: int, unplaced: int) -> Seed:
+    guild_ids = [str(10**17 + i) for i in range(servers)]
+    placed_ids = [str(2 * 10**17 + i) for i in range(placed)]
+    unplaced_ids = [str(3 * 10**17 + i) for i in range(unplaced)]
+
+    await conn.copy_records_to_table(
+        "cache_servers",
+        records=[(g, f"Borealis Cache Server {i}", g, g, g, g, f"invite{i}", g, g) for i, g in enumerate(guild_ids)],
+        columns=["guild_id", "name", "bots_role", "system_bots_role", "web_moderator_role", "welcome_channel", "invite_code", "logs_channel", "staff_role"]
+    )
+    await conn.copy_records_to_table("bots", records=[(b, "approved") for b in placed_ids + unplaced_ids], columns=["bot_id", "type"])
+
+    # Fill servers evenly, leaving the rest of the capacity for the add endpoints
+    await conn.copy_records_to_table(
+        "cache_server_bots",
+        records=[(guild_ids[i % servers], b) for i, b in enumerate(placed_ids)],
+        columns=["guild_id", "bot_id"]
+    )
+
+    return Seed(guild_ids, placed_ids, unplaced_ids)
+
+class Result():
+    """Latencies and outcomes of one endpoint"""
+    def __init__(self, endpoint: str):
+        self.endpoint = endpoint
+        self.latencies: list[float] = []
+        self.statuses: dict[int, int] = {}
+        self.exceptions = 0
+        self.elapsed = 0.0
+
+    @property
+    def errors(self) -> int:
+        """Requests that failed outright or returned a 5xx, 4xx are expected answers (e.g. bots in no cache server)"""
+        return self.exceptions + sum(n for status, n in self.statuses.items() if status >= 500)
+
+    def report(self) -> str:
+        total = len(self.latencies)
+
+        if not total:
+            return f"{self.endpoint:<28} no requests"
+
+        statuses = ", ".join(f"{status}={n}" for status, n in sorted(self.statuses.items()))
+        return (
+            f"{self.endpoint:<28} {total:>7} {total / self.elapsed:>8.1f} "
+            f"{percentile(self.latencies, 0.5):>8.2f} {percentile(self.latencies, 0.95):>8.2f} {percentile(self.latencies, 0.99):>8.2f} "
+            f"{self.errors / total:>7.2%}  {statuses}{f', exceptions={self.exceptions}' if self.exceptions else ''}"
+        )
+
+def request_factory(endpoint: str, data: Seed, batch_size: int):
+    """Returns a function making the (method, path, params, json) of the next request to an endpoint"""
+    unplaced = iter(data.unplaced)
+    all_bots = data.placed + data.unplaced
+
+    def make():
+        if endpoint == "getCacheServerOfBot":
+            # Mostly placed bots, some in no cache server (404)
+            return "GET", "/getCacheServerOfBot", {"bot_id": random.choice(data.unplaced if random.random() < 0.1 else data.placed)}, None
+        elif endpoint == "getCacheServerOfBots":
+            return "POST", "/getCacheServerOfBots", None, {"bot_ids": random.sample(all_bots, min(batch_size, len(all_bots)))}
+        elif endpoint == "addBotToCacheServer":
+            # Every request places a new bot, so concurrent requests race for the same free slots
+            return "POST", "/addBotToCacheServer", {"bot_id": next(unplaced), "ignore_bot_type": "false"}, None
+        elif endpoint == "handleBotOnAllCacheServers":
+            return "POST", "/handleBotOnAllCacheServers", {"bot_id": random.choice(data.placed)}, None
+
+        raise ValueError(f"Unknown endpoint {endpoint}")
+
+    return make
+
+async def drive(session: aiohttp.ClientSession, base_url: str, endpoint: str, make, requests: int, concurrency: int) -> Result:
+    result = Result(endpoint)
+    remaining = requests
+
+    async def worker():
+        nonlocal remaining
+
+        while remaining > 0:
+            remaining -= 1
+
+            try:
+                method, path, params, json = make()
+            except StopIteration:
+                return # Out of unplaced bots
+
+            start = time.perf_counter()
+            try:
+                async with session.request(method, base_url + path, params=params, json=json) as resp:
+                    await resp.read()
+                    result.statuses[resp.status] = result.statuses.get(resp.status, 0) + 1
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                result.exceptions += 1
+
+            result.latencies.append((time.perf_counter() - start) * 1000)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    result.elapsed = time.perf_counter() - start
+
+    return result
+
+async def overfilled(pool: ManagedPool) -> int:
+    """Cache servers holding more than MAX_PER_CACHE_SERVER bots, which the allocator should never allow"""
+    return await pool.fetchval(
+        "SELECT COUNT(*) FROM (SELECT guild_id FROM cache_server_bots GROUP BY guild_id HAVING COUNT(*) > $1) s",
+        MAX_PER_CACHE_SERVER
+    )
+
+async def main():
+    parser = argparse.ArgumentParser(description="Load tests the Borealis API against a seeded scratch database")
+    parser.add_argument("--dsn", default=os.environ.get("LOADTEST_POSTGRES_URL"), help="scratch database, the schema borealis_loadtest in it is dropped and recreated")
+    parser.add_argument("--endpoints", nargs="+", default=["getCacheServerOfBot", "addBotToCacheServer", "handleBotOnAllCacheServers"])
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--requests", type=int, default=2000, help="per endpoint")
+    parser.add_argument("--servers", type=int, default=100)
+    parser.add_argument("--placed", type=int, default=2000, help="bots already in a cache server")
+    parser.add_argument("--batch-size", type=int, default=100, help="bot ids per getCacheServerOfBots request")
+    parser.add_argument("--handle-latency", type=float, default=5, help="milliseconds the stub bot takes to handle a bot")
+    parser.add_argument("--placement-ttl", type=float, default=30, help="seconds placements stay cached, 0 to always query")
+    parser.add_argument("--pool-size", type=int, default=10)
+    parser.add_argument("--port", type=int, default=28370)
+    parser.add_argument("--keep", action="store_true", help="keep the seeded schema afterwards")
+    args = parser.parse_args()
+
+    if not args.dsn:
+        parser.error("--dsn (or LOADTEST_POSTGRES_URL) is required")
+
+    if args.placed + args.requests > args.servers * MAX_PER_CACHE_SERVER:
+        print(f"WARNING: {args.servers} servers cannot fit {args.placed + args.requests} bots, addBotToCacheServer will run out of space")
+
+    print(f"Seeding {args.servers} cache servers, {args.placed} placed and {args.requests} unplaced bots into {SCHEMA}")
+    data = await seed(args.dsn, args.servers, args.placed, args.requests)
+
+    pool = ManagedPool(
+        await queries.create_pool(args.dsn, min_size=1, max_size=args.pool_size, server_settings={"search_path": SCHEMA})
+    )
+
+    # Everything setup() would make, so the app never tries to reach a bot or config.yaml
+    placement_ttl = datetime.timedelta(seconds=args.placement_ttl)
+    api.config = Config.model_construct()
+    api.pool = pool
+    api.read_pool = ReadPool(pool)
+    api.placements = PlacementCache(pool, ttl=placement_ttl)
+    api.read_placements = api.placements
+    api.gateway = StubGateway({int(g) for g in data.guild_ids}, args.handle_latency / 1000)
+
+    server = uvicorn.Server(uvicorn.Config(api.app, host="127.0.0.1", port=args.port, log_level="warning", access_log=False))
+    serve_task = asyncio.create_task(server.serve())
+
+    while not server.started:
+        await asyncio.sleep(0.05)
+
+    base_url = f"http://127.0.0.1:{args.port}"
+    results = []
+
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=30)) as session:
+        api.session = session
+
+        for endpoint in args.endpoints:
+            print(f"Running {args.requests} requests to {endpoint} with concurrency {args.concurrency}")
+
+            # The endpoints print every requests headers
+            with contextlib.redirect_stdout(io.StringIO()):
+                results.append(await drive(session, base_url, endpoint, request_factory(endpoint, data, args.batch_size), args.requests, args.concurrency))
+
+    print(f"\n{'endpoint':<28} {'requests':>7} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>7}  statuses")
+    for result in results:
+        print(result.report())
+
+    print(f"\nOverfilled cache servers: {await overfilled(pool)}")
+
+    stats = pool.stats()
+    print(f"Pool: acquires={stats['acquires']} wait p50={stats['wait_p50_ms']:.2f}ms p99={stats['wait_p99_ms']:.2f}ms max={stats['wait_max_ms']:.2f}ms")
+
+    server.should_exit = True
+    await serve_task
+
+    if not args.keep:
+        await pool.execute(f"DROP SCHEMA {SCHEMA} CASCADE")
+
+    await pool.close()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,132 +1,306 @@
 import discord
 from discord.ext import commands, tasks
-from pydantic import BaseModel, Field
-from ruamel.yaml import YAML
 import logging
 import asyncpg
 import asyncio
-from perms import get_user_staff_perms
-from kittycat import StaffPermissions, has_perm, Permission
+from perms import get_user_staff_perms, load_staff_positions, resolve, check
+from kittycat import StaffPermissions
 import secrets
+import signal
 import traceback
 import sys
 import os
 import datetime
+import time
 import io
 import importlib
-import uvicorn
 import aiohttp
 from typing import Callable
-from PIL import Image, ImageDraw, ImageFont
-from cfg_autogen import gen_config
-from migrations import MIGRATION_LIST, Migration
-from constants import BOTS_ROLE_PERMS
-
-MAX_PER_CACHE_SERVER = 40
+from constants import BOTS_ROLE_PERMS, MAX_PER_CACHE_SERVER, LEADER_LOCK_KEY
+from config import Config, ConfigIndexes, ConfigService
+from alerts import AlertDigest
+from placements import PlacementCache
+from gateway import GatewayError, GatewayPublisher, LocalGateway, serve_ipc
+from startup import StartupTimer, warm_caches
+from cluster import LeaderLock, cluster_shards, cluster_ipc_socket, guild_shard
+from scheduler import Scheduler, Job
+from invites import InviteTracker, is_unlimited
+from lifecycle import GuildLifecycle
+from guild_selector import GuildSelector
+from rebalancer import Rebalancer, Move, plan_moves
+from capacity import CapacityPlanner
+from audit import ActionLog
+from write_behind import WriteBehind
+import queries
+from paginator import LazyPaginator
+from snapshot import Snapshot
+from db import ManagedPool, ReadPool, create_managed_pool, create_read_pool
+from member_cache import bot_intents, server_maker_intents, should_chunk, ensure_chunked, estimate_guild_memory, process_rss, format_bytes
 
 logging.basicConfig(level=logging.INFO)
 
-class NeededBots(BaseModel):
-    id: int
-    name: str
-    invite: str
-
-class CacheServerMaker(BaseModel):
-    client_id: int
-    client_secret: str
-    token: str
-
-class Config(BaseModel):
-    token: str
-    postgres_url: str = Field(default="postgresql:///infinity")
-    pinned_servers: list[int] = Field(default=[870950609291972618, 758641373074423808])
-    main_server: int = Field(default=758641373074423808)
-    needed_bots: list[NeededBots] = Field(
-        default=[
-            NeededBots(
-                name = "Borealis",
-                id = 1200677946789212242,
-                invite = "https://discord.com/api/oauth2/authorize?client_id={id}&permissions=8&scope=bot%20applications.commands"
-            ),
-            NeededBots(
-                name = "Arcadia",
-                id = 870728078228324382,
-                invite = "https://discord.com/api/oauth2/authorize?client_id={id}&scope=bot%20applications.commands"
-            ),
-            NeededBots(
-                name = "Popplio",
-                id = 815553000470478850,
-                invite = "https://discord.com/api/oauth2/authorize?client_id={id}&scope=bot%20applications.commands"
-            )
-        ]
-    )
-    notify_webhook: str
-    base_url: str
-    cache_server_maker: CacheServerMaker
-    borealis_client_id: int
-    borealis_client_secret: str
+startup_timer = StartupTimer()
 
-gen_config(Config, 'config.yaml.sample')
+if os.environ.get("GEN_CONFIG", "false").lower() == "true":
+    from cfg_autogen import gen_config
+    with startup_timer.phase("gen_config"):
+        gen_config(Config, 'config.yaml.sample')
 
-yaml = YAML(typ="safe")
-with open("config.yaml", "r") as f:
-    config = Config(**yaml.load(f))
+with startup_timer.phase("load_config"):
+    config_service = ConfigService()
 
 with open("guild_logo.png", "rb") as f:
     guild_logo = f.read()
 
 class BorealisBot(commands.AutoShardedBot):
-    pool: asyncpg.pool.Pool
+    pool: ManagedPool
+    read_pool: ReadPool
+    placements: PlacementCache
+    cache_servers: dict[int, dict]
+
+    def __init__(self, config_service: ConfigService, cluster_id: int = 0):
+        config = config_service.config
+        shard_kwargs = {}
+        if config.cluster_count > 1:
+            if not config.shard_count:
+                raise Exception("shard_count must be set when cluster_count > 1")
+
+            shard_kwargs = {
+                "shard_count": config.shard_count,
+                "shard_ids": cluster_shards(cluster_id, config.cluster_count, config.shard_count)
+            }
 
-    def __init__(self, config: Config):
-        super().__init__(command_prefix="#", intents=discord.Intents.all())
-        self.config = config
+        super().__init__(
+            command_prefix="#", 
+            intents=bot_intents(config.member_cache_policy),
+            chunk_guilds_at_startup=config.member_cache_policy == "all",
+            **shard_kwargs
+        )
+        self.config_service = config_service
+        self.config_service.listen(self.config_reloaded)
+        self.cluster_id = cluster_id
+        self.leader = LeaderLock(config.postgres_url, LEADER_LOCK_KEY)
         self.pool = None
+        self.read_pool = None
+        self.placements = None
+        self.lifecycle = None
+        self.rebalancer = None
+        self.capacity = None
+        self.actions = None
+        self.cache_server_writes = None
+        self.publisher = None
+        self.cache_servers = {}
+        self.snapshot = Snapshot(
+            config.snapshot_path if config.cluster_count <= 1 else f"{config.snapshot_path}.{cluster_id}",
+            max_age=datetime.timedelta(minutes=config.snapshot_max_age_minutes)
+        )
+        self.warm_task: asyncio.Task | None = None
         self.session = aiohttp.ClientSession()
 
     async def run(self):
-        self.pool = await asyncpg.pool.create_pool(self.config.postgres_url)
-        api = importlib.import_module("api")
-        api.bot = bot
-        api.config = config
-        server = uvicorn.Server(config=uvicorn.Config(api.app, workers=3, loop=loop, port=2837))
-        asyncio.create_task(server.serve())
-        await super().start(self.config.token)
-        await cache_server_bot.start(config.cache_server_maker.token)
+        with startup_timer.phase("snapshot"):
+            print(f"Restored {self.snapshot.load()} guilds from {self.snapshot.path}")
+
+        with startup_timer.phase("database pool"):
+            self.pool = await create_managed_pool(self.config)
+            self.read_pool = await create_read_pool(self.pool, self.config.replica_postgres_url)
+        asyncio.create_task(self.pool.watch())
+        asyncio.create_task(self.config_service.watch())
+        self.placements = PlacementCache(self.pool)
+        self.lifecycle = GuildLifecycle(self.pool)
+        self.rebalancer = Rebalancer(self.pool, MAX_PER_CACHE_SERVER, batch_size=self.config.rebalance_batch_size)
+        self.actions = ActionLog(self.pool)
+        self.cache_server_writes = WriteBehind(
+            self.pool,
+            "cache_servers",
+            "guild_id",
+            {"name", "welcome_channel", "invite_code"},
+            on_flush=self.cache_servers_written
+        )
+        self.capacity = CapacityPlanner(
+            self.pool,
+            MAX_PER_CACHE_SERVER,
+            min_free=self.config.provision_min_free,
+            horizon=datetime.timedelta(hours=self.config.provision_horizon_hours),
+            cooldown=datetime.timedelta(minutes=self.config.provision_cooldown_minutes),
+            max_pending=self.config.provision_max_pending
+        )
 
-intents = discord.Intents.all()
+        # Warm caches while the gateway connects, on_ready waits for this before starting tasks
+        self.warm_task = asyncio.create_task(
+            warm_caches(
+                startup_timer,
+                cache_servers=load_cache_servers(),
+                staff_positions=load_staff_positions(self.pool),
+                bot_placements=self.placements.warm(),
+            )
+        )
 
-bot = BorealisBot(config)
-cache_server_bot = discord.Client(intents=discord.Intents.all())
+        if self.config.api_mode == "standalone":
+            # The API runs in its own processes (python api.py), only serve mutations to it
+            self.publisher = GatewayPublisher(self, self.pool, shard_ids=self.shard_ids, shard_count=self.shard_count)
+            asyncio.create_task(serve_ipc(cluster_ipc_socket(self.config.ipc_socket, self.cluster_id, self.config.cluster_count), {"handle_bot": handle_bot_on_cache_server}))
+        elif self.config.cluster_count > 1:
+            raise Exception("api_mode must be standalone when running more than one cluster")
+        else:
+            import uvicorn
+            api = importlib.import_module("api")
+            api.config = self.config
+            self.config_service.listen(lambda old, new: setattr(api, "config", new))
+            api.pool = self.pool
+            api.session = self.session
+            api.placements = self.placements
+            api.read_pool = self.read_pool
+            # Only this cache sees the bots invalidations, a separate replica backed one would serve stale placements
+            api.read_placements = self.placements
+            api.gateway = LocalGateway(self, handle_bot_on_cache_server)
+            server = uvicorn.Server(config=uvicorn.Config(api.app, loop=loop, port=2837))
+            asyncio.create_task(server.serve())
+
+        self.gateway_started_at = time.perf_counter()
+
+        clients = [super().start(self.config.token)]
+
+        # Only one cluster may run the cache server maker
+        if self.cluster_id == 0:
+            clients.append(cache_server_bot.start(self.config.cache_server_maker.token))
+
+        await asyncio.gather(*clients)
+
+    @property
+    def config(self) -> Config:
+        return self.config_service.config
+
+    @property
+    def indexes(self) -> ConfigIndexes:
+        return self.config_service.indexes
+
+    def config_reloaded(self, old: Config, new: Config):
+        """Applies reloaded settings to the components that copied them at startup"""
+        if self.pool:
+            self.pool.warn_after = new.db_hold_warn_seconds
+            self.pool.reclaim_after = new.db_hold_reclaim_seconds
+
+        if self.rebalancer:
+            self.rebalancer.batch_size = new.rebalance_batch_size
+
+        if self.capacity:
+            self.capacity.min_free = new.provision_min_free
+            self.capacity.horizon = datetime.timedelta(hours=new.provision_horizon_hours)
+            self.capacity.cooldown = datetime.timedelta(minutes=new.provision_cooldown_minutes)
+            self.capacity.max_pending = new.provision_max_pending
+
+    def cache_servers_written(self, guild_ids: set[str]):
+        """Called once write-behind updates to cache_servers have been flushed"""
+        for guild_id in guild_ids:
+            self.placements.invalidate_guild(int(guild_id))
+
+    def owns_guild(self, guild_id: int) -> bool:
+        """Whether a guild is on one of this processes shards"""
+        if self.shard_ids is None:
+            return True
+
+        return guild_shard(guild_id, self.shard_count) in self.shard_ids
+
+bot = BorealisBot(config_service, cluster_id=int(os.environ.get("CLUSTER_ID", "0")))
+cache_server_bot = discord.Client(intents=server_maker_intents(), member_cache_flags=discord.MemberCacheFlags.none(), chunk_guilds_at_startup=False)
+alerts = AlertDigest()
+scheduler = Scheduler()
+invite_tracker = InviteTracker()
+guild_selector = GuildSelector(bot, MAX_PER_CACHE_SERVER)
 
 have_started_events = False
 bot_tasks = []
 # On ready handler
 @bot.event
 async def on_ready():
+    global have_started_events
     print(f"Logged in as {bot.user.name}#{bot.user.discriminator} ({bot.user.id})")
     if not have_started_events:
+        have_started_events = True
+        startup_timer.phases.append(("gateway ready", time.perf_counter() - bot.gateway_started_at))
+
+        if bot.warm_task:
+            await bot.warm_task
+
+        print(startup_timer.report())
+
         bot_tasks.extend(
             [
-                validate_members,
                 ensure_invites,
-                ensure_cache_servers,
-                nuke_not_approved,
                 ensure_guild_image,
-                main_server_kicker,
+                flush_alerts,
+                flush_actions,
+                flush_cache_server_writes,
+                refresh_staff_positions,
+                save_snapshot,
                 task_fail_check,
             ]
         )
 
+        if bot.publisher:
+            bot_tasks.append(publish_gateway_state)
+
         for t in bot_tasks:
             t.add_exception_type(Exception)
             t.start()
 
+        await bot.lifecycle.load(
+            cache_servers=[g for g in bot.cache_servers if bot.owns_guild(g)],
+            present=[g.id for g in bot.guilds]
+        )
+
+        # validate_members, main_server_kicker, nuke_not_approved and ensure_cache_servers
+        scheduler.start()
+
+        if bot.config.member_cache_policy != "all":
+            asyncio.create_task(chunk_targeted_guilds())
+
+async def chunk_targeted_guilds():
+    """Chunks the cache servers and main server, all other guilds are chunked on demand"""
+    start = time.perf_counter()
+    chunked = 0
+    for guild in bot.guilds:
+        if should_chunk(guild, bot.cache_servers, bot.config.main_server) and not guild.chunked:
+            await ensure_chunked(guild)
+            chunked += 1
+
+    print(f"chunk_targeted_guilds: Chunked {chunked} guilds in {time.perf_counter() - start:.1f}s (rss={format_bytes(process_rss() or 0)})")
+
+@bot.event
+async def on_guild_join(guild: discord.Guild):
+    guild_selector.index.invalidate()
+    await bot.lifecycle.joined(guild.id)
+
+    if bot.config.member_cache_policy != "all" and should_chunk(guild, bot.cache_servers, bot.config.main_server):
+        await ensure_chunked(guild)
+
+@bot.event
+async def on_guild_available(guild: discord.Guild):
+    guild_selector.index.invalidate()
+
+    if bot.lifecycle:
+        await bot.lifecycle.joined(guild.id)
+
+@bot.event
+async def on_guild_update(before: discord.Guild, after: discord.Guild):
+    if before.name != after.name:
+        guild_selector.index.invalidate()
+
+@bot.event
+async def on_guild_remove(guild: discord.Guild):
+    guild_selector.index.invalidate()
+
+    if bot.lifecycle:
+        bot.lifecycle.left(guild.id)
+
+    bot.snapshot.forget(guild.id)
+
 @bot.command()
 async def register(ctx: commands.Context):
     try:
         usp = await get_user_staff_perms(bot.pool, ctx.author.id)
-        resolved = usp.resolve()
+        resolved = resolve(usp)
     except:
         usp = StaffPermissions(user_positions=[], perm_overrides=[])
         resolved = []
@@ -134,7 +308,7 @@ async def register(ctx: commands.Context):
     if not resolved:
         return await ctx.send("User is not a staff member")
 
-    if not has_perm(resolved, Permission.from_str("borealis.register")):
+    if not check(usp, "borealis.register"):
         return await ctx.send("You need ``borealis.register`` permission to perform migrations!")
 
     await bot.tree.sync()
@@ -149,6 +323,52 @@ async def task_fail_check():
             task.start()
             print(f"task_fail_check: Restarted task {task}")
 
+@tasks.loop(minutes=5)
+async def flush_alerts():
+    """Sends one digest of all alerts raised since the last flush"""
+    await alerts.flush(bot, bot.config.notify_webhook)
+
+@tasks.loop(seconds=15)
+async def flush_actions():
+    """Writes buffered actions to cache_server_actions"""
+    await bot.actions.flush()
+
+@tasks.loop(seconds=2)
+async def flush_cache_server_writes():
+    """Writes pending low priority cache_servers updates (name, welcome channel, invite code)"""
+    await bot.cache_server_writes.flush()
+
+@tasks.loop(minutes=5)
+async def save_snapshot():
+    """Saves reconciled guild state to disk, so a restart only revalidates what changed"""
+    await asyncio.to_thread(bot.snapshot.write, bot.snapshot.rows())
+
+async def close_clients():
+    """Disconnects both clients, which makes bot.run return"""
+    await cache_server_bot.close()
+    await bot.close()
+
+async def persist_on_shutdown():
+    """Flushes the buffered actions and cache_servers writes and saves the snapshot"""
+    if bot.actions:
+        await bot.actions.flush()
+
+    if bot.cache_server_writes:
+        await bot.cache_server_writes.flush()
+
+    await asyncio.to_thread(bot.snapshot.write, bot.snapshot.rows())
+
+@tasks.loop(minutes=1)
+async def refresh_staff_positions():
+    """Reloads staff positions, dropping memoized permission checks if they changed"""
+    if await load_staff_positions(bot.pool):
+        print("refresh_staff_positions: Staff positions changed, cleared permission cache")
+
+@tasks.loop(seconds=30)
+async def publish_gateway_state():
+    """Publishes gateway state for standalone API workers"""
+    await bot.publisher.publish()
+
 @cache_server_bot.event
 async def on_ready():
     for guild in cache_server_bot.guilds:
@@ -157,6 +377,14 @@ async def on_ready():
         else:
             await guild.leave()
 
+async def load_cache_servers():
+    """Loads (or reloads) all cache servers into bot.cache_servers"""
+    rows = await bot.pool.fetch("SELECT guild_id, name, bots_role, system_bots_role, logs_channel, staff_role, web_moderator_role, welcome_channel, invite_code, created_at from cache_servers")
+    bot.cache_servers = {int(r["guild_id"]): bot.cache_server_writes.overlay(r["guild_id"], dict(r)) for r in rows}
+
+    if bot.is_ready():
+        bot.lifecycle.update_cache_servers(g for g in bot.cache_servers if bot.owns_guild(g))
+
 async def create_cache_server(guild: discord.Guild):
     # Check that we're not already in a cache server
     count = await bot.pool.fetchval("SELECT COUNT(*) from cache_servers WHERE guild_id = $1", str(guild.id))
@@ -166,7 +394,7 @@ async def create_cache_server(guild: discord.Guild):
     
     oauth_md = await bot.pool.fetchrow("SELECT owner_id from cache_server_oauth_md")
 
-    if guild.id in bot.config.pinned_servers:
+    if guild.id in bot.indexes.pinned_servers:
         return False
 
     if str(guild.owner_id) != oauth_md["owner_id"]:
@@ -205,10 +433,13 @@ async def create_cache_server(guild: discord.Guild):
         logs_channel = await logs_category.create_text_channel('system-logs')
         
         await bot.pool.execute("INSERT INTO cache_servers (guild_id, bots_role, web_moderator_role, system_bots_role, logs_channel, staff_role, welcome_channel, invite_code, name) VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9)", str(guild.id), str(bots_role.id), str(webmod_role.id), str(needed_bots_role.id), str(logs_channel.id), str(hs_role.id), str(welcome_channel.id), invite.code, guild.name)
+        await bot.capacity.provisioned(guild.id)
+        await load_cache_servers()
         async with aiohttp.ClientSession() as session:
             hook = discord.Webhook.from_url(bot.config.notify_webhook, session=session)
             await hook.send(content=f"@Bot Reviewers\n\nCache server added: {guild.name} ({guild.id}) {invite.url}")
 
+        await ensure_chunked(guild)
         for member in guild.members:
             await handle_member(member, cache_server_info={"bots_role": bots_role.id, "web_moderator_role": str(webmod_role.id), "system_bots_role": needed_bots_role.id, "logs_channel": logs_channel.id, "staff_role": hs_role.id})
 
@@ -218,38 +449,11 @@ async def create_cache_server(guild: discord.Guild):
 
 async def resolve_guilds_from_str(guilds: str, check: Callable[[discord.Guild], bool]):
     """
-    If guilds is 'all', return all guilds that the bot is in and passes check(g)
-    If guilds is 'cs', then return all cache servers the bot is in and passes check(g)
-    Otherwise, returns all guilds from the comma seperated list that passes check(g)
-    """
-    resolved_guilds: list[discord.Guild] = []
-    if guilds == "all":
-        resolved_guilds = [g for g in bot.guilds if check(g) and g.id not in bot.config.pinned_servers]
-    elif guilds == "cs":
-        db_ids = await bot.pool.fetch("SELECT guild_id from cache_servers")
-        for g in db_ids:
-            guild = bot.get_guild(int(g["guild_id"]))
-
-            if guild and check(guild):
-                resolved_guilds.append(guild)
-    else:
-        for id in guilds.split(","):
-            id = id.strip()
-
-            guild = None
-            for g in bot.guilds:
-                if id == str(g.id) or id == g.name:
-                    guild = g
-                    break
-                    
-            if not guild:
-                continue
-
-            if guild and check(guild):
-                resolved_guilds.append(guild)
-    
-    return resolved_guilds
+    Returns all guilds matching the selector expression guilds that pass check(g)
 
+    'all' is every guild the bot is in (except pinned servers), 'cs' is every cache server, see GuildSelector for the full syntax
+    """
+    return [g for g in await guild_selector.resolve(guilds) if check(g)]
 
 async def refresh_oauth(cred: dict):
     # Check if expired, if so, refresh access token and update db
@@ -260,8 +464,8 @@ async def refresh_oauth(cred: dict):
         data = {
             "grant_type": "refresh_token",
             "refresh_token": cred["refresh_token"],
-            "client_id": config.borealis_client_id if cred["bot"] == "borealis" else config.cache_server_maker.client_id,
-            "client_secret": config.borealis_client_secret if cred["bot"] == "borealis" else config.cache_server_maker.client_secret,
+            "client_id": bot.config.borealis_client_id if cred["bot"] == "borealis" else bot.config.cache_server_maker.client_id,
+            "client_secret": bot.config.borealis_client_secret if cred["bot"] == "borealis" else bot.config.cache_server_maker.client_secret,
         }
         print(data)
         async with bot.session.post(f"https://discord.com/api/v10/oauth2/token", data=data, headers=headers) as resp:
@@ -297,15 +501,12 @@ async def create_unprovisioned_cache_server():
     oauth_creds = []
     for cred in _oauth_creds:
         usp = await get_user_staff_perms(bot.pool, int(cred["user_id"]))
-        resolved = usp.resolve()
 
-        if not has_perm(resolved, Permission.from_str("borealis.make_cache_servers")):
+        if not check(usp, "borealis.make_cache_servers"):
             continue # Don't add this user
 
         oauth_creds.append(await refresh_oauth(cred))
         
-    guild: discord.Guild = await cache_server_bot.create_guild(name="IBLCS-" + secrets.token_hex(4))
-
     # Add owner first to transfer ownership
     owner_creds = None
     for cred in oauth_creds:
@@ -315,65 +516,81 @@ async def create_unprovisioned_cache_server():
     
     if not owner_creds:
         raise Exception("Owner credentials not found")
-    
-    async with aiohttp.ClientSession() as session:
-        # First add owner
-        async with session.put(f"https://discord.com/api/v10/guilds/{guild.id}/members/{owner_creds['user_id']}", headers={"Authorization": f"Bot {config.cache_server_maker.token}"}, json={"access_token": owner_creds["access_token"]}) as resp:
-            if not resp.ok:
-                raise Exception(f"Failed to add owner to guild: {await resp.text()}")
-        
-        await asyncio.sleep(1)
 
-        # Add all other users
-        for cred in oauth_creds:
-            if cred["user_id"] == owner_creds["user_id"]:
-                continue
+    guild: discord.Guild = await cache_server_bot.create_guild(name="IBLCS-" + secrets.token_hex(4))
 
-            async with session.put(f"https://discord.com/api/v10/guilds/{guild.id}/members/{cred['user_id']}", headers={"Authorization": f"Bot {config.cache_server_maker.token}"}, json={"access_token": cred["access_token"]}) as resp:
+    try:
+        async with aiohttp.ClientSession() as session:
+            # First add owner
+            async with session.put(f"https://discord.com/api/v10/guilds/{guild.id}/members/{owner_creds['user_id']}", headers={"Authorization": f"Bot {bot.config.cache_server_maker.token}"}, json={"access_token": owner_creds["access_token"]}) as resp:
                 if not resp.ok:
-                    raise Exception(f"Failed to add user to guild: {await resp.text()}")
-
+                    raise Exception(f"Failed to add owner to guild: {await resp.text()}")
+        
             await asyncio.sleep(1)
+
+            # Add all other users
+            for cred in oauth_creds:
+                if cred["user_id"] == owner_creds["user_id"]:
+                    continue
+
+                async with session.put(f"https://discord.com/api/v10/guilds/{guild.id}/members/{cred['user_id']}", headers={"Authorization": f"Bot {bot.config.cache_server_maker.token}"}, json={"access_token": cred["access_token"]}) as resp:
+                    if not resp.ok:
+                        raise Exception(f"Failed to add user to guild: {await resp.text()}")
+
+                await asyncio.sleep(1)
         
-    # create oauthadmin role
-    oauth_admin_role = await guild.create_role(name="Oauth Admin", permissions=discord.Permissions.all(), color=discord.Color.blurple(), hoist=True)
+        # create oauthadmin role
+        oauth_admin_role = await guild.create_role(name="Oauth Admin", permissions=discord.Permissions.all(), color=discord.Color.blurple(), hoist=True)
 
-    # Give all users oauthadmin role
-    async for member in guild.fetch_members():
-        await member.add_roles(oauth_admin_role)
+        # Give all users oauthadmin role
+        async for member in guild.fetch_members():
+            await member.add_roles(oauth_admin_role)
 
-    # Send everyone ping to temp channel
-    temp_chan = await guild.create_text_channel("temp")
+        # Send everyone ping to temp channel
+        temp_chan = await guild.create_text_channel("temp")
 
-    await temp_chan.send(
-        f"@everyone"
-    )
+        await temp_chan.send(
+            f"@everyone"
+        )
 
-    msg = f"""
+        msg = f"""
 New unprovisioned cache server created!
 
 Add the following bots to the server: 
 
         """
 
-    for b in bot.config.needed_bots:
-        invite = b.invite.replace("{id}", str(b.id)).replace("{perms}", "8")
-        msg += f"\n- {b.name}: [{invite}]\n"
+        for name, invite in bot.indexes.needed_bot_invites:
+            msg += f"\n- {name}: [{invite}]\n"
     
-    msg += "\n3. Run the following command in the server: ``#make_cache_server true``"
+        msg += "\n3. Run the following command in the server: ``#make_cache_server true``"
 
-    await temp_chan.send(msg)
+        await temp_chan.send(msg)
+
+        # Transfer ownership and leave
+        await guild.edit(owner=discord.Object(int(owner_creds["user_id"])))
+    except Exception:
+        # Do not leave half made guilds behind, the bot still owns the guild here
+        print(f"create_unprovisioned_cache_server: Setting up {guild.id} failed, deleting it")
+        try:
+            await guild.delete()
+        except discord.HTTPException as exc:
+            print(f"create_unprovisioned_cache_server: Failed to delete {guild.id}: {exc}")
+        raise
 
-    # Transfer ownership and leave
-    await guild.edit(owner=discord.Object(int(owner_creds["user_id"])))
     await guild.leave()
 
+    return guild.id
+
 async def handle_member(member: discord.Member, cache_server_info):
     """
     Handles a member, including adding them to any needed roles
     
     This is a seperate function to allow for better debugging using the WIP fastapi webserver
+
+    Returns True if anything had to be fixed
     """
+    changed = False
     if not member.bot:
         try:
             usp = await get_user_staff_perms(bot.pool, member.id)
@@ -385,91 +602,141 @@ async def handle_member(member: discord.Member, cache_server_info):
             staff_role = member.guild.get_role(int(cache_server_info["staff_role"]))
             
             if not webmod_role:
-                async with aiohttp.ClientSession() as session:
-                    hook = discord.Webhook.from_url(bot.config.notify_webhook, session=session)
-                    await hook.send(content=f"Failed to find web moderator role for staff member {member.name} ({member.id}). The web moderator role currently configured is {cache_server_info['web_moderator_role']}. Please verify this role exists <@&{cache_server_info['staff_role']}>")
+                alerts.add(
+                    member.guild,
+                    "missing_web_moderator_role",
+                    subject=f"{member.name} ({member.id})",
+                    message=f"Failed to find web moderator role for staff members. The web moderator role currently configured is {cache_server_info['web_moderator_role']}. Please verify this role exists <@&{cache_server_info['staff_role']}>"
+                )
                 return
 
             if not staff_role:
-                async with aiohttp.ClientSession() as session:
-                    hook = discord.Webhook.from_url(bot.config.notify_webhook, session=session)
-                    await hook.send(content=f"Failed to find staff role for staff member {member.name} ({member.id}). The staff role currently configured is {cache_server_info['staff_role']}. Please verify this role exists <@&{cache_server_info['staff_role']}>")
+                alerts.add(
+                    member.guild,
+                    "missing_staff_role",
+                    subject=f"{member.name} ({member.id})",
+                    message=f"Failed to find staff role for staff members. The staff role currently configured is {cache_server_info['staff_role']}. Please verify this role exists <@&{cache_server_info['staff_role']}>"
+                )
                 return
 
             if len(usp.user_positions) == 0:
                 if staff_role in member.roles:
                     await member.remove_roles(staff_role)
+                    bot.actions.record(member.guild.id, "remove_role", member.id, staff_role.name)
+                    changed = True
                 if webmod_role in member.roles:
                     await member.remove_roles(webmod_role)
+                    bot.actions.record(member.guild.id, "remove_role", member.id, webmod_role.name)
+                    changed = True
             else:
                 # Add webmod role
                 if webmod_role not in member.roles:
                     await member.add_roles(webmod_role)
+                    bot.actions.record(member.guild.id, "add_role", member.id, webmod_role.name)
+                    changed = True
                 
-                resolved_perms = usp.resolve()
-
-                if has_perm(resolved_perms, Permission.from_str("borealis.can_have_staff_role")):
+                if check(usp, "borealis.can_have_staff_role"):
                     if staff_role not in member.roles:
                         await member.add_roles(staff_role)
+                        bot.actions.record(member.guild.id, "add_role", member.id, staff_role.name)
+                        changed = True
                 else:
                     if staff_role in member.roles:
                         await member.remove_roles(staff_role)
+                        bot.actions.record(member.guild.id, "remove_role", member.id, staff_role.name)
+                        changed = True
 
     # If still not found...
     if not cache_server_info:
         # Ignore non-cache servers
-        return 
+        return changed
 
     if member.bot:
         # Check if the bot is in the needed bots list
-        if str(member.id) in [str(b.id) for b in bot.config.needed_bots]:
+        if member.id in bot.indexes.needed_bot_ids:
             # Give Needed Bots role and Bots role
             needed_bots_role = member.guild.get_role(int(cache_server_info["system_bots_role"]))
             bots_role = member.guild.get_role(int(cache_server_info["bots_role"]))
 
             if not needed_bots_role or not bots_role:
                 # Send alert to logs channel
-                logs_channel = member.guild.get_channel(int(cache_server_info["logs_channel"]))
-
-                if logs_channel:
-                    await logs_channel.send(f"Failed to find needed roles for needed bot {member.name} ({member.id}). The Needed Bots role currently configured is {cache_server_info['system_bots_role']} and the Bots role is {cache_server_info['bots_role']}. Please verify these roles exist <@&{cache_server_info['staff_role']}>")
+                alerts.add(
+                    member.guild,
+                    "missing_needed_bots_roles",
+                    subject=f"{member.name} ({member.id})",
+                    message=f"Failed to find needed roles for needed bots. The Needed Bots role currently configured is {cache_server_info['system_bots_role']} and the Bots role is {cache_server_info['bots_role']}. Please verify these roles exist <@&{cache_server_info['staff_role']}>",
+                    logs_channel=int(cache_server_info["logs_channel"])
+                )
                 return
 
             # Check if said bot has the needed roles
             if needed_bots_role not in member.roles or bots_role not in member.roles:
                 # Add the roles
-                return await member.add_roles(needed_bots_role, bots_role)
+                await member.add_roles(needed_bots_role, bots_role)
+                bot.actions.record(member.guild.id, "add_role", member.id, f"{needed_bots_role.name}, {bots_role.name}")
+                return True
 
-            return
+            return False
 
         # Check if this bot has been selected for this cache server
-        count = await bot.pool.fetchval("SELECT COUNT(*) from cache_server_bots WHERE guild_id = $1 AND bot_id = $2", str(member.guild.id), str(member.id))
-
-        if not count:
+        if not await queries.is_selected_bot(bot.pool, member.guild.id, member.id):
             # Not white-listed, kick it
-            return await member.kick(reason="Not white-listed for cache server")
+            await member.kick(reason="Not white-listed for cache server")
+            bot.actions.record(member.guild.id, "kick", member.id, "Not white-listed for cache server")
+            return True
         
         # Also, check that the bot is approved or certified
-        bot_type = await bot.pool.fetchval("SELECT type from bots WHERE bot_id = $1", str(member.id))
+        bot_type = await queries.bot_type(bot.pool, member.id)
 
         if bot_type and bot_type not in ["approved", "certified"]:
             # Not approved or certified, kick it
             await bot.pool.execute("DELETE FROM cache_server_bots WHERE guild_id = $1 AND bot_id = $2", str(member.guild.id), str(member.id))
-            return await member.kick(reason="Not approved or certified")
+            bot.placements.invalidate(str(member.id))
+            await member.kick(reason="Not approved or certified")
+            bot.actions.record(member.guild.id, "kick", member.id, "Not approved or certified")
+            return True
 
         # Add the bot to the Bots role
         bots_role = member.guild.get_role(int(cache_server_info["bots_role"]))
 
         if not bots_role:
             # Send alert to logs channel
-            logs_channel = member.guild.get_channel(int(cache_server_info["logs_channel"]))
-
-            if logs_channel:
-                await logs_channel.send(f"Failed to find Bots role for bot {member.name} ({member.id}). The Bots role currently configured is {cache_server_info['bots_role']}. Please verify this role exists <@&{cache_server_info['staff_role']}>")
+            alerts.add(
+                member.guild,
+                "missing_bots_role",
+                subject=f"{member.name} ({member.id})",
+                message=f"Failed to find Bots role for bots. The Bots role currently configured is {cache_server_info['bots_role']}. Please verify this role exists <@&{cache_server_info['staff_role']}>",
+                logs_channel=int(cache_server_info["logs_channel"])
+            )
             return
 
         if bots_role not in member.roles:
             await member.add_roles(bots_role)
+            bot.actions.record(member.guild.id, "add_role", member.id, bots_role.name)
+            return True
+
+    return changed
+
+async def handle_bot_on_cache_server(bot_id: int):
+    """Handles a bot on the cache server it has been placed in"""
+    cache_server = await queries.cache_server_of_bot(bot.pool, bot_id)
+
+    if cache_server is None:
+        raise GatewayError(404, "Bot not found in any cache server")
+    
+    cache_server_info = await queries.cache_server_info(bot.pool, cache_server)
+
+    guild = bot.get_guild(int(cache_server))
+
+    if not cache_server_info or not guild:
+        raise GatewayError(500, "Cache server not found despite existing in database")
+
+    member = guild.get_member(int(bot_id))
+
+    if member is None:
+        raise GatewayError(500, "Bot not found in cache server")
+
+    await handle_member(member, cache_server_info=cache_server_info)
 
 async def remove_if_tresspassing(member: discord.Member):
     """Removes a bot from the main server if it is not premium, certified or explicitly whitelisted or a partner"""
@@ -479,26 +746,15 @@ async def remove_if_tresspassing(member: discord.Member):
     if not member.bot:
         raise Exception("Not a bot")
 
-    whitelist_entry = await bot.pool.fetchval("SELECT COUNT(*) from bot_whitelist WHERE bot_id = $1", str(member.id))
-
-    if whitelist_entry:
-        return
-    
-    bot_entry = await bot.pool.fetchval("SELECT COUNT(*) from bots WHERE bot_id = $1 AND (premium = true OR type = 'certified')", str(member.id))
-
-    if bot_entry:
-        return
-    
-    # Partner check
-    partner_entry = await bot.pool.fetchval("SELECT COUNT(*) FROM partners WHERE bot_id = $1", str(member.id))
-
-    if partner_entry:
+    if await queries.bot_may_stay_on_main_server(bot.pool, member.id):
         return
 
     if member.top_role >= member.guild.me.top_role:
         print("Cant kick", member.name, member.top_role, member.guild.me.top_role)
     
     await member.kick(reason="Not premium, certified or whitelisted")
+    bot.actions.record(member.guild.id, "kick", member.id, "Not premium, certified or whitelisted")
+    return True
 
 @bot.event
 async def on_member_join(member: discord.Member):
@@ -509,7 +765,7 @@ async def on_member_join(member: discord.Member):
             print(f"on_member_join [bot_tresspass_check] (id={member},{member.id}) {exc}")
         return
 
-    cache_server_info = await bot.pool.fetchrow("SELECT bots_role, system_bots_role, logs_channel, staff_role, web_moderator_role from cache_servers WHERE guild_id = $1", str(member.guild.id))
+    cache_server_info = await queries.cache_server_info(bot.pool, member.guild.id)
     
     if not cache_server_info:
         try:
@@ -522,9 +778,12 @@ async def on_member_join(member: discord.Member):
     else:
         await handle_member(member, cache_server_info=cache_server_info)
 
-@tasks.loop(minutes=5)
-async def main_server_kicker():
-    print(f"Starting main_server_kicker task on {datetime.datetime.now()}")
+@scheduler.job(datetime.timedelta(minutes=5))
+async def main_server_kicker(job: Job):
+    print(f"Starting main_server_kicker task on {datetime.datetime.now()} (interval={job.interval:.0f}s)")
+
+    if not bot.owns_guild(bot.config.main_server):
+        return # Another cluster handles the main server
 
     main_server = bot.get_guild(bot.config.main_server)
 
@@ -532,23 +791,36 @@ async def main_server_kicker():
         print("Bot could not find main server")
         return
     
+    await ensure_chunked(main_server)
+
+    kicked = 0
     for member in main_server.members:
         if member.bot and member.id != bot.user.id:
             try:
-                await remove_if_tresspassing(member)
+                if await remove_if_tresspassing(member):
+                    kicked += 1
             except Exception as exc:
                 print(f"main_server_kicker (bot_id={member},{member.id}) {exc}")
 
-@tasks.loop(minutes=5)
-async def nuke_not_approved():
-    print (f"Starting nuke_not_approved task on {datetime.datetime.now()}")
+    return kicked
+
+@scheduler.job(datetime.timedelta(minutes=5))
+async def nuke_not_approved(job: Job):
+    print (f"Starting nuke_not_approved task on {datetime.datetime.now()} (interval={job.interval:.0f}s)")
+
+    # Each cluster handles the cache servers on its own shards, as only it can kick bots there
+    owned = [str(g) for g in bot.cache_servers if bot.owns_guild(g)]
 
     # Get all bots that are not approved or certified
-    not_approved = await bot.pool.fetch("SELECT bot_id, guild_id from cache_server_bots WHERE bot_id NOT IN (SELECT bot_id from bots WHERE type = 'approved' OR type = 'certified')")
+    not_approved = await bot.pool.fetch(
+        "SELECT bot_id, guild_id from cache_server_bots WHERE guild_id = ANY($1) AND bot_id NOT IN (SELECT bot_id from bots WHERE type = 'approved' OR type = 'certified')",
+        owned
+    )
 
     for b in not_approved:
         # Delete it first
         await bot.pool.execute("DELETE FROM cache_server_bots WHERE bot_id = $1", b["bot_id"])
+        bot.placements.invalidate(b["bot_id"])
 
         guild = bot.get_guild(int(b["guild_id"]))
 
@@ -557,19 +829,85 @@ async def nuke_not_approved():
 
             if member:
                 await member.kick(reason="Not approved or certified")
+                bot.actions.record(guild.id, "kick", member.id, "Not approved or certified")
+
+    return len(not_approved)
+
+@scheduler.job(datetime.timedelta(minutes=30))
+async def plan_capacity(job: Job):
+    print(f"Starting plan_capacity task on {datetime.datetime.now()} (interval={job.interval:.0f}s)")
+
+    if bot.cluster_id != 0:
+        return # Only cluster 0 runs the cache server maker
+
+    created = await bot.capacity.run(create_unprovisioned_cache_server)
+
+    if created:
+        hook = discord.Webhook.from_url(bot.config.notify_webhook, session=bot.session)
+        await hook.send(content="@Bot Reviewers\n\nCache servers are running low on free slots, a new unprovisioned cache server has been created. Please add the needed bots to it")
+
+    return created
+
+async def plan_rebalance(include_present: bool = False, max_moves: int | None = None) -> list[Move]:
+    """Plans moves evening out the cache servers this process can see (those on its own shards)"""
+    guild_ids = [str(g) for g in bot.cache_servers if bot.owns_guild(g) and bot.get_guild(g)]
+
+    def is_present(guild_id: str, bot_id: str) -> bool:
+        return bot.get_guild(int(guild_id)).get_member(int(bot_id)) is not None
+
+    occupancy = await bot.rebalancer.occupancy(guild_ids, is_present)
+    return plan_moves(occupancy, MAX_PER_CACHE_SERVER, include_present=include_present, max_moves=max_moves)
+
+async def apply_rebalance(moves: list[Move]) -> list[Move]:
+    """Applies moves, kicking moved bots that had already joined their old cache server"""
+    async def on_batch(applied: list[Move]):
+        bot.placements.invalidate(*[m.bot_id for m in applied])
+
+        for move in applied:
+            bot.actions.record(int(move.to_guild), "move_bot", int(move.bot_id), f"From cache server {move.from_guild}")
+
+            if not move.present:
+                continue
+
+            guild = bot.get_guild(int(move.from_guild))
+            member = guild.get_member(int(move.bot_id)) if guild else None
+
+            if member:
+                await member.kick(reason=f"Rebalanced to cache server {move.to_guild}")
+                bot.actions.record(guild.id, "kick", member.id, f"Rebalanced to cache server {move.to_guild}")
+
+    return await bot.rebalancer.apply(moves, on_batch=on_batch)
+
+@scheduler.job(datetime.timedelta(hours=6))
+async def rebalance_cache_servers(job: Job):
+    """Evens out the cache servers of this cluster, each cluster can only kick bots on its own shards"""
+    print(f"Starting rebalance_cache_servers task on {datetime.datetime.now()} (interval={job.interval:.0f}s)")
+
+    # Only bots that have not joined yet are moved in the background, moving the rest needs cs_rebalance
+    moves = await plan_rebalance(max_moves=bot.config.rebalance_max_moves)
+
+    if not moves:
+        return 0
+
+    applied = await apply_rebalance(moves)
+    print(f"rebalance_cache_servers: Moved {len(applied)}/{len(moves)} bots")
+    return len(applied)
 
 @tasks.loop(minutes=120)
 async def ensure_guild_image():
+    from PIL import Image, ImageDraw, ImageFont
+
     print(f"Starting ensure_guild_image task on {datetime.datetime.now()}")
 
     for guild in bot.guilds:
-        cache_server_info = await bot.pool.fetchrow("SELECT guild_id from cache_servers WHERE guild_id = $1", str(guild.id))
-
-        if not cache_server_info:
+        if guild.id not in bot.cache_servers:
             continue
 
         name = guild.name.split("-")[-1]
 
+        if bot.snapshot.icon_unchanged(guild, name):
+            continue
+
         try:
             print("Editing guild logo for", name)
 
@@ -589,85 +927,153 @@ async def ensure_guild_image():
             
             bio.seek(0, 0)
 
-            await guild.edit(icon=bio.read())
+            edited = await guild.edit(icon=bio.read())
+
+            state = bot.snapshot.state(guild.id)
+            state.icon_name = name
+            state.icon_key = edited.icon.key if edited.icon else None
+
             await asyncio.sleep(30)
         except Exception as e:
             print(f"Failed to edit guild logo for {name}: {e}")
 
-_ensure_cache_server = {} # delete if fail check 3 times
-@tasks.loop(minutes=5)
-async def ensure_cache_servers():
-    print(f"Starting ensure_cache_servers task on {datetime.datetime.now()}")
+@scheduler.job(datetime.timedelta(minutes=5))
+async def ensure_cache_servers(job: Job):
+    """Deletes cache servers we have been missing from for too long, see bot.lifecycle"""
+    print(f"Starting ensure_cache_servers task on {datetime.datetime.now()} (interval={job.interval:.0f}s)")
 
     # First ensure only one row of cache_server_oauth_md exists
-    count = await bot.pool.fetchval("SELECT COUNT(*) from cache_server_oauth_md")
+    if await bot.leader.is_leader():
+        count = await bot.pool.fetchval("SELECT COUNT(*) from cache_server_oauth_md")
+
+        if count > 1:
+            await bot.pool.execute("DELETE FROM cache_server_oauth_md WHERE id NOT IN (SELECT id from cache_server_oauth_md ORDER BY id DESC LIMIT 1)")
 
-    if count > 1:
-        await bot.pool.execute("DELETE FROM cache_server_oauth_md WHERE id NOT IN (SELECT id from cache_server_oauth_md ORDER BY id DESC LIMIT 1)")
+    new, expired = await bot.lifecycle.check(datetime.timedelta(minutes=bot.config.cache_server_missing_minutes))
 
-    # Check for guilds we are not in
-    unknown_guilds = await bot.pool.fetch("SELECT guild_id from cache_servers WHERE guild_id != ALL($1)", [str(g.id) for g in bot.guilds])
+    for guild_id in new:
+        print(f"ALERT: Found unknown server {guild_id}")
 
-    for guild in unknown_guilds:
-        print(f"ALERT: Found unknown server {guild['guild_id']}")
+    for guild_id in expired:
+        print(f"ALERT: Deleting cache server {guild_id}, the bot has been missing from it for too long")
+        await bot.pool.execute("DELETE FROM cache_servers WHERE guild_id = $1", str(guild_id))
+        bot.actions.record(guild_id, "delete_cache_server", reason="Missing from cache server for too long")
+        bot.placements.invalidate_guild(guild_id)
+        bot.cache_servers.pop(guild_id, None)
+        bot.lifecycle.forget(guild_id)
+
+    # Servers that are still missing are not drift this run fixed, counting them would shrink the interval
+    return len(expired)
+
+async def recreate_invite(guild: discord.Guild, cache_server_info: dict):
+    """Creates a new cache server invite, replacing the one in the database"""
+    logs_channel = guild.get_channel(int(cache_server_info["logs_channel"]))
+
+    if not logs_channel:
+        print(f"Failed to find logs channel for {guild.name} ({guild.id})")
+        return
+
+    welcome_channel = guild.get_channel(int(cache_server_info["welcome_channel"]))
+
+    if not welcome_channel:
+        print(f"Failed to find welcome channel for {guild.name} ({guild.id})")
+        await logs_channel.send("Failed to find welcome channel, creating new one")
+        welcome_channel = await guild.create_text_channel("welcome", reason="Welcome channel")
+        bot.actions.record(guild.id, "create_channel", welcome_channel.id, "Welcome channel")
+        bot.cache_server_writes.set(str(guild.id), "welcome_channel", str(welcome_channel.id))
+        cache_server_info["welcome_channel"] = str(welcome_channel.id)
+
+    await logs_channel.send("Cache server invite has expired, creating new one")
+    invite = await welcome_channel.create_invite(reason="Cache server invite", unique=True, max_uses=0, max_age=0)
+    bot.actions.record(guild.id, "rotate_invite", reason=f"{cache_server_info['invite_code']} -> {invite.code}")
+    bot.cache_server_writes.set(str(guild.id), "invite_code", invite.code)
+    cache_server_info["invite_code"] = invite.code
+    invite_tracker.add(guild.id, invite.code)
+
+@bot.event
+async def on_invite_create(invite: discord.Invite):
+    if not invite.guild:
+        return
+
+    cache_server_info = bot.cache_servers.get(invite.guild.id)
+
+    if not cache_server_info:
+        return
+
+    invite_tracker.add(invite.guild.id, invite.code)
+
+    # recreate_invite's own invite can arrive here before it has stored the new code
+    if invite.inviter and invite.inviter.id == bot.user.id:
+        return
+
+    if invite.code != cache_server_info["invite_code"] and is_unlimited(invite):
+        try:
+            await invite.delete(reason="Unlimited invites are not allowed on cache servers")
+            bot.actions.record(invite.guild.id, "delete_invite", invite.inviter.id if invite.inviter else None, invite.code)
+        except discord.NotFound:
+            pass
 
-        c = _ensure_cache_server.get(guild["guild_id"], 0)
+@bot.event
+async def on_invite_delete(invite: discord.Invite):
+    if not invite.guild:
+        return
 
-        if c > 3:
-            await bot.pool.execute("DELETE FROM cache_servers WHERE guild_id = $1", guild["guild_id"])
+    invite_tracker.remove(invite.guild.id, invite.code)
 
-        _ensure_cache_server[guild["guild_id"]] = c + 1
+    cache_server_info = bot.cache_servers.get(invite.guild.id)
+    guild = bot.get_guild(invite.guild.id)
 
+    if cache_server_info and guild and invite.code == cache_server_info["invite_code"]:
+        await recreate_invite(guild, cache_server_info)
 
-@tasks.loop(minutes=15)
+@tasks.loop(hours=6)
 async def ensure_invites():
-    """Task to ensure and correct guild invites for all servers"""
+    """
+    Safety net to ensure and correct guild invites for all servers
+    
+    Invites are normally fixed as they change by on_invite_create/on_invite_delete, this also seeds invite_tracker
+    """
     print(f"Starting ensure_invites task on {datetime.datetime.now()}")
     for guild in bot.guilds:
-        cache_server_info = await bot.pool.fetchrow("SELECT welcome_channel, logs_channel, invite_code from cache_servers WHERE guild_id = $1", str(guild.id))
+        cache_server_info = bot.cache_servers.get(guild.id)
 
         if not cache_server_info:
+            invite_tracker.forget(guild.id)
             continue
 
         print(f"Validating invites for {guild.name} ({guild.id})")
         invites = await guild.invites()
 
-        have_invite = False
         for invite in invites:
-            if invite.code == cache_server_info["invite_code"]:
-                have_invite = True
-            else:
-                if not invite.expires_at:
-                    await invite.delete(reason="Unlimited invites are not allowed on cache servers")
+            if invite.code != cache_server_info["invite_code"] and is_unlimited(invite):
+                await invite.delete(reason="Unlimited invites are not allowed on cache servers")
+                bot.actions.record(guild.id, "delete_invite", invite.inviter.id if invite.inviter else None, invite.code)
 
-        if not have_invite:
-            logs_channel = guild.get_channel(int(cache_server_info["logs_channel"]))
+        invite_tracker.seed(guild.id, [i for i in invites if i.code == cache_server_info["invite_code"] or not is_unlimited(i)])
 
-            if not logs_channel:
-                print(f"Failed to find logs channel for {guild.name} ({guild.id})")
-                continue
+        if not invite_tracker.has_invite(guild.id, cache_server_info["invite_code"]):
+            await recreate_invite(guild, cache_server_info)
 
-            welcome_channel = guild.get_channel(int(cache_server_info["welcome_channel"]))
+    await bot.cache_server_writes.flush()
 
-            if not welcome_channel:
-                print(f"Failed to find welcome channel for {guild.name} ({guild.id})")
-                await logs_channel.send("Failed to find welcome channel, creating new one")
-                welcome_channel = await guild.create_text_channel("welcome", reason="Welcome channel")
-                await bot.pool.execute("UPDATE cache_servers SET welcome_channel = $1 WHERE guild_id = $2", str(welcome_channel.id), str(guild.id))
+@scheduler.job(datetime.timedelta(minutes=5))
+async def validate_members(job: Job):
+    """Task to validate all members, spread over the jobs interval"""
+    print(f"Starting validate_members task on {datetime.datetime.now()} (interval={job.interval:.0f}s)")
 
-            await logs_channel.send("Cache server invite has expired, creating new one")
-            invite = await welcome_channel.create_invite(reason="Cache server invite", unique=True, max_uses=0, max_age=0)
-            await bot.pool.execute("UPDATE cache_servers SET invite_code = $1 WHERE guild_id = $2", invite.code, str(guild.id))
+    # One query per sweep instead of one per guild, staff positions are kept fresh by refresh_staff_positions
+    await load_cache_servers()
 
-@tasks.loop(minutes=5) 
-async def validate_members():
-    """Task to validate all members every 5 minutes"""
-    print(f"Starting validate_members task on {datetime.datetime.now()}")
-    for guild in bot.guilds:
-        cache_server_info = await bot.pool.fetchrow("SELECT bots_role, system_bots_role, logs_channel, staff_role, web_moderator_role, name from cache_servers WHERE guild_id = $1", str(guild.id))
+    # The first sweep after a restart skips guilds that still match the snapshot
+    first_sweep = job.last_run is None
+
+    fixed = 0
+    skipped = 0
+    async for guild in job.spread(bot.guilds):
+        cache_server_info = bot.cache_servers.get(guild.id)
 
         if not cache_server_info:
-            if guild.id in bot.config.pinned_servers:
+            if guild.id in bot.indexes.pinned_servers:
                 continue
 
             if os.environ.get("DELETE_GUILDS", "false").lower() == "true":
@@ -676,9 +1082,11 @@ async def validate_members():
                     if guild.owner_id == bot.user.id:
                         print(f"ALERT: Guild owner is bot, deleting guild")
                         await guild.delete()
+                        bot.actions.record(guild.id, "delete_guild", reason="Unknown server")
                     else:
                         print(f"ALERT: Guild owner is not bot, leaving guild")
                         await guild.leave()
+                        bot.actions.record(guild.id, "leave_guild", reason="Unknown server")
                 except discord.HTTPException:
                     print(f"ALERT: Failed to leave/delete guild {guild.name} ({guild.id})")
             
@@ -686,18 +1094,34 @@ async def validate_members():
         else:
             # Check name
             if not cache_server_info["name"]:
-                await bot.pool.execute("UPDATE cache_servers SET name = $1 WHERE guild_id = $2", guild.name, str(guild.id))
+                bot.cache_server_writes.set(str(guild.id), "name", guild.name)
+                cache_server_info["name"] = guild.name
             elif cache_server_info["name"] != guild.name:
                 # Update server name
                 await guild.edit(name=cache_server_info["name"])      
+                fixed += 1
+
+        if first_sweep and bot.snapshot.unchanged(guild, cache_server_info):
+            skipped += 1
+            continue
 
         print(f"Validating members for {guild.name} ({guild.id})")
+        await ensure_chunked(guild)
         for member in guild.members:
             if member.id == bot.user.id:
                 continue
     
             print(f"Validating {member.name} ({member.id}) [bot={member.bot}]")
-            await handle_member(member, cache_server_info=cache_server_info)
+            if await handle_member(member, cache_server_info=cache_server_info):
+                fixed += 1
+
+        bot.snapshot.reconciled(guild, cache_server_info)
+
+    if skipped:
+        print(f"validate_members: Skipped {skipped} guilds unchanged since the snapshot")
+
+    await asyncio.gather(bot.actions.flush(), bot.cache_server_writes.flush())
+    return fixed
 
 # Error handler
 @bot.event
@@ -710,9 +1134,163 @@ async def on_command_error(ctx: commands.Context, error: commands.CommandError):
 
 @bot.hybrid_command()
 async def db_test(ctx: commands.Context):
-    await bot.pool.acquire()
+    async with bot.pool.acquire() as conn:
+        await conn.fetchval("SELECT 1")
     await ctx.send("Acquired connection")
 
+@bot.hybrid_command()
+async def db_stats(ctx: commands.Context):
+    """Shows database pool usage, who is holding connections and how long callers wait for one"""
+    usp = await get_user_staff_perms(bot.pool, ctx.author.id)
+
+    if not check(usp, "borealis.csreport"):
+        return await ctx.send("You need ``borealis.csreport`` permission to use this command!")
+
+    stats = bot.pool.stats()
+
+    msg = "**Database pool**\n"
+    msg += f"\n- Connections: {stats['size']} open ({stats['idle']} idle, {stats['held']} held), min={stats['min_size']} max={stats['max_size']}"
+    msg += f"\n- Acquires: {stats['acquires']}, reclaimed: {stats['reclaimed']}"
+    msg += f"\n- Wait: p50={stats['wait_p50_ms']:.1f}ms p99={stats['wait_p99_ms']:.1f}ms max={stats['wait_max_ms']:.1f}ms (last 1000 acquires)"
+    msg += f"\n- Replica: {'in use' if bot.read_pool.using_replica else 'not in use'}"
+
+    holds = bot.pool.longest_holds(10)
+    if holds:
+        msg += "\n\n**Longest held**\n" + "\n".join(f"- {h}" for h in holds)
+
+    await ctx.send(msg)
+
+@bot.hybrid_command()
+async def cs_memory(ctx: commands.Context, limit: int = 25):
+    """Shows the (estimated) memory used by each guilds member cache"""
+    usp = await get_user_staff_perms(bot.pool, ctx.author.id)
+
+    if not check(usp, "borealis.csreport"):
+        return await ctx.send("You need ``borealis.csreport`` permission to use this command!")
+
+    usage = sorted(((estimate_guild_memory(g), g) for g in bot.guilds), key=lambda u: u[0], reverse=True)
+
+    msg = f"**Member cache** (policy={bot.config.member_cache_policy}, rss={format_bytes(process_rss() or 0)}, estimated total={format_bytes(sum(u[0] for u in usage))})\n"
+
+    for size, g in usage[:limit]:
+        msg += f"\n- {g.name} ({g.id}): {format_bytes(size)}, {len(g.members)}/{g.member_count} members cached [chunked={g.chunked}]"
+
+        if len(msg) >= 1500:
+            await ctx.send(msg)
+            msg = ""
+
+    if msg:
+        await ctx.send(msg)
+
+@bot.hybrid_command()
+async def cs_jobs(ctx: commands.Context):
+    """Shows the current state of scheduled jobs"""
+    usp = await get_user_staff_perms(bot.pool, ctx.author.id)
+
+    if not check(usp, "borealis.csreport"):
+        return await ctx.send("You need ``borealis.csreport`` permission to use this command!")
+
+    msg = "**Jobs**\n"
+
+    for job in scheduler.jobs.values():
+        msg += f"\n- {job.name}: interval={job.interval:.0f}s (base={job.base_interval:.0f}s), running={job.running}, last_run={job.last_run}, last_drift={job.last_drift}"
+
+    await ctx.send(msg)
+
+@bot.hybrid_command()
+async def cs_select(ctx: commands.Context, guilds: str):
+    """Previews which servers a guild selector expression (e.g. cs&fill<50%&age>30d) matches"""
+    usp = await get_user_staff_perms(bot.pool, ctx.author.id)
+
+    if not check(usp, "borealis.csreport"):
+        return await ctx.send("You need ``borealis.csreport`` permission to use this command!")
+
+    resolved_guilds = await resolve_guilds_from_str(guilds, lambda g: True)
+
+    if not resolved_guilds:
+        return await ctx.send("No servers found")
+
+    msg = f"**{len(resolved_guilds)} servers matched**\n"
+
+    for g in resolved_guilds:
+        msg += f"\n- {g.name} ({g.id}){' [cache server]' if g.id in bot.cache_servers else ''}"
+
+        if len(msg) >= 1500:
+            await ctx.send(msg)
+            msg = ""
+
+    if msg:
+        await ctx.send(msg)
+
+@bot.hybrid_command()
+async def cs_rebalance(
+    ctx: commands.Context,
+    dry_run: bool = True,
+    include_present: bool = commands.parameter(default=False, description="Also move bots that have already joined their cache server (they will be kicked and need to be re-added)"),
+    max_moves: int | None = None
+):
+    """Evens out the number of bots on each cache server"""
+    usp = await get_user_staff_perms(bot.pool, ctx.author.id)
+
+    if not check(usp, "borealis.csbots"):
+        return await ctx.send("You need ``borealis.csbots`` permission to use this command!")
+
+    moves = await plan_rebalance(include_present=include_present, max_moves=max_moves)
+
+    if not moves:
+        return await ctx.send("Cache servers are already balanced")
+
+    msg = f"**{len(moves)} moves planned** ({len([m for m in moves if m.present])} of already joined bots)\n"
+
+    for move in moves:
+        msg += f"\n- {move.bot_id}: {move.from_guild} -> {move.to_guild}{' [joined]' if move.present else ''}"
+
+        if len(msg) >= 1500:
+            await ctx.send(msg)
+            msg = ""
+
+    if msg:
+        await ctx.send(msg)
+
+    if dry_run:
+        return await ctx.send("Dry run, nothing was changed. Rerun with dry_run set to False to apply")
+
+    applied = await apply_rebalance(moves)
+    await ctx.send(f"Moved {len(applied)}/{len(moves)} bots")
+
+@bot.hybrid_command()
+async def cs_actions(ctx: commands.Context, guild_id: int | None = None, target_id: int | None = None, limit: int = 25):
+    """Shows the latest actions Borealis has taken on cache servers"""
+    usp = await get_user_staff_perms(bot.pool, ctx.author.id)
+
+    if not check(usp, "borealis.csreport"):
+        return await ctx.send("You need ``borealis.csreport`` permission to use this command!")
+
+    # Include actions not yet flushed
+    await bot.actions.flush()
+
+    actions = await bot.pool.fetch(
+        "SELECT guild_id, target_id, action, reason, created_at FROM cache_server_actions WHERE ($1::text IS NULL OR guild_id = $1) AND ($2::text IS NULL OR target_id = $2) ORDER BY created_at DESC LIMIT $3",
+        str(guild_id) if guild_id else None,
+        str(target_id) if target_id else None,
+        limit
+    )
+
+    if not actions:
+        return await ctx.send("No actions found")
+
+    msg = "**Actions**\n"
+
+    for a in actions:
+        msg += f"\n- {a['created_at']} {a['action']} guild={a['guild_id']} target={a['target_id']}: {a['reason']}"
+
+        if len(msg) >= 1500:
+            await ctx.send(msg)
+            msg = ""
+
+    if msg:
+        await ctx.send(msg)
+
 @bot.hybrid_command()
 async def kittycat(
     ctx: commands.Context, 
@@ -721,7 +1299,7 @@ async def kittycat(
 ):
     """Returns the resolved permissions of the user"""
     usp = await get_user_staff_perms(bot.pool, user_id or ctx.author.id)
-    resolved = [str(p) for p in usp.resolve()]
+    resolved = [str(p) for p in resolve(usp)]
 
     if only_show_resolved:
         await ctx.send(f"**Resolved**: ``{' | '.join(resolved)}``")
@@ -732,12 +1310,11 @@ async def kittycat(
 async def cs_createreport(ctx: commands.Context, only_file: bool = False):
     """Create report on all cache servers"""
     usp = await get_user_staff_perms(bot.pool, ctx.author.id)
-    resolved = usp.resolve()
 
-    if not has_perm(resolved, Permission.from_str("borealis.csreport")):
+    if not check(usp, "borealis.csreport"):
         return await ctx.send("You need ``borealis.csreport`` permission to use this command!")
 
-    servers = await bot.pool.fetch("SELECT guild_id, bots_role, system_bots_role, logs_channel, staff_role, welcome_channel, invite_code from cache_servers")
+    servers = await bot.read_pool.fetch("SELECT guild_id, bots_role, system_bots_role, logs_channel, staff_role, welcome_channel, invite_code from cache_servers")
 
     msg = "Cache Servers:\n"
 
@@ -764,13 +1341,13 @@ async def cs_createreport(ctx: commands.Context, only_file: bool = False):
         msg += f"\n- {guild.name} ({guild.id})\n{opts_str}"
 
         # Get all bots in cache server
-        bots = await bot.pool.fetch("SELECT bot_id, guild_id, created_at, added from cache_server_bots")
+        bots = await bot.read_pool.fetch("SELECT bot_id, guild_id, created_at, added from cache_server_bots")
 
         msg += "\n\n== Bots =="
 
         for b in bots:
             if b["guild_id"] == str(guild.id):
-                name = await bot.pool.fetchval("SELECT username from internal_user_cache__discord WHERE id = $1", b["bot_id"])
+                name = await bot.read_pool.fetchval("SELECT username from internal_user_cache__discord WHERE id = $1", b["bot_id"])
                 msg += f"\n- {name} [{b['bot_id']}]: {b['created_at']} ({b['added']})"
 
     if len(msg) < 1500 and not only_file:
@@ -793,12 +1370,14 @@ async def get_selected_bots(guild_id: int | str):
                 break
 
             created_at = await bot.pool.fetchval("INSERT INTO cache_server_bots (guild_id, bot_id) VALUES ($1, $2) RETURNING created_at", str(guild_id), b["bot_id"])
+            bot.placements.invalidate(b["bot_id"])
             selected.append({"bot_id": b["bot_id"], "created_at": created_at, "added": 0})
     
     elif len(selected) > MAX_PER_CACHE_SERVER:
         remove_amount = len(selected) - MAX_PER_CACHE_SERVER
         to_remove = selected[:remove_amount]
         await bot.pool.execute("DELETE FROM cache_server_bots WHERE guild_id = $1 AND bot_id = ANY($2)", str(guild_id), [b["bot_id"] for b in to_remove])
+        bot.placements.invalidate(*[b["bot_id"] for b in to_remove])
         selected = selected[remove_amount:]
     
     return selected
@@ -811,54 +1390,46 @@ async def cs_allbots(
 ):
     """Partitions all bots and sends"""
     usp = await get_user_staff_perms(bot.pool, ctx.author.id)
-    resolved = usp.resolve()
 
-    if not has_perm(resolved, Permission.from_str("borealis.csallbots")):
+    if not check(usp, "borealis.csallbots"):
         return await ctx.send("You need ``borealis.csallbots`` permission to use this command!")
 
-    for guild in bot.guilds:
-        # Check if a cache server
-        is_cache_server = await bot.pool.fetchval("SELECT COUNT(*) from cache_servers WHERE guild_id = $1", str(guild.id))
+    async def lines():
+        for guild in bot.guilds:
+            if guild.id not in bot.cache_servers:
+                continue
 
-        if not is_cache_server:
-            continue
-            
-        msg = f"**Cache server: {guild.name} ({guild.id})**"
+            # Check currently selected too, this also fills the selection of the server
+            selected = await get_selected_bots(guild.id)
+
+            if only_not_on_server:
+                shown = [b for b in selected if not guild.get_member(int(b["bot_id"]))]
+            else:
+                shown = selected
 
-        # Check currently selected too
-        selected = await get_selected_bots(guild.id)
+            if not shown and only_unfilled_servers:
+                continue
 
-        msg += "\nSelected bots:\n"
+            bot_ids = [b["bot_id"] for b in shown]
+            names = {r["id"]: r["username"] for r in await bot.read_pool.fetch("SELECT id, username from internal_user_cache__discord WHERE id = ANY($1)", bot_ids)}
+            client_ids = {r["bot_id"]: r["client_id"] for r in await bot.read_pool.fetch("SELECT bot_id, client_id from bots WHERE bot_id = ANY($1)", bot_ids)}
 
-        showing = 0
-        for b in selected:
-            if only_not_on_server:
-                # Check if in server
-                in_server = guild.get_member(int(b["bot_id"]))
-                if in_server:
-                    continue
-            
-            showing += 1
+            yield f"**Cache server: {guild.name} ({guild.id})**"
+            yield "Selected bots:"
 
-            name = await bot.pool.fetchval("SELECT username from internal_user_cache__discord WHERE id = $1", b["bot_id"])
-            client_id = await bot.pool.fetchval("SELECT client_id from bots WHERE bot_id = $1", b["bot_id"])
-            msg += f"\n- {name} [{b['bot_id']}]: https://discord.com/api/oauth2/authorize?client_id={client_id or b['bot_id']}&guild_id={guild.id}&scope=bot ({b['added']}, {b['created_at']})"
+            for b in shown:
+                yield f"- {names.get(b['bot_id'])} [{b['bot_id']}]: https://discord.com/api/oauth2/authorize?client_id={client_ids.get(b['bot_id']) or b['bot_id']}&guild_id={guild.id}&scope=bot ({b['added']}, {b['created_at']})"
 
-            if len(msg) >= 1500:
-                await ctx.send(msg)
-                msg = ""
+            yield f"Total: {len(selected)} bots\nShowing: {len(shown)} bots\n"
 
-        if showing or not only_unfilled_servers:
-            msg += f"\nTotal: {len(selected)} bots\nShowing: {showing} bots"
-            await ctx.send(msg)
+    await LazyPaginator(ctx.author.id, lines(), title="**All bots**").start(ctx)
 
 @bot.hybrid_command()
 async def cs_bots(ctx: commands.Context, only_show_not_on_server: bool = True):
     """Selects 50 bots for a cache server"""
     usp = await get_user_staff_perms(bot.pool, ctx.author.id)
-    resolved = usp.resolve()
 
-    if not has_perm(resolved, Permission.from_str("borealis.csbots")):
+    if not check(usp, "borealis.csbots"):
         return await ctx.send("You need ``borealis.csbots`` permission to use this command!")
 
     # Check if a cache server
@@ -901,17 +1472,16 @@ async def cs_list(
 ):
     """Lists all cache servers, their names, their invites and when they were made"""
     usp = await get_user_staff_perms(bot.pool, ctx.author.id)
-    resolved = usp.resolve()
 
-    if not has_perm(resolved, Permission.from_str("borealis.cslist")):
+    if not check(usp, "borealis.cslist"):
         return await ctx.send("You need ``borealis.cslist`` permission to use this command!")
 
-    servers = await bot.pool.fetch("SELECT guild_id, invite_code, name, created_at from cache_servers")
+    servers = await bot.read_pool.fetch("SELECT guild_id, invite_code, name, created_at from cache_servers")
 
     msg = "Cache Servers:\n"
 
     for s in servers:            
-        bot_count = await bot.pool.fetchval("SELECT COUNT(*) from cache_server_bots WHERE guild_id = $1", s["guild_id"])
+        bot_count = await bot.read_pool.fetchval("SELECT COUNT(*) from cache_server_bots WHERE guild_id = $1", s["guild_id"])
 
         msg += f"\n- {s['guild_id']} ({s['name']}) ({bot_count} bots): [{s['invite_code']}, https://discord.gg/{s['invite_code']}] ({s['created_at']})"
 
@@ -932,9 +1502,8 @@ async def cs_mark_uninvitable(
 ):
     """Marks a bot as uninvitable in the cache server"""
     usp = await get_user_staff_perms(bot.pool, ctx.author.id)
-    resolved = usp.resolve()
 
-    if not has_perm(resolved, Permission.from_str("borealis.csbots")):
+    if not check(usp, "borealis.csbots"):
         return await ctx.send("You need ``borealis.csbots`` permission to use this command!")
 
     # Check if a cache server
@@ -951,6 +1520,7 @@ async def cs_mark_uninvitable(
 
     await bot.pool.execute("UPDATE bots SET cache_server_uninvitable = $1 WHERE bot_id = $2", reason, str(bot_id))
     await bot.pool.execute("DELETE FROM cache_server_bots WHERE bot_id = $1", str(bot_id))
+    bot.placements.invalidate(str(bot_id))
     await ctx.send("Bot marked as uninvitable")
 
 @bot.hybrid_command()
@@ -960,9 +1530,8 @@ async def cs_unmark_uninvitable(
 ):
     """Unmarks a bot as uninvitable"""
     usp = await get_user_staff_perms(bot.pool, ctx.author.id)
-    resolved = usp.resolve()
 
-    if not has_perm(resolved, Permission.from_str("borealis.csbots")):
+    if not check(usp, "borealis.csbots"):
         return await ctx.send("You need ``borealis.csbots`` permission to use this command!")
 
     # Check if a cache server
@@ -980,44 +1549,34 @@ async def cs_list_uninvitable(
     only_show_for_guild: bool = False
 ):
     """Shows a list of all bots marked as uninvitable with their reason"""
+    cache_server = None
     if only_show_for_guild:
-        is_cache_server = await bot.pool.fetchval("SELECT COUNT(*) from cache_servers WHERE guild_id = $1", str(ctx.guild.id))
+        cache_server = await bot.read_pool.fetchrow("SELECT guild_id, invite_code, name from cache_servers WHERE guild_id = $1", str(ctx.guild.id))
 
-        if not is_cache_server:
+        if not cache_server:
             return await ctx.send("This server is not a cache server")
 
-        bots = await bot.pool.fetch("SELECT bot_id, cache_server_uninvitable from bots WHERE guild_id = $1 AND cache_server_uninvitable IS NOT NULL", str(ctx.guild.id))
-        message = "Uninvitable bots for this server:\n"
-
-        for b in bots:
-            name = await bot.pool.fetchval("SELECT username from internal_user_cache__discord WHERE id = $1", b["bot_id"])
-            cache_server = await bot.pool.fetchrow("SELECT guild_id, invite_code, name from cache_servers WHERE guild_id = $1", str(ctx.guild.id))
-            message += f"\n- {name} [{b['bot_id']}]: {b['cache_server_uninvitable']} [{cache_server['guild_id']}, {cache_server['name']}, {cache_server['invite_code']}]"
+    async def lines():
+        # Names are looked up a page at a time rather than per bot
+        page_size = 25
 
-            if len(message) >= 1500:
-                await ctx.send(message)
-                message = ""
-        
-        if message:
-            await ctx.send(message)
-        
-        return
-
-    # Show all
-    bots = await bot.pool.fetch("SELECT bot_id, cache_server_uninvitable from bots WHERE cache_server_uninvitable IS NOT NULL")
+        if cache_server:
+            bots = await bot.read_pool.fetch("SELECT bot_id, cache_server_uninvitable from bots WHERE guild_id = $1 AND cache_server_uninvitable IS NOT NULL", str(ctx.guild.id))
+        else:
+            bots = await bot.read_pool.fetch("SELECT bot_id, cache_server_uninvitable from bots WHERE cache_server_uninvitable IS NOT NULL")
 
-    message = "Uninvitable bots:\n"
+        for i in range(0, len(bots), page_size):
+            chunk = bots[i:i + page_size]
+            names = {r["id"]: r["username"] for r in await bot.read_pool.fetch("SELECT id, username from internal_user_cache__discord WHERE id = ANY($1)", [b["bot_id"] for b in chunk])}
 
-    for b in bots:
-        name = await bot.pool.fetchval("SELECT username from internal_user_cache__discord WHERE id = $1", b["bot_id"])
-        message += f"\n- {name} [{b['bot_id']}]: {b['cache_server_uninvitable']}"
+            for b in chunk:
+                if cache_server:
+                    yield f"- {names.get(b['bot_id'])} [{b['bot_id']}]: {b['cache_server_uninvitable']} [{cache_server['guild_id']}, {cache_server['name']}, {cache_server['invite_code']}]"
+                else:
+                    yield f"- {names.get(b['bot_id'])} [{b['bot_id']}]: {b['cache_server_uninvitable']}"
 
-        if len(message) >= 1500:
-            await ctx.send(message)
-            message = ""
-        
-    if message:
-        await ctx.send(message)
+    title = "**Uninvitable bots for this server**" if cache_server else "**Uninvitable bots**"
+    await LazyPaginator(ctx.author.id, lines(), title=title).start(ctx)
 
 @bot.hybrid_command()
 async def make_cache_server(
@@ -1026,9 +1585,8 @@ async def make_cache_server(
 ):
     """Creates a cache server"""
     usp = await get_user_staff_perms(bot.pool, ctx.author.id)
-    resolved = usp.resolve()
 
-    if not has_perm(resolved, Permission.from_str("borealis.make_cache_servers")):
+    if not check(usp, "borealis.make_cache_servers"):
         return await ctx.send("You need ``borealis.make_cache_servers`` permission to use this command!")
 
     existing = await bot.pool.fetchval("SELECT COUNT(*) from cache_servers WHERE guild_id = $1", str(ctx.guild.id))
@@ -1063,7 +1621,7 @@ async def make_cache_server(
             return await ctx.send(f"Failed to create unprovisioned cache server: {e}")
         await ctx.send("Provisioned new server")
     else:
-        if ctx.guild.id in bot.config.pinned_servers:
+        if ctx.guild.id in bot.indexes.pinned_servers:
             return await ctx.send("This server is a pinned server and cannot be converted to a cache server")
 
         if str(ctx.guild.owner_id) != oauth_md["owner_id"]:
@@ -1102,9 +1660,8 @@ async def cs_delete(
 ):
     """Deletes a cache server"""
     usp = await get_user_staff_perms(bot.pool, ctx.author.id)
-    resolved = usp.resolve()
 
-    if not has_perm(resolved, Permission.from_str("borealis.cs_delete")):
+    if not check(usp, "borealis.cs_delete"):
         return await ctx.send("You need ``borealis.cs_delete`` permission to use this command!")
 
     cs_data = await bot.pool.fetchrow("SELECT COUNT(*) from cache_servers WHERE guild_id = $1", guild_id or str(ctx.guild.id))
@@ -1113,6 +1670,10 @@ async def cs_delete(
         return await ctx.send("Specified server is not a cache server")
 
     await bot.pool.execute("DELETE FROM cache_servers WHERE guild_id = $1", guild_id or str(ctx.guild.id))
+    bot.actions.record(guild_id or ctx.guild.id, "delete_cache_server", reason=f"cs_delete by {ctx.author.id}")
+    bot.placements.invalidate_guild(guild_id or ctx.guild.id)
+    bot.cache_servers.pop(guild_id or ctx.guild.id, None)
+    bot.lifecycle.forget(guild_id or ctx.guild.id)
     await ctx.send("Cache server deleted")
     
     if guild_id:
@@ -1134,7 +1695,7 @@ async def cs_leave(
     """Leaves cache server(s)"""
     try:
         usp = await get_user_staff_perms(bot.pool, ctx.author.id)
-        resolved = usp.resolve()
+        resolved = resolve(usp)
     except:
         usp = StaffPermissions(user_positions=[], perm_overrides=[])
         resolved = []
@@ -1143,7 +1704,7 @@ async def cs_leave(
         return await ctx.send("User is not a staff member")
 
     if user:
-        if not has_perm(resolved, Permission.from_str("borealis.cs_leave_other")):
+        if not check(usp, "borealis.cs_leave_other"):
             return await ctx.send("You need ``borealis.cs_leave_other`` permission to remove other people from cache servers!")
 
         # Check if member has lower index than us, if so then error
@@ -1175,7 +1736,7 @@ async def cs_leave(
 
     user = user if user else ctx.author
     for g in resolved_guilds:
-        if g.id in bot.config.pinned_servers:
+        if g.id in bot.indexes.pinned_servers:
             continue
 
         member = g.get_member(user.id)
@@ -1194,6 +1755,7 @@ async def cs_leave(
             await member.ban(reason=f"cs_leave: {reason}")
         else:
             await member.kick(reason=f"cs_leave: {reason}")
+        bot.actions.record(g.id, "ban" if ban_user else "kick", member.id, f"cs_leave by {ctx.author.id}: {reason}")
             
         await ctx.send(f"Successfully {'banned' if ban_user else 'kicked'} {user.id} ({user.name}) from {g.id} ({g.name})")
         await asyncio.sleep(5)
@@ -1208,7 +1770,7 @@ async def cs_migrate(
     """Apply migrations to cache servers"""
     try:
         usp = await get_user_staff_perms(bot.pool, ctx.author.id)
-        resolved = usp.resolve()
+        resolved = resolve(usp)
     except:
         usp = StaffPermissions(user_positions=[], perm_overrides=[])
         resolved = []
@@ -1216,15 +1778,15 @@ async def cs_migrate(
     if not resolved:
         return await ctx.send("User is not a staff member")
 
-    if not has_perm(resolved, Permission.from_str("service_account.marker")):
+    if not check(usp, "service_account.marker"):
         return await ctx.send("You need ``service_account.marker`` permission to perform migrations!")
 
-    guilds_split = []
+    from migrations import MIGRATION_LIST, Migration
+
+    selected_ids = set()
 
     if guilds != "all":
-        guilds_split = guilds.split(",")
-        for i in range(len(guilds_split)):
-            guilds_split[i] = guilds_split[i].strip()
+        selected_ids = {g.id for g in await resolve_guilds_from_str(guilds, lambda g: True)}
 
     for migration in MIGRATION_LIST:
         migration_cls: Migration = migration(
@@ -1249,7 +1811,7 @@ async def cs_migrate(
             if not guild:
                 continue
 
-            if guilds != "all" and str(guild.id) not in guilds_split:
+            if guilds != "all" and guild.id not in selected_ids:
                 continue
             
             current_migration_data = await bot.pool.fetchrow("SELECT state from cache_server_migrations WHERE guild_id = $1 AND migration_id = $2", str(guild.id), migration_cls.id())
@@ -1292,7 +1854,7 @@ async def cs_migration_rollback(
     """Rollback a database migration"""
     try:
         usp = await get_user_staff_perms(bot.pool, ctx.author.id)
-        resolved = usp.resolve()
+        resolved = resolve(usp)
     except:
         usp = StaffPermissions(user_positions=[], perm_overrides=[])
         resolved = []
@@ -1300,9 +1862,10 @@ async def cs_migration_rollback(
     if not resolved:
         return await ctx.send("User is not a staff member")
 
-    if not has_perm(resolved, Permission.from_str("service_account.marker")):
+    if not check(usp, "service_account.marker"):
         return await ctx.send("You need ``service_account.marker`` permission to perform migrations!")
 
+    from migrations import MIGRATION_LIST, Migration
 
     migration_cls: Migration | None = None
     for migration in MIGRATION_LIST:
@@ -1319,12 +1882,10 @@ async def cs_migration_rollback(
 
     await bot.pool.execute("DELETE FROM cache_server_migrations_done WHERE migration_id = $1", migration_id)
 
-    guilds_split = []
+    selected_ids = set()
 
     if guilds != "all":
-        guilds_split = guilds.split(",")
-        for i in range(len(guilds_split)):
-            guilds_split[i] = guilds_split[i].strip()
+        selected_ids = {g.id for g in await resolve_guilds_from_str(guilds, lambda g: True)}
 
     cache_servers = await bot.pool.fetch("SELECT guild_id from cache_servers")
 
@@ -1334,7 +1895,7 @@ async def cs_migration_rollback(
         if not guild:
             continue
 
-        if guilds != "all" and str(guild.id) not in guilds_split:
+        if guilds != "all" and guild.id not in selected_ids:
             continue
 
         #mig_entry = await bot.pool.fetchrow("SELECT state from cache_server_migrations WHERE guild_id = $1 AND migration_id = $2", str(cs["guild_id"]), migration_id)
@@ -1363,41 +1924,35 @@ async def cs_oauth_list(
     """Lists all oauth2s configured for cache servers"""
     try:
         usp = await get_user_staff_perms(bot.pool, ctx.author.id)
-        resolved = usp.resolve()
+        resolved = resolve(usp)
     except:
         resolved = []
     
     if not resolved:
         return await ctx.send("User is not a staff member")
 
-    oauths = await bot.pool.fetch("SELECT user_id, bot from cache_server_oauths")   
-    oauth_md = await bot.pool.fetchrow("SELECT owner_id from cache_server_oauth_md")
+    async def lines():
+        oauths = await bot.read_pool.fetch("SELECT user_id, bot from cache_server_oauths")
+        oauth_md = await bot.read_pool.fetchrow("SELECT owner_id from cache_server_oauth_md")
 
-    msg = "OAuths:\n"
-
-    for o in oauths:
-        try:
-            usp = await get_user_staff_perms(bot.pool, int(o["user_id"]))
-            resolved = usp.resolve()
-        except:
-            resolved = []
+        if oauth_md:
+            yield f"Metadata:\n- Currently selected cache server owner: {oauth_md['owner_id']} (<@{oauth_md['owner_id']}>)\n"
 
-        service_account = has_perm(resolved, Permission.from_str("service_account.marker"))
+        yield "OAuths:"
 
-        user = bot.get_user(int(o["user_id"]))
+        for o in oauths:
+            try:
+                usp = await get_user_staff_perms(bot.pool, int(o["user_id"]))
+            except:
+                usp = StaffPermissions(user_positions=[], perm_overrides=[])
 
-        msg += f"\n- {o['user_id']} [{user}] (bot={o['bot']}, service_account={service_account})"
+            service_account = check(usp, "service_account.marker")
 
-        if len(msg) >= 1500:
-            await ctx.send(msg)
-            msg = ""
+            user = bot.get_user(int(o["user_id"]))
 
-    if msg:
-        await ctx.send(msg)
+            yield f"- {o['user_id']} [{user}] (bot={o['bot']}, service_account={service_account})"
 
-    if oauth_md:
-        msg = f"Metadata:\n- Currently selected cache server owner: {oauth_md['owner_id']} (<@{oauth_md['owner_id']}>)"
-        await ctx.send(msg)
+    await LazyPaginator(ctx.author.id, lines(), title="**Cache server OAuths**").start(ctx)
 
 @bot.hybrid_command()
 async def cs_oauth_add(
@@ -1406,14 +1961,14 @@ async def cs_oauth_add(
     """Sets up oauth2 for a user"""
     try:
         usp = await get_user_staff_perms(bot.pool, ctx.author.id)
-        resolved = usp.resolve()
+        resolved = resolve(usp)
     except:
         resolved = []
     
     if not resolved:
         return await ctx.send("User is not a staff member")
 
-    await ctx.send(f"Visit {config.base_url}/oauth2 to continue. Note that you may need to authorize yourself twice in a row through Discord (so don't get confused), once for Borealis and a second time for Doxycycline (if you have permission such as Human Resources etc)")    
+    await ctx.send(f"Visit {bot.config.base_url}/oauth2 to continue. Note that you may need to authorize yourself twice in a row through Discord (so don't get confused), once for Borealis and a second time for Doxycycline (if you have permission such as Human Resources etc)")    
 
 @bot.hybrid_command()
 async def cs_oauth_join(
@@ -1423,7 +1978,7 @@ async def cs_oauth_join(
     """Joins cache server(s) bypassing typical invite flow."""
     try:
         usp = await get_user_staff_perms(bot.pool, ctx.author.id)
-        resolved = usp.resolve()
+        resolved = resolve(usp)
     except:
         resolved = []
     
@@ -1449,7 +2004,7 @@ async def cs_oauth_join(
             data = {
                 "access_token": oauth_data["access_token"],
             }
-            async with session.put(f"https://discord.com/api/v9/guilds/{g.id}/members/{ctx.author.id}", headers={"Authorization": f"Bot {config.token}"}, json=data) as resp:
+            async with session.put(f"https://discord.com/api/v9/guilds/{g.id}/members/{ctx.author.id}", headers={"Authorization": f"Bot {bot.config.token}"}, json=data) as resp:
                 if not resp.ok:
                     err = await resp.json()
                     await ctx.send(f"Failed to join {g}: {err}")
@@ -1469,10 +2024,9 @@ async def cs_oauth_mdset(
 ):
     """Sets a user as a service account or not"""
     usp = await get_user_staff_perms(bot.pool, ctx.author.id)
-    resolved = usp.resolve()
 
     # We use borealis_mgmt to ensure Human Resources etc cannot use metadata commands
-    if not has_perm(resolved, Permission.from_str("borealis_mgmt.cs_oauth_mdset")):
+    if not check(usp, "borealis_mgmt.cs_oauth_mdset"):
         return await ctx.send("You need ``borealis_mgmt.cs_oauth_mdset`` permission to use this command!")
 
     oauth_v = await bot.pool.fetchval("SELECT user_id from cache_server_oauths WHERE user_id = $1", owner_id)
@@ -1496,12 +2050,11 @@ async def nuke_from_main_server(
 ):
     """Nukes a server from the main server"""
     usp = await get_user_staff_perms(bot.pool, ctx.author.id)
-    resolved = usp.resolve()
 
-    if not has_perm(resolved, Permission.from_str("borealis.nuke_from_main_server")):
+    if not check(usp, "borealis.nuke_from_main_server"):
         return await ctx.send("You need ``borealis.nuke_from_main_server`` permission to use this command!")
 
-    if guild_id not in config.pinned_servers:
+    if guild_id not in bot.indexes.pinned_servers:
         return await ctx.send("Guild is not a pinned server. Must be temporarily pinned to nuke")
 
     guild = bot.get_guild(guild_id)
@@ -1509,81 +2062,135 @@ async def nuke_from_main_server(
     if not guild:
         return await ctx.send("Guild not found")
     
-    bots_to_nuke = await bot.pool.fetch("SELECT bot_id, type, premium from bots WHERE type != 'certified' AND premium = false")
-    
-    class KickAskView(discord.ui.View):
-        def __init__(self, member: discord.Member):
-            super().__init__(timeout=1000)    
-            self.done = False
-            self.member = member
-        
-        @discord.ui.button(label="Kick", style=discord.ButtonStyle.danger, custom_id="kick")
-        async def kick(self, interaction: discord.Interaction, button: discord.ui.Button,):
-            await interaction.response.send_message(f"Kicking {self.member} ({self.member.id})", ephemeral=False)
-            await guild.kick(self.member)
-            self.done = True
-            self.stop()
-        
-        @discord.ui.button(label="Ignore", style=discord.ButtonStyle.secondary, custom_id="nothing")
-        async def nothing(self, interaction: discord.Interaction, button: discord.ui.Button):
-            await interaction.response.send_message(f"Ignoring {self.member} ({self.member.id})", ephemeral=False)
-            self.done = True
-            self.stop()
+    await ensure_chunked(guild)
 
-    for b in bots_to_nuke:
-        bot_obj = guild.get_member(int(b["bot_id"]))
+    # Classify every bot in the guild at once
+    members = {m.id: m for m in guild.members if m.bot and m.id != ctx.me.id}
+    rows = await bot.pool.fetch(
+        """
+        SELECT m.id, b.type, b.premium, EXISTS (SELECT 1 FROM bot_whitelist w WHERE w.bot_id = m.id) AS whitelisted
+        FROM unnest($1::text[]) AS m(id)
+        LEFT JOIN bots b ON b.bot_id = m.id
+        """,
+        [str(m) for m in members]
+    )
 
-        if not bot_obj:
+    candidates: list[tuple[discord.Member, str]] = []
+    skipped = 0
+    for row in rows:
+        if row["whitelisted"] or row["type"] == "certified" or row["premium"]:
+            skipped += 1
             continue
 
-        whitelist_entry = await bot.pool.fetchval("SELECT COUNT(*) from bot_whitelist WHERE bot_id = $1", str(bot_obj.id))
+        label = f"type={row['type']}, premium={row['premium']}" if row["type"] is not None else "not on db"
+        candidates.append((members[int(row["id"])], label))
+
+    if not candidates:
+        return await ctx.send(f"No bots to kick ({skipped} whitelisted, certified or premium bots skipped)")
+
+    page_size = 25 # Most options a select can have
+
+    class NukeReviewView(discord.ui.View):
+        def __init__(self):
+            super().__init__(timeout=1000)
+            self.page = 0
+            self.pages = (len(candidates) + page_size - 1) // page_size
+            self.selected: set[int] = set()
+            self.confirmed = False
+            self.select: discord.ui.Select | None = None
+            self._build_select()
+
+        def _page_candidates(self):
+            return candidates[self.page * page_size:(self.page + 1) * page_size]
+
+        def _build_select(self):
+            if self.select:
+                self.remove_item(self.select)
+
+            page = self._page_candidates()
+            self.select = discord.ui.Select(
+                placeholder=f"Bots to kick (page {self.page + 1}/{self.pages})",
+                min_values=0,
+                max_values=len(page),
+                options=[
+                    discord.SelectOption(label=f"{m.name}"[:100], value=str(m.id), description=f"{m.id} [{label}]"[:100], default=m.id in self.selected)
+                    for m, label in page
+                ],
+                row=0
+            )
+            self.select.callback = self.on_select
+            self.add_item(self.select)
 
-        if whitelist_entry or bot_obj.id == ctx.me.id:
-            await ctx.send(f"Skipping {bot_obj.name} ({bot_obj.id})")
-            continue # Ignore
+        def content(self) -> str:
+            return f"Select the bots to kick from {guild.name} ({len(candidates)} candidates, {skipped} whitelisted, certified or premium bots skipped). {len(self.selected)} selected"
 
-        # Ask with a component
-        view = KickAskView(bot_obj)
+        async def interaction_check(self, interaction: discord.Interaction) -> bool:
+            return interaction.user.id == ctx.author.id
 
-        random_emoji = secrets.choice(guild.emojis)
+        async def on_select(self, interaction: discord.Interaction):
+            self.selected -= {m.id for m, _ in self._page_candidates()}
+            self.selected |= {int(v) for v in self.select.values}
+            await interaction.response.edit_message(content=self.content(), view=self)
 
-        await ctx.send(f"Should I kick {bot_obj.name} ({bot_obj.id}) [type={b['type']}, premium={b['premium']}]? {random_emoji}", view=view)
-        await view.wait()
+        async def _go(self, interaction: discord.Interaction, page: int):
+            self.page = max(0, min(page, self.pages - 1))
+            self._build_select()
+            await interaction.response.edit_message(content=self.content(), view=self)
 
-        if not view.done:
-            return await ctx.send("Timed out")
-    
-    await ctx.send("Done from db")
+        @discord.ui.button(label="Previous", style=discord.ButtonStyle.secondary, row=1)
+        async def previous(self, interaction: discord.Interaction, button: discord.ui.Button):
+            await self._go(interaction, self.page - 1)
 
-    for bot_obj in guild.members:
-        if not bot_obj:
-            continue
+        @discord.ui.button(label="Next", style=discord.ButtonStyle.secondary, row=1)
+        async def next(self, interaction: discord.Interaction, button: discord.ui.Button):
+            await self._go(interaction, self.page + 1)
 
-        whitelist_entry = await bot.pool.fetchval("SELECT COUNT(*) from bot_whitelist WHERE bot_id = $1", str(bot_obj.id))
+        @discord.ui.button(label="Kick selected", style=discord.ButtonStyle.danger, row=1)
+        async def kick(self, interaction: discord.Interaction, button: discord.ui.Button):
+            self.confirmed = True
+            await interaction.response.edit_message(content=f"Kicking {len(self.selected)} bots", view=None)
+            self.stop()
 
-        if whitelist_entry or bot_obj.id == ctx.me.id:
-            continue
+        @discord.ui.button(label="Cancel", style=discord.ButtonStyle.secondary, row=1)
+        async def cancel(self, interaction: discord.Interaction, button: discord.ui.Button):
+            await interaction.response.edit_message(content="Cancelled", view=None)
+            self.stop()
 
-        if not bot_obj.bot:
-            continue
+    view = NukeReviewView()
+    await ctx.send(view.content(), view=view)
 
-        # Ensure its not premium or certified
-        typ = await bot.pool.fetchrow("SELECT type, premium from bots WHERE bot_id = $1", str(bot_obj.id))
+    if await view.wait():
+        return await ctx.send("Timed out")
 
-        if typ and (typ["type"] in ["certified"] or typ["premium"]):
-            continue
+    if not view.confirmed or not view.selected:
+        return
 
-        # Ask with a component
-        view = KickAskView(bot_obj)
+    sem = asyncio.Semaphore(5)
+    failed = []
 
-        random_emoji = secrets.choice(guild.emojis)
+    async def kick(member: discord.Member):
+        async with sem:
+            try:
+                await guild.kick(member, reason=f"nuke_from_main_server by {ctx.author.id}")
+                bot.actions.record(guild.id, "kick", member.id, f"nuke_from_main_server by {ctx.author.id}")
+            except discord.HTTPException as exc:
+                failed.append(f"{member} ({member.id}): {exc}")
 
-        await ctx.send(f"Should I kick {bot_obj.name} ({bot_obj.id}) [not on db]? {random_emoji}", view=view)
-        await view.wait()
+    await asyncio.gather(*[kick(members[bot_id]) for bot_id in view.selected])
 
-        if not view.done:
-            return await ctx.send("Timed out")
+    await ctx.send(f"Kicked {len(view.selected) - len(failed)}/{len(view.selected)} bots")
+
+    if failed:
+        await ctx.send("Failed to kick:\n" + "\n".join(f"- {f}" for f in failed)[:1900])
 
 if __name__ == "__main__":
     loop = asyncio.get_event_loop()
-    loop.run_until_complete(bot.run())
+
+    # docker stop and systemd send SIGTERM, which would otherwise exit without running any cleanup
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, lambda: asyncio.ensure_future(close_clients()))
+
+    try:
+        loop.run_until_complete(bot.run())
+    finally:
+        loop.run_until_complete(persist_on_shutdown())
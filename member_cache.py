@@ -0,0 +1,69 @@
+import discord
+import sys
+
+def bot_intents(policy: str) -> discord.Intents:
+    """
+    Intents for Borealis itself
+
+    With the 'targeted' policy, presences are not received (they are never used) and guilds
+    are not chunked at startup, see should_chunk for which guilds are chunked instead
+    """
+    if policy == "all":
+        return discord.Intents.all()
+
+    intents = discord.Intents.default()
+    intents.members = True
+    intents.message_content = True
+    return intents
+
+def server_maker_intents() -> discord.Intents:
+    """
+    Intents for the cache server maker, which only creates, deletes and leaves guilds
+
+    members is needed for guild.fetch_members, nothing is ever cached from it
+    """
+    return discord.Intents(guilds=True, members=True)
+
+def should_chunk(guild: discord.Guild, cache_server_ids: set[int] | dict, main_server: int) -> bool:
+    """Whether a guild should be fully chunked up front, other guilds are chunked when something needs their members"""
+    return guild.id in cache_server_ids or guild.id == main_server
+
+async def ensure_chunked(guild: discord.Guild):
+    """Chunks a guild if it has not been already"""
+    if not guild.chunked:
+        await guild.chunk(cache=True)
+
+def estimate_guild_memory(guild: discord.Guild) -> int:
+    """Roughly estimates the memory (in bytes) used by a guilds cached members, roles and channels"""
+    size = sys.getsizeof(guild)
+
+    for member in guild.members:
+        size += sys.getsizeof(member) + sys.getsizeof(member._user) + sys.getsizeof(member._roles)
+
+    for role in guild.roles:
+        size += sys.getsizeof(role)
+
+    for channel in guild.channels:
+        size += sys.getsizeof(channel)
+
+    return size
+
+def process_rss() -> int | None:
+    """Returns the resident set size of this process in bytes, if it can be found"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    return None
+
+def format_bytes(size: int) -> str:
+    for unit in ["B", "KiB", "MiB"]:
+        if size < 1024:
+            return f"{size:.1f}{unit}"
+        size /= 1024
+
+    return f"{size:.1f}GiB"
@@ -0,0 +1,112 @@
+import asyncpg
+import asyncio
+import datetime
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+
+def _now() -> datetime.datetime:
+    # Aware, as created_at comes back from the timestamptz column as an aware datetime
+    return datetime.datetime.now(tz=datetime.timezone.utc)
+
+class StateStore(ABC):
+    """Stores pending OAuth2 states as (created_at, bot) pairs"""
+    def __init__(self, ttl: datetime.timedelta = datetime.timedelta(seconds=60)):
+        self.ttl = ttl
+
+    @abstractmethod
+    async def get(self, state: str) -> tuple[datetime.datetime, str] | None:
+        ...
+
+    @abstractmethod
+    async def set(self, state: str, bot: str):
+        ...
+
+    @abstractmethod
+    async def delete(self, state: str):
+        ...
+
+    @abstractmethod
+    async def sweep(self) -> int:
+        """Removes all expired states, returning how many were removed"""
+
+    def expired(self, created_at: datetime.datetime) -> bool:
+        return _now() - created_at > self.ttl
+
+    async def sweep_forever(self, interval: int = 30):
+        while True:
+            await asyncio.sleep(interval)
+
+            try:
+                await self.sweep()
+            except Exception as exc:
+                print(f"StateStore: Failed to sweep expired states: {exc}")
+
+class MemoryStateStore(StateStore):
+    """In-memory state store for a single API process, evicting the oldest states past max_size"""
+    def __init__(self, ttl: datetime.timedelta = datetime.timedelta(seconds=60), max_size: int = 1000):
+        super().__init__(ttl)
+        self.max_size = max_size
+        self._states: OrderedDict[str, tuple[datetime.datetime, str]] = OrderedDict()
+
+    async def get(self, state: str):
+        return self._states.get(state)
+
+    async def set(self, state: str, bot: str):
+        self._states.pop(state, None)
+        self._states[state] = (_now(), bot)
+
+        while len(self._states) > self.max_size:
+            self._states.popitem(last=False)
+
+    async def delete(self, state: str):
+        self._states.pop(state, None)
+
+    async def sweep(self):
+        # States are kept in insertion order so expired ones are always at the front
+        removed = 0
+        while self._states:
+            state, (created_at, _) = next(iter(self._states.items()))
+
+            if not self.expired(created_at):
+                break
+
+            del self._states[state]
+            removed += 1
+
+        return removed
+
+class PostgresStateStore(StateStore):
+    """State store backed by the cache_server_oauth_states table, shared between API processes"""
+    def __init__(self, pool: asyncpg.Pool, ttl: datetime.timedelta = datetime.timedelta(seconds=60), max_size: int = 1000):
+        super().__init__(ttl)
+        self.pool = pool
+        self.max_size = max_size
+
+    async def get(self, state: str):
+        row = await self.pool.fetchrow("SELECT created_at, bot FROM cache_server_oauth_states WHERE state = $1", state)
+
+        if not row:
+            return None
+
+        return (row["created_at"], row["bot"])
+
+    async def set(self, state: str, bot: str):
+        await self.pool.execute("INSERT INTO cache_server_oauth_states (state, bot, created_at) VALUES ($1, $2, $3) ON CONFLICT (state) DO UPDATE SET bot = $2, created_at = $3", state, bot, _now())
+
+    async def delete(self, state: str):
+        await self.pool.execute("DELETE FROM cache_server_oauth_states WHERE state = $1", state)
+
+    async def sweep(self):
+        removed = await self.pool.fetchval(
+            """
+            WITH removed AS (
+                DELETE FROM cache_server_oauth_states WHERE created_at < $1 OR state NOT IN (
+                    SELECT state FROM cache_server_oauth_states ORDER BY created_at DESC LIMIT $2
+                ) RETURNING 1
+            ) SELECT COUNT(*) FROM removed
+            """,
+            _now() - self.ttl,
+            self.max_size
+        )
+
+        return removed
@@ -0,0 +1,117 @@
+import asyncio
+import discord
+from discord.ext import commands
+from typing import AsyncIterator
+
+class LazyPaginator(discord.ui.View):
+    """
+    Shows lines from an async iterator as pages of one message, edited in place
+
+    Lines are only pulled from the iterator when a page that needs them is requested, and
+    rendered pages are kept so going back never queries again. Only the invoking user can page
+    """
+    def __init__(self, author_id: int, lines: AsyncIterator[str], title: str = "", page_size: int = 1900, timeout: float = 600):
+        super().__init__(timeout=timeout)
+        self.author_id = author_id
+        self.lines = lines
+        self.title = title
+        self.page_size = page_size
+        self.pages: list[str] = []
+        self.page = 0
+        self.exhausted = False
+        self.message: discord.Message | None = None
+        self._next_line: str | None = None # Line that did not fit on the previous page
+        self._render_lock = asyncio.Lock() # The iterator cannot be pulled from by two clicks at once
+
+    async def _pull(self) -> str | None:
+        if self._next_line is not None:
+            line, self._next_line = self._next_line, None
+            return line
+
+        try:
+            line = await self.lines.__anext__()
+        except StopAsyncIteration:
+            self.exhausted = True
+            return None
+
+        # A single line may never be larger than a page
+        return line[:self.page_size]
+
+    async def _render_until(self, index: int):
+        """Renders pages until index exists or there is nothing left"""
+        async with self._render_lock:
+            await self._render_locked(index)
+
+    async def _render_locked(self, index: int):
+        while len(self.pages) <= index and not self.exhausted:
+            page = ""
+
+            while True:
+                line = await self._pull()
+
+                if line is None:
+                    break
+
+                if page and len(page) + len(line) + 1 > self.page_size:
+                    self._next_line = line
+                    break
+
+                page += line + "\n"
+
+            if page:
+                self.pages.append(page)
+
+    def _content(self) -> str:
+        if not self.pages:
+            return f"{self.title}\nNothing to show" if self.title else "Nothing to show"
+
+        total = len(self.pages) if self.exhausted else f"{len(self.pages)}+"
+        header = f"{self.title} (page {self.page + 1}/{total})" if self.title else f"Page {self.page + 1}/{total}"
+        return f"{header}\n{self.pages[self.page]}"
+
+    def _update_buttons(self):
+        self.previous.disabled = self.page == 0
+        self.next.disabled = self.exhausted and self.page >= len(self.pages) - 1
+
+    async def start(self, ctx: commands.Context):
+        await self._render_until(0)
+        self._update_buttons()
+        self.message = await ctx.send(self._content(), view=self, suppress_embeds=True)
+
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        if interaction.user.id != self.author_id:
+            await interaction.response.send_message("Only the user who ran this command can change pages", ephemeral=True)
+            return False
+
+        return True
+
+    async def _show(self, interaction: discord.Interaction, page: int):
+        await interaction.response.defer()
+        await self._render_until(page)
+        self.page = min(page, max(len(self.pages) - 1, 0))
+        self._update_buttons()
+        await interaction.edit_original_response(content=self._content(), view=self)
+
+    @discord.ui.button(label="Previous", style=discord.ButtonStyle.secondary)
+    async def previous(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self._show(interaction, self.page - 1)
+
+    @discord.ui.button(label="Next", style=discord.ButtonStyle.primary)
+    async def next(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self._show(interaction, self.page + 1)
+
+    @discord.ui.button(label="Close", style=discord.ButtonStyle.danger)
+    async def close(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await interaction.response.defer()
+        await self.on_timeout()
+        self.stop()
+
+    async def on_timeout(self):
+        for item in self.children:
+            item.disabled = True
+
+        if self.message:
+            try:
+                await self.message.edit(view=self)
+            except discord.HTTPException:
+                pass
@@ -1,8 +1,83 @@
 import asyncpg
-from kittycat import PartialStaffPosition, StaffPermissions, Permission
+import asyncio
+import queries
+from kittycat import PartialStaffPosition, StaffPermissions, Permission, has_perm
+
+# Preloaded staff_positions, keyed by position id. None until load_staff_positions is called
+_positions: dict[str, PartialStaffPosition] | None = None
+_fingerprint: dict[str, tuple[int, tuple[str, ...]]] | None = None
+
+# Memoized resolutions and checks, keyed by (sorted position ids, sorted overrides).
+# Most staff share a few combinations of positions, so these stay small. Cleared whenever staff positions change
+_resolved: dict[tuple, list[Permission]] = {}
+_checks: dict[tuple, bool] = {}
+
+async def load_staff_positions(pool: asyncpg.Pool) -> bool:
+    """
+    Loads (or reloads) all staff positions so get_user_staff_perms does not need to query them
+
+    Returns whether the positions changed since the last load, in which case the memoized resolutions are dropped
+    """
+    global _positions, _fingerprint
+
+    rows = await pool.fetch("SELECT id::text, index, perms FROM staff_positions")
+
+    fingerprint = {row["id"]: (row["index"], tuple(sorted(row["perms"]))) for row in rows}
+
+    if fingerprint == _fingerprint:
+        return False
+
+    _positions = {
+        row["id"]: PartialStaffPosition(
+            id=row["id"],
+            index=row["index"],
+            perms=Permission.from_str_list(row["perms"])
+        )
+        for row in rows
+    }
+    _fingerprint = fingerprint
+    _resolved.clear()
+    _checks.clear()
+    return True
+
+async def refresh_staff_positions_forever(pool: asyncpg.Pool, interval: float = 60):
+    """Keeps staff positions (and so the memoized checks) fresh, for processes without the bots refresh task"""
+    while True:
+        try:
+            await load_staff_positions(pool)
+        except Exception as exc:
+            print(f"refresh_staff_positions_forever: Failed to load staff positions: {exc}")
+
+        await asyncio.sleep(interval)
+
+def _key(usp: StaffPermissions) -> tuple:
+    return (
+        tuple(sorted(str(p.id) for p in usp.user_positions)),
+        tuple(sorted(str(p) for p in usp.perm_overrides))
+    )
+
+def resolve(usp: StaffPermissions) -> list[Permission]:
+    """Memoized usp.resolve(), the returned list is shared and must not be modified"""
+    key = _key(usp)
+    resolved = _resolved.get(key)
+
+    if resolved is None:
+        resolved = _resolved[key] = usp.resolve()
+
+    return resolved
+
+def check(usp: StaffPermissions, perm: str) -> bool:
+    """Memoized has_perm(usp.resolve(), Permission.from_str(perm))"""
+    key = (_key(usp), perm)
+    allowed = _checks.get(key)
+
+    if allowed is None:
+        allowed = _checks[key] = has_perm(resolve(usp), Permission.from_str(perm))
+
+    return allowed
 
 async def get_user_staff_perms(pool: asyncpg.Pool, user_id: int) -> StaffPermissions:
-    user_poses = await pool.fetchrow("SELECT positions, perm_overrides FROM staff_members WHERE user_id = $1", str(user_id))
+    user_poses = await queries.staff_member(pool, user_id)
     
     if not user_poses:
         return StaffPermissions(
@@ -10,13 +85,19 @@ async def get_user_staff_perms(pool: asyncpg.Pool, user_id: int) -> StaffPermiss
             user_positions=[]
         )
 
-    position_data = await pool.fetch("SELECT id::text, index, perms FROM staff_positions WHERE id = ANY($1)", user_poses["positions"])
-
     sp = StaffPermissions(
         perm_overrides=Permission.from_str_list(user_poses["perm_overrides"]),
         user_positions=[]
     )
 
+    if _positions is not None and all(str(pos_id) in _positions for pos_id in user_poses["positions"]):
+        sp.user_positions = [_positions[str(pos_id)] for pos_id in user_poses["positions"]]
+        return sp
+
+    # Not preloaded yet or a position was added since, ask the database
+
+    position_data = await queries.staff_positions(pool, user_poses["positions"])
+
     for pos in position_data:
         sp.user_positions.append(
             PartialStaffPosition(
@@ -26,4 +107,4 @@ async def get_user_staff_perms(pool: asyncpg.Pool, user_id: int) -> StaffPermiss
             )
         )
     
-    return sp
\ No newline at end of file
+    return sp
@@ -0,0 +1,110 @@
+import asyncpg
+import datetime
+import queries
+
+class Placement():
+    """Which cache server a bot has been placed in"""
+    def __init__(self, bot_id: str, guild_id: str, name: str, invite_code: str):
+        self.bot_id = bot_id
+        self.guild_id = guild_id
+        self.name = name
+        self.invite_code = invite_code
+
+class PlacementCache():
+    """
+    Read-through cache of cache_server_bots joined with cache_servers
+
+    Anything writing to cache_server_bots (or changing a cache servers invite) must call
+    invalidate/invalidate_guild. Entries also expire after ``ttl`` to cover writes made
+    outside of Borealis (such as cascading deletes from the bots table), and are evicted
+    once expired or when there are more than max_size of them
+
+    A load that was running while its bot (or every bot) was invalidated is returned but not
+    cached, as it may have read the row from before the write
+    """
+    def __init__(self, pool: asyncpg.Pool, ttl: datetime.timedelta = datetime.timedelta(minutes=5), max_size: int = 50000):
+        self.pool = pool
+        self.ttl = ttl
+        self.max_size = max_size
+        self._cache: dict[str, tuple[datetime.datetime, Placement]] = {} # Oldest first
+        self._generations: dict[str, int] = {} # Bumped by invalidate
+        self._epoch = 0 # Bumped by invalidate_guild and clear
+
+    async def get(self, bot_id: str) -> Placement | None:
+        return (await self.get_many([bot_id])).get(bot_id)
+
+    async def get_many(self, bot_ids: list[str]) -> dict[str, Placement]:
+        """Returns the placements of all given bots that are in a cache server, loading misses in one query"""
+        now = datetime.datetime.now()
+
+        found: dict[str, Placement] = {}
+        misses: list[str] = []
+        for bot_id in bot_ids:
+            entry = self._cache.get(bot_id)
+
+            if entry and now - entry[0] < self.ttl:
+                found[bot_id] = entry[1]
+            else:
+                if entry:
+                    del self._cache[bot_id]
+
+                misses.append(bot_id)
+
+        if misses:
+            epoch = self._epoch
+            generations = {bot_id: self._generations.get(bot_id, 0) for bot_id in misses}
+
+            rows = await queries.placements(self.pool, misses)
+
+            for row in rows:
+                placement = Placement(row["bot_id"], row["guild_id"], row["name"], row["invite_code"])
+                found[row["bot_id"]] = placement
+
+                if self._epoch == epoch and self._generations.get(row["bot_id"], 0) == generations[row["bot_id"]]:
+                    self._set(row["bot_id"], now, placement)
+
+            self._evict(now)
+
+        return found
+
+    def _set(self, bot_id: str, at: datetime.datetime, placement: Placement):
+        # Popped first so the dict stays ordered oldest first
+        self._cache.pop(bot_id, None)
+        self._cache[bot_id] = (at, placement)
+
+    def _evict(self, now: datetime.datetime):
+        """Drops expired entries from the front, then the oldest entries while over max_size"""
+        while self._cache:
+            bot_id, (at, _) = next(iter(self._cache.items()))
+
+            if now - at < self.ttl and len(self._cache) <= self.max_size:
+                break
+
+            del self._cache[bot_id]
+
+    async def warm(self):
+        """Loads the placements of every bot"""
+        now = datetime.datetime.now()
+        rows = await self.pool.fetch("SELECT csb.bot_id, csb.guild_id, cs.name, cs.invite_code FROM cache_server_bots csb INNER JOIN cache_servers cs ON cs.guild_id = csb.guild_id")
+
+        for row in rows:
+            self._set(row["bot_id"], now, Placement(row["bot_id"], row["guild_id"], row["name"], row["invite_code"]))
+
+        self._evict(now)
+
+    def invalidate(self, *bot_ids: str):
+        for bot_id in bot_ids:
+            bot_id = str(bot_id)
+            self._cache.pop(bot_id, None)
+            self._generations[bot_id] = self._generations.get(bot_id, 0) + 1
+
+    def invalidate_guild(self, guild_id: str):
+        guild_id = str(guild_id)
+        self._epoch += 1 # Bots being loaded for this guild are not in the cache yet
+        for bot_id, (_, placement) in list(self._cache.items()):
+            if placement.guild_id == guild_id:
+                del self._cache[bot_id]
+
+    def clear(self):
+        self._epoch += 1
+        self._cache.clear()
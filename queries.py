@@ -0,0 +1,126 @@
+import asyncpg
+from asyncpg.prepared_stmt import PreparedStatement
+
+# Hot statements, prepared on every pool connection as it is created (see create_pool)
+QUERIES: dict[str, str] = {
+    "staff_member": "SELECT positions, perm_overrides FROM staff_members WHERE user_id = $1",
+    "staff_positions": "SELECT id::text, index, perms FROM staff_positions WHERE id = ANY($1)",
+    "bot_type": "SELECT type FROM bots WHERE bot_id = $1",
+    "bot_types": "SELECT bot_id, type FROM bots WHERE bot_id = ANY($1)",
+    "bot_is_premium_or_certified": "SELECT COUNT(*) from bots WHERE bot_id = $1 AND (premium = true OR type = 'certified')",
+    "bot_is_whitelisted": "SELECT COUNT(*) from bot_whitelist WHERE bot_id = $1",
+    "bot_is_partner": "SELECT COUNT(*) FROM partners WHERE bot_id = $1",
+    "cache_server_of_bot": "SELECT guild_id FROM cache_server_bots WHERE bot_id = $1",
+    "is_selected_bot": "SELECT COUNT(*) from cache_server_bots WHERE guild_id = $1 AND bot_id = $2",
+    "cache_server_info": "SELECT bots_role, system_bots_role, logs_channel, staff_role, web_moderator_role from cache_servers WHERE guild_id = $1",
+    "cache_server_invite": "SELECT name, invite_code FROM cache_servers WHERE guild_id = $1",
+    "cache_server_counts": "SELECT guild_id, count(*) FROM cache_server_bots GROUP BY guild_id ORDER BY random()",
+    "add_cache_server_bot": "INSERT INTO cache_server_bots (guild_id, bot_id) VALUES ($1, $2)",
+    "placements": "SELECT csb.bot_id, csb.guild_id, cs.name, cs.invite_code FROM cache_server_bots csb INNER JOIN cache_servers cs ON cs.guild_id = csb.guild_id WHERE csb.bot_id = ANY($1)",
+}
+
+class BorealisConnection(asyncpg.Connection):
+    """Pool connection holding a prepared statement for each query in QUERIES"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.statements: dict[str, PreparedStatement] = {}
+
+async def prepare_statements(conn: BorealisConnection):
+    for name, query in QUERIES.items():
+        conn.statements[name] = await conn.prepare(query)
+
+async def create_pool(dsn: str, **kwargs) -> asyncpg.Pool:
+    """Creates a pool whose connections have every query in QUERIES prepared"""
+    return await asyncpg.create_pool(dsn, connection_class=BorealisConnection, init=prepare_statements, **kwargs)
+
+async def _run_on(conn: asyncpg.Connection, method: str, name: str, *args):
+    statements: dict[str, PreparedStatement] | None = getattr(conn, "statements", None)
+
+    if statements is None:
+        # Not a pool made by create_pool, run the query inline
+        return await getattr(conn, method)(QUERIES[name], *args)
+
+    if name not in statements:
+        statements[name] = await conn.prepare(QUERIES[name])
+
+    try:
+        return await getattr(statements[name], method)(*args)
+    except asyncpg.exceptions.InterfaceError as exc:
+        # Closed by an earlier OutdatedSchemaCacheError, nothing was sent so it can be prepared again anywhere
+        if "prepared statement is closed" not in str(exc):
+            raise
+
+        statements[name] = await conn.prepare(QUERIES[name])
+        return await getattr(statements[name], method)(*args)
+    except (asyncpg.exceptions.InvalidCachedStatementError, asyncpg.exceptions.OutdatedSchemaCacheError):
+        # The schema changed under the statement (e.g. a migration or ALTER TYPE). An open transaction is
+        # aborted by now, so only drop the statement there and let the next use prepare it again
+        if conn.is_in_transaction():
+            del statements[name]
+            raise
+
+        statements[name] = await conn.prepare(QUERIES[name])
+        return await getattr(statements[name], method)(*args)
+
+async def _run(pool: asyncpg.Pool | asyncpg.Connection, method: str, name: str, *args):
+    """Runs a query on a connection from pool, or on pool itself if it is a connection (e.g. inside a transaction)"""
+    if isinstance(pool, asyncpg.Connection):
+        return await _run_on(pool, method, name, *args)
+
+    async with pool.acquire() as conn:
+        return await _run_on(conn, method, name, *args)
+
+async def fetch(pool: asyncpg.Pool, name: str, *args) -> list[asyncpg.Record]:
+    return await _run(pool, "fetch", name, *args)
+
+async def fetchrow(pool: asyncpg.Pool, name: str, *args) -> asyncpg.Record | None:
+    return await _run(pool, "fetchrow", name, *args)
+
+async def fetchval(pool: asyncpg.Pool, name: str, *args):
+    return await _run(pool, "fetchval", name, *args)
+
+async def execute(pool: asyncpg.Pool, name: str, *args):
+    # Prepared statements have no execute, fetch runs them just the same
+    await _run(pool, "fetch", name, *args)
+
+async def staff_member(pool: asyncpg.Pool, user_id: int) -> asyncpg.Record | None:
+    return await fetchrow(pool, "staff_member", str(user_id))
+
+async def staff_positions(pool: asyncpg.Pool, position_ids: list) -> list[asyncpg.Record]:
+    return await fetch(pool, "staff_positions", position_ids)
+
+async def bot_type(pool: asyncpg.Pool, bot_id: int | str) -> str | None:
+    return await fetchval(pool, "bot_type", str(bot_id))
+
+async def bot_types(pool: asyncpg.Pool, bot_ids: list[str]) -> dict[str, str]:
+    return {r["bot_id"]: r["type"] for r in await fetch(pool, "bot_types", bot_ids)}
+
+async def bot_may_stay_on_main_server(pool: asyncpg.Pool, bot_id: int) -> bool:
+    """Whether a bot is whitelisted, premium/certified or a partner"""
+    for name in ("bot_is_whitelisted", "bot_is_premium_or_certified", "bot_is_partner"):
+        if await fetchval(pool, name, str(bot_id)):
+            return True
+
+    return False
+
+async def cache_server_of_bot(pool: asyncpg.Pool, bot_id: int | str) -> str | None:
+    return await fetchval(pool, "cache_server_of_bot", str(bot_id))
+
+async def is_selected_bot(pool: asyncpg.Pool, guild_id: int, bot_id: int) -> bool:
+    return bool(await fetchval(pool, "is_selected_bot", str(guild_id), str(bot_id)))
+
+async def cache_server_info(pool: asyncpg.Pool, guild_id: int | str) -> asyncpg.Record | None:
+    return await fetchrow(pool, "cache_server_info", str(guild_id))
+
+async def cache_server_invite(pool: asyncpg.Pool, guild_id: int | str) -> asyncpg.Record | None:
+    return await fetchrow(pool, "cache_server_invite", str(guild_id))
+
+async def cache_server_counts(pool: asyncpg.Pool) -> list[asyncpg.Record]:
+    """Number of bots on each cache server with at least one bot, in random order"""
+    return await fetch(pool, "cache_server_counts")
+
+async def add_cache_server_bot(pool: asyncpg.Pool, guild_id: str, bot_id: str):
+    await execute(pool, "add_cache_server_bot", guild_id, bot_id)
+
+async def placements(pool: asyncpg.Pool, bot_ids: list[str]) -> list[asyncpg.Record]:
+    return await fetch(pool, "placements", bot_ids)
@@ -0,0 +1,128 @@
+import asyncpg
+import asyncio
+import heapq
+from typing import Awaitable, Callable
+from constants import PLACEMENT_LOCK
+
+class Move():
+    """Moving a bot from one cache server to another"""
+    def __init__(self, bot_id: str, from_guild: str, to_guild: str, present: bool):
+        self.bot_id = bot_id
+        self.from_guild = from_guild
+        self.to_guild = to_guild
+        self.present = present # Whether the bot has already joined from_guild (and so must be kicked and re-added)
+
+def plan_moves(
+    occupancy: dict[str, list[tuple[str, bool]]],
+    capacity: int,
+    include_present: bool = False,
+    max_moves: int | None = None
+) -> list[Move]:
+    """
+    Plans the fewest moves needed to even out the number of bots on each cache server
+
+    occupancy maps every cache server to its (bot_id, present) pairs. Bots that have not joined their
+    server yet are moved first as moving them costs nothing, bots that have joined are only moved if
+    include_present is set. Moves stop once the fullest and emptiest server differ by at most one bot
+    (or no more movable bots are left)
+    """
+    if len(occupancy) < 2:
+        return []
+
+    counts = {g: len(bots) for g, bots in occupancy.items()}
+
+    # Movable bots of each server, not yet joined bots last so they are popped first
+    movable: dict[str, list[str]] = {}
+    for g, bots in occupancy.items():
+        movable[g] = [b for b, present in bots if present] if include_present else []
+        movable[g] += [b for b, present in bots if not present]
+
+    present = {b for bots in occupancy.values() for b, p in bots if p}
+
+    donors = [(-c, g) for g, c in counts.items() if movable[g]]
+    receivers = [(c, g) for g, c in counts.items() if c < capacity]
+    heapq.heapify(donors)
+    heapq.heapify(receivers)
+
+    moves: list[Move] = []
+    while donors and receivers and (max_moves is None or len(moves) < max_moves):
+        donor_count, donor = -donors[0][0], donors[0][1]
+        receiver_count, receiver = receivers[0]
+
+        if donor_count - receiver_count <= 1:
+            break
+
+        heapq.heappop(donors)
+        heapq.heappop(receivers)
+
+        bot_id = movable[donor].pop()
+        moves.append(Move(bot_id, donor, receiver, bot_id in present))
+
+        counts[donor] -= 1
+        counts[receiver] += 1
+
+        if movable[donor]:
+            heapq.heappush(donors, (-counts[donor], donor))
+        if counts[receiver] < capacity:
+            heapq.heappush(receivers, (counts[receiver], receiver))
+
+    return moves
+
+class Rebalancer():
+    """Applies planned moves to cache_server_bots in small batches, sleeping between them to stay under rate limits"""
+    def __init__(self, pool: asyncpg.Pool, capacity: int, batch_size: int = 10, batch_delay: float = 5):
+        self.pool = pool
+        self.capacity = capacity
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+
+    async def occupancy(self, guild_ids: list[str], is_present: Callable[[str, str], bool]) -> dict[str, list[tuple[str, bool]]]:
+        """Loads the bots placed on each of the given cache servers, is_present(guild_id, bot_id) says whether a bot has joined"""
+        rows = await self.pool.fetch("SELECT guild_id, bot_id FROM cache_server_bots WHERE guild_id = ANY($1)", guild_ids)
+
+        occupancy: dict[str, list[tuple[str, bool]]] = {g: [] for g in guild_ids}
+        for row in rows:
+            occupancy[row["guild_id"]].append((row["bot_id"], is_present(row["guild_id"], row["bot_id"])))
+
+        return occupancy
+
+    async def apply(self, moves: list[Move], on_batch: Callable[[list[Move]], Awaitable[None]] | None = None) -> list[Move]:
+        """
+        Applies moves, returning the ones that were applied
+
+        A move is skipped if the bot is no longer on from_guild (it was moved or removed since the plan was made)
+        or if to_guild has been filled up since. on_batch is awaited with the moves applied by each batch
+        """
+        applied: list[Move] = []
+
+        for i in range(0, len(moves), self.batch_size):
+            batch = moves[i:i + self.batch_size]
+
+            async with self.pool.acquire() as conn:
+                async with conn.transaction():
+                    await conn.execute(PLACEMENT_LOCK)
+
+                    batch_applied = []
+                    for move in batch:
+                        if await conn.fetchval("SELECT COUNT(*) FROM cache_server_bots WHERE guild_id = $1", move.to_guild) >= self.capacity:
+                            continue
+
+                        status = await conn.execute(
+                            "UPDATE cache_server_bots SET guild_id = $1, moved_at = NOW(), added = 0 WHERE bot_id = $2 AND guild_id = $3",
+                            move.to_guild,
+                            move.bot_id,
+                            move.from_guild
+                        )
+
+                        if status != "UPDATE 0":
+                            batch_applied.append(move)
+
+            applied.extend(batch_applied)
+
+            if on_batch and batch_applied:
+                await on_batch(batch_applied)
+
+            if i + self.batch_size < len(moves):
+                await asyncio.sleep(self.batch_delay)
+
+        return applied
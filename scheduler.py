@@ -0,0 +1,112 @@
+import asyncio
+import datetime
+import random
+import traceback
+import sys
+from typing import AsyncIterator, Awaitable, Callable, Iterable, TypeVar
+
+T = TypeVar("T")
+
+class Job():
+    """
+    A periodic job whose interval adapts to how much drift it finds
+
+    The job function is given the job and returns how many problems it fixed. Finding drift
+    halves the interval (down to min_interval), a clean run grows it by a quarter (up to max_interval)
+    """
+    def __init__(
+        self,
+        name: str,
+        func: Callable[["Job"], Awaitable[int | None]],
+        interval: datetime.timedelta,
+        min_interval: datetime.timedelta | None = None,
+        max_interval: datetime.timedelta | None = None,
+        jitter: float = 0.1
+    ):
+        self.name = name
+        self.func = func
+        self.base_interval = interval.total_seconds()
+        self.interval = self.base_interval
+        self.min_interval = (min_interval or interval / 5).total_seconds()
+        self.max_interval = (max_interval or interval * 3).total_seconds()
+        self.jitter = jitter
+        self.running = False
+        self.last_run: datetime.datetime | None = None
+        self.last_drift: int | None = None
+        self.task: asyncio.Task | None = None
+
+    def next_delay(self) -> float:
+        return self.interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def adapt(self, drift: int):
+        if drift:
+            self.interval = max(self.min_interval, self.interval / 2)
+        else:
+            self.interval = min(self.max_interval, self.interval * 1.25)
+
+    async def spread(self, items: Iterable[T], fraction: float = 0.5) -> AsyncIterator[T]:
+        """
+        Yields items spread over ``fraction`` of the current interval, so one run does not hit every guild at once
+
+        Time already spent handling an item counts towards the wait before the next one
+        """
+        items = list(items)
+
+        if not items:
+            return
+
+        per_item = self.interval * fraction / len(items)
+        loop = asyncio.get_running_loop()
+
+        for item in items:
+            started = loop.time()
+            yield item
+            remaining = per_item - (loop.time() - started)
+
+            if remaining > 0:
+                await asyncio.sleep(remaining)
+
+    async def run_once(self):
+        self.running = True
+        try:
+            drift = await self.func(self) or 0
+        except Exception as exc:
+            print(f"Scheduler: Job {self.name} failed, resetting its interval")
+            traceback.print_exception(type(exc), exc, exc.__traceback__, file=sys.stderr)
+            self.interval = self.base_interval
+            return
+        finally:
+            self.running = False
+            self.last_run = datetime.datetime.now()
+
+        self.last_drift = drift
+        self.adapt(drift)
+
+    async def run_forever(self, offset: float):
+        await asyncio.sleep(offset)
+
+        while True:
+            # A run always finishes before the next one is scheduled, so runs never overlap
+            await self.run_once()
+            await asyncio.sleep(self.next_delay())
+
+class Scheduler():
+    """Runs adaptive jobs, staggering their first runs so they do not all start together"""
+    def __init__(self):
+        self.jobs: dict[str, Job] = {}
+
+    def job(self, interval: datetime.timedelta, **kwargs):
+        """Decorator registering a job"""
+        def decorator(func: Callable[[Job], Awaitable[int | None]]):
+            self.jobs[func.__name__] = Job(func.__name__, func, interval, **kwargs)
+            return func
+
+        return decorator
+
+    def start(self):
+        for i, job in enumerate(self.jobs.values()):
+            if job.task and not job.task.done():
+                continue
+
+            offset = job.base_interval * i / len(self.jobs)
+            job.task = asyncio.create_task(job.run_forever(offset))
@@ -30,6 +30,7 @@ CREATE TABLE public.cache_server_bots (
     guild_id text NOT NULL REFERENCES cache_servers(guild_id) ON UPDATE CASCADE ON DELETE CASCADE,
     bot_id text NOT NULL UNIQUE REFERENCES bots(bot_id) ON UPDATE CASCADE ON DELETE CASCADE,
     created_at timestamp with time zone DEFAULT now() NOT NULL,
+    moved_at timestamp with time zone, -- Last rebalance, created_at stays the original placement so moves are not counted as new ones
     added integer DEFAULT 0 NOT NULL
 );
 
@@ -44,4 +45,56 @@ CREATE TABLE cache_server_oauths (
 
 create table cache_server_oauth_md (
     owner_id text not null
-);
\ No newline at end of file
+);
+
+-- Pending OAuth2 states, only used when oauth_state_backend is postgres
+create table cache_server_oauth_states (
+    state text primary key,
+    bot text not null,
+    created_at timestamptz not null default now()
+);
+
+-- Gateway read model published by the bot for standalone API workers (api_mode: standalone)
+create table cache_server_gateway_guilds (
+    guild_id text primary key,
+    name text not null,
+    member_count integer not null,
+    updated_at timestamptz not null default now()
+);
+
+create table cache_server_gateway_members (
+    guild_id text not null references cache_server_gateway_guilds(guild_id) on update cascade on delete cascade,
+    user_id text not null,
+    primary key (guild_id, user_id)
+);
+
+-- Cache servers the bot is currently missing from, and since when
+create table cache_server_missing (
+    guild_id text primary key references cache_servers(guild_id) on update cascade on delete cascade,
+    first_missing_at timestamptz not null default now()
+);
+
+-- Unprovisioned cache servers created by the capacity planner that have not been set up yet
+create table cache_server_pending (
+    guild_id text primary key,
+    created_at timestamptz not null default now()
+);
+
+-- Every attempt of the capacity planner to create a cache server, the cooldown runs from the latest one
+create table cache_server_provision_attempts (
+    id serial primary key,
+    guild_id text, -- set once the server was created
+    error text, -- set if creating it failed
+    created_at timestamptz not null default now()
+);
+
+-- Append-only log of actions taken on cache servers, written in batches by audit.ActionLog
+create table cache_server_actions (
+    guild_id text not null,
+    target_id text,
+    action text not null,
+    reason text,
+    created_at timestamptz not null default now()
+);
+
+create index cache_server_actions_guild_id_idx on cache_server_actions (guild_id, created_at);
@@ -0,0 +1,182 @@
+import discord
+import datetime
+import hashlib
+import sqlite3
+import time
+
+SNAPSHOT_VERSION = 3
+
+class GuildState():
+    """What Borealis last reconciled for one guild"""
+    def __init__(
+        self,
+        shape: bytes | None = None,
+        members: bytes | None = None,
+        icon_name: str | None = None,
+        icon_key: str | None = None,
+        reconciled_at: float | None = None
+    ):
+        self.shape = shape # See shape_fingerprint
+        self.members = members # See members_fingerprint, None if the guild was not chunked
+        self.icon_name = icon_name # Name drawn on the icon ensure_guild_image last set
+        self.icon_key = icon_key # Hash of that icon
+        self.reconciled_at = reconciled_at # When shape and members were recorded by validate_members
+
+def shape_fingerprint(guild: discord.Guild, cache_server_info: dict) -> bytes:
+    """Fingerprint of everything validate_members checks that does not need the member list"""
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f"{guild.name}\0{guild.member_count}\0".encode())
+
+    for role in sorted(guild.roles, key=lambda r: r.id):
+        h.update(f"{role.id}:{role.permissions.value};".encode())
+
+    for key in sorted(cache_server_info):
+        h.update(f"{key}={cache_server_info[key]};".encode())
+
+    return h.digest()
+
+def members_fingerprint(guild: discord.Guild) -> bytes:
+    """Fingerprint of every cached member and their roles"""
+    h = hashlib.blake2b(digest_size=16)
+
+    for member in sorted(guild.members, key=lambda m: m.id):
+        h.update(f"{member.id}:{','.join(str(r.id) for r in sorted(member.roles, key=lambda r: r.id))};".encode())
+
+    return h.digest()
+
+class Snapshot():
+    """
+    On-disk (SQLite) snapshot of the last reconciled state of each guild, so a restart does not redo all of it
+
+    Fingerprints older than max_age when loaded are not trusted, as too much may have been missed while
+    Borealis was down. Ages are kept per guild and only reset by actually reconciling, so saving restored
+    state again does not make it look fresh. Invites are not kept, ensure_invites always polls them after
+    a restart to catch events missed while down. Write is blocking, pass rows() to it from the event loop
+    and run it in a thread
+    """
+    def __init__(self, path: str, max_age: datetime.timedelta = datetime.timedelta(minutes=30)):
+        self.path = path
+        self.max_age = max_age
+        self.guilds: dict[int, GuildState] = {}
+        self.restored: set[int] = set() # Guilds whose fingerprints came from disk and have not been reconciled since
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path)
+
+        # Snapshots from an older layout are simply discarded
+        if conn.execute("PRAGMA user_version").fetchone()[0] != SNAPSHOT_VERSION:
+            with conn:
+                conn.execute("DROP TABLE IF EXISTS meta")
+                conn.execute("DROP TABLE IF EXISTS guilds")
+                conn.execute(f"PRAGMA user_version = {SNAPSHOT_VERSION}")
+
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS guilds (guild_id INTEGER PRIMARY KEY, shape BLOB, members BLOB, icon_name TEXT, icon_key TEXT, reconciled_at REAL)"
+        )
+        return conn
+
+    def load(self) -> int:
+        """Loads the snapshot from disk, returning how many guilds were restored"""
+        try:
+            conn = self._connect()
+        except sqlite3.Error as exc:
+            print(f"Snapshot: Failed to open {self.path}, starting without one: {exc}")
+            return 0
+
+        try:
+            for guild_id, shape, members, icon_name, icon_key, reconciled_at in conn.execute("SELECT guild_id, shape, members, icon_name, icon_key, reconciled_at FROM guilds"):
+                self.guilds[guild_id] = GuildState(
+                    shape=shape,
+                    members=members,
+                    icon_name=icon_name,
+                    icon_key=icon_key,
+                    reconciled_at=reconciled_at
+                )
+        except sqlite3.Error as exc:
+            print(f"Snapshot: Failed to read {self.path}, starting without one: {exc}")
+            self.guilds = {}
+            return 0
+        finally:
+            conn.close()
+
+        self.restored = {g for g, state in self.guilds.items() if self._fresh(state.reconciled_at)}
+        return len(self.restored)
+
+    def _fresh(self, at: float | None) -> bool:
+        return at is not None and time.time() - at <= self.max_age.total_seconds()
+
+    def state(self, guild_id: int) -> GuildState:
+        if guild_id not in self.guilds:
+            self.guilds[guild_id] = GuildState()
+
+        return self.guilds[guild_id]
+
+    def forget(self, guild_id: int):
+        self.guilds.pop(guild_id, None)
+        self.restored.discard(guild_id)
+
+    def unchanged(self, guild: discord.Guild, cache_server_info: dict) -> bool:
+        """
+        Whether a guild restored from disk still looks as it did when last reconciled
+
+        Member roles are only compared if the guild is chunked, otherwise the shape alone decides
+        """
+        if guild.id not in self.restored:
+            return False
+
+        state = self.guilds[guild.id]
+
+        if state.shape != shape_fingerprint(guild, cache_server_info):
+            return False
+
+        if guild.chunked and state.members is not None and state.members != members_fingerprint(guild):
+            return False
+
+        return True
+
+    def reconciled(self, guild: discord.Guild, cache_server_info: dict):
+        """Records a guild as just validated"""
+        state = self.state(guild.id)
+        state.shape = shape_fingerprint(guild, cache_server_info)
+        state.members = members_fingerprint(guild) if guild.chunked else None
+        state.reconciled_at = time.time()
+        self.restored.discard(guild.id)
+
+    def icon_unchanged(self, guild: discord.Guild, name: str) -> bool:
+        """Whether the guild still has the icon ensure_guild_image last set for name"""
+        state = self.guilds.get(guild.id)
+
+        if not state or not guild.icon:
+            return False
+
+        return state.icon_name == name and state.icon_key == guild.icon.key
+
+    def rows(self) -> list[tuple]:
+        return [
+            (
+                guild_id,
+                state.shape,
+                state.members,
+                state.icon_name,
+                state.icon_key,
+                state.reconciled_at
+            )
+            for guild_id, state in self.guilds.items()
+        ]
+
+    def write(self, rows: list[tuple]):
+        """Replaces the snapshot on disk with rows, in one transaction"""
+        conn = self._connect()
+
+        try:
+            with conn:
+                conn.execute("DELETE FROM guilds")
+                conn.executemany(
+                    "INSERT INTO guilds (guild_id, shape, members, icon_name, icon_key, reconciled_at) VALUES (?, ?, ?, ?, ?, ?)",
+                    rows
+                )
+        finally:
+            conn.close()
+
+    def save(self):
+        self.write(self.rows())
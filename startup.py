@@ -0,0 +1,35 @@
+import asyncio
+import time
+from contextlib import contextmanager
+from typing import Awaitable
+
+class StartupTimer():
+    """Records how long each startup phase took"""
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases: list[tuple[str, float]] = []
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - start))
+
+    async def timed(self, name: str, aw: Awaitable):
+        with self.phase(name):
+            return await aw
+
+    def report(self) -> str:
+        lines = [f"- {name}: {took * 1000:.0f}ms" for name, took in self.phases]
+        lines.append(f"- total: {(time.perf_counter() - self.started) * 1000:.0f}ms")
+        return "Startup timings:\n" + "\n".join(lines)
+
+async def warm_caches(timer: StartupTimer, **loaders: Awaitable):
+    """Runs all cache loaders concurrently, timing each. A failing loader is logged and does not stop the others"""
+    results = await asyncio.gather(*[timer.timed(f"warm {name}", aw) for name, aw in loaders.items()], return_exceptions=True)
+
+    for name, res in zip(loaders.keys(), results):
+        if isinstance(res, Exception):
+            print(f"warm_caches: Failed to warm {name}: {res}")
@@ -0,0 +1,65 @@
+import asyncpg
+from typing import Any, Callable
+
+class WriteBehind():
+    """
+    Coalesces low priority single column UPDATEs of one table
+
+    set only records the value, keeping the last one written per (key, column). flush writes everything
+    pending with one executemany per column. Callers must already have applied the value in memory, and
+    anything reloading rows from the table should overlay pending values on top (see overlay)
+    """
+    def __init__(self, pool: asyncpg.Pool, table: str, key_column: str, columns: set[str], on_flush: Callable[[set[str]], None] | None = None):
+        self.pool = pool
+        self.table = table
+        self.key_column = key_column
+        self.columns = columns
+        self.on_flush = on_flush
+        self._pending: dict[tuple[str, str], Any] = {}
+
+    def set(self, key: str, column: str, value: Any):
+        if column not in self.columns:
+            raise ValueError(f"{column} is not a write-behind column of {self.table}")
+
+        self._pending[(key, column)] = value
+
+    def overlay(self, key: str, row: dict) -> dict:
+        """Applies pending values for key to row"""
+        for column in self.columns:
+            if (key, column) in self._pending:
+                row[column] = self._pending[(key, column)]
+
+        return row
+
+    def __len__(self):
+        return len(self._pending)
+
+    async def flush(self) -> int:
+        """Writes all pending values, returning how many were written"""
+        if not self._pending:
+            return 0
+
+        pending, self._pending = self._pending, {}
+
+        by_column: dict[str, list[tuple[Any, str]]] = {}
+        for (key, column), value in pending.items():
+            by_column.setdefault(column, []).append((value, key))
+
+        try:
+            async with self.pool.acquire() as conn:
+                async with conn.transaction():
+                    for column, args in by_column.items():
+                        await conn.executemany(f"UPDATE {self.table} SET {column} = $1 WHERE {self.key_column} = $2", args)
+        except (asyncpg.PostgresError, OSError) as exc:
+            print(f"WriteBehind: Failed to flush {len(pending)} {self.table} updates, will retry: {exc}")
+
+            # Values set while flushing are newer, keep those
+            for k, value in pending.items():
+                self._pending.setdefault(k, value)
+
+            return 0
+
+        if self.on_flush:
+            self.on_flush({key for key, _ in pending})
+
+        return len(pending)